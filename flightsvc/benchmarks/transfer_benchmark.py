@@ -0,0 +1,388 @@
+"""
+Parametric Flight transfer benchmark.
+
+Starts an in-process FlightServer on localhost (or targets a running one with
+--location) and sweeps rows, columns, column types, batch size, compression
+and concurrency over do_put, do_get and the catalog calls, and reads every
+flight split into 1, 2, 4 and 8 row range partitions fetched in parallel.
+Every case reports throughput, p50/p99 latency and how much the RSS of the
+process grew while it ran as JSON, and can be compared against a stored
+baseline run:
+
+    python -m flightsvc.benchmarks.transfer_benchmark --output run.json
+    python -m flightsvc.benchmarks.transfer_benchmark --baseline run.json --tolerance 0.15
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import timeit
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_compression import available_codecs, write_options
+from flightsvc.controllers.flight_pool import FlightClientPool
+from flightsvc.controllers.flight_query import query_descriptor
+from flightsvc.controllers.parallel_flight_client import fetch_endpoints
+from flightsvc.controllers.synthetic_data import SyntheticData, column
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
+
+COLUMN_TYPES = ['int64', 'float64', 'string', 'dictionary']
+
+# metrics compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {'throughput_mb_s': True, 'p50_ms': False, 'p99_ms': False}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def current_rss_mb():
+    # the resident set now; without /proc only the peak of the process so far is known
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return peak_rss_mb()
+
+
+class RssSampler:
+    """
+    Samples the RSS of the process on a thread while a case runs.
+
+    ru_maxrss is the peak of the whole process and never goes down, so it
+    only tells about the largest case run so far; the growth over the RSS
+    the case started from is reported instead.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = current_rss_mb()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+    @property
+    def growth_mb(self):
+        return self.peak - self.start
+
+
+def make_table(rows, columns, column_type, seed=0):
+    """
+    Generates a table of `columns` random columns of one type.
+    """
+    if column_type not in COLUMN_TYPES:
+        raise ValueError(f"Invalid column type {column_type!r}, expected one of {COLUMN_TYPES}")
+    specs = []
+    for i in range(columns):
+        name = f'col_{i}'
+        if column_type == 'string':
+            specs.append(column(name, 'string', cardinality=max(rows, 1)))
+        elif column_type == 'dictionary':
+            specs.append(column(name, 'symbol', 'zipf', cardinality=500))
+        else:
+            specs.append(column(name, column_type))
+    return SyntheticData(specs, rows, seed=seed).to_table()
+
+
+def summarize(latencies, wall_seconds, nbytes, rows, rss_growth_mb):
+    """
+    Returns the metrics of a case from the latency of every operation.
+    """
+    latencies = numpy.array(latencies) * 1000
+    return {
+        'ops': len(latencies),
+        'seconds': round(wall_seconds, 4),
+        'throughput_mb_s': round(nbytes / 1024 / 1024 / wall_seconds, 2) if nbytes else None,
+        'rows_per_s': round(rows / wall_seconds) if rows else None,
+        'ops_per_s': round(len(latencies) / wall_seconds, 2),
+        'p50_ms': round(float(numpy.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(numpy.percentile(latencies, 99)), 3),
+        'rss_growth_mb': round(rss_growth_mb, 1),
+    }
+
+
+def run_concurrently(operation, concurrency, repeat):
+    """
+    Runs `operation(worker, i)` `repeat` times on each of `concurrency` threads.
+
+    Returns:
+        tuple: (latency of every call in seconds, wall clock seconds, RSS growth in MB)
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(w):
+        for i in range(repeat):
+            tic = timeit.default_timer()
+            operation(w, i)
+            toc = timeit.default_timer()
+            with lock:
+                latencies.append(toc - tic)
+
+    with RssSampler() as rss:
+        tic = timeit.default_timer()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+        seconds = timeit.default_timer() - tic
+    return latencies, seconds, rss.growth_mb
+
+
+class TransferBenchmark:
+    """
+    Runs the benchmark cases against one Flight server.
+
+    Args:
+        location (str): The Flight URL of the server.
+        repeat (int): The number of calls per worker thread in every case.
+        connections (int): The connections the partitioned reads share.
+    """
+
+    def __init__(self, location, repeat=3, connections=32):
+        self.location = location
+        self.repeat = repeat
+        self._clients = {}
+        # partitions are read over pooled connections, so no case pays for connecting
+        self._pool = FlightClientPool(max_per_destination=connections)
+
+    def client(self, worker):
+        # one connection per worker thread, reused across cases
+        if worker not in self._clients:
+            self._clients[worker] = flight.FlightClient(self.location)
+        return self._clients[worker]
+
+    def clear(self):
+        list(self.client(0).do_action(flight.Action('clear', b'')))
+
+    def put_case(self, table, batch_size, codec, concurrency):
+        options = flight.FlightCallOptions(write_options=write_options(codec))
+
+        def put(worker, i):
+            descriptor = flight.FlightDescriptor.for_command(f'bench_put_{worker}')
+            writer, reader = self.client(worker).do_put(descriptor, table.schema, options=options)
+            writer.write_table(table, max_chunksize=batch_size)
+            writer.close()
+
+        latencies, seconds, rss = run_concurrently(put, concurrency, self.repeat)
+        return summarize(latencies, seconds, table.nbytes * len(latencies), table.num_rows * len(latencies), rss)
+
+    def load(self, table, batch_size):
+        descriptor = flight.FlightDescriptor.for_command('bench_get')
+        writer, reader = self.client(0).do_put(descriptor, table.schema)
+        writer.write_table(table, max_chunksize=batch_size)
+        writer.close()
+
+    def get_case(self, table, codec, concurrency, partitions):
+        # the flight stored by load(), split into `partitions` endpoints read in parallel
+        info = self.client(0).get_flight_info(query_descriptor('bench_get', partitions=partitions, compression=codec))
+
+        def get(worker, i):
+            fetch_endpoints(info, self.location, pool=self._pool)
+
+        latencies, seconds, rss = run_concurrently(get, concurrency, self.repeat)
+        return summarize(latencies, seconds, table.nbytes * len(latencies), table.num_rows * len(latencies), rss)
+
+    def catalog_case(self, flights, concurrency):
+        table = make_table(10, 2, 'int64')
+        for i in range(flights):
+            writer, reader = self.client(0).do_put(
+                flight.FlightDescriptor.for_command(f'bench_catalog_{i:06d}'), table.schema)
+            writer.write_table(table)
+            writer.close()
+
+        def list_flights(worker, i):
+            list(self.client(worker).list_flights())
+
+        def get_flight_info(worker, i):
+            self.client(worker).get_flight_info(
+                flight.FlightDescriptor.for_command(f'bench_catalog_{(worker * self.repeat + i) % flights:06d}'))
+
+        results = {}
+        for op, call in (('list_flights', list_flights), ('get_flight_info', get_flight_info)):
+            latencies, seconds, rss = run_concurrently(call, concurrency, self.repeat)
+            results[op] = summarize(latencies, seconds, 0, 0, rss)
+        return results
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._pool.close()
+
+
+def case_id(params):
+    return ','.join(f'{k}={params[k]}' for k in sorted(params))
+
+
+def run(args):
+    server = None
+    location = args.location
+    if location is None:
+        from flightsvc.controllers.multi_flight_producer import FlightServer
+        server = FlightServer(location='grpc://localhost:0')
+        threading.Thread(target=server.serve, daemon=True).start()
+        location = f'grpc://localhost:{server.port}'
+    log.info(f'benchmarking {location}')
+
+    bench = TransferBenchmark(location, repeat=args.repeat,
+                              connections=max(args.partitions) * max(args.concurrency))
+    codecs = [codec for codec in args.compression if codec == 'none' or codec in available_codecs()]
+    results = []
+    try:
+        for rows, columns, column_type in itertools.product(args.rows, args.columns, args.types):
+            table = make_table(rows, columns, column_type)
+            for batch_size, codec, concurrency in itertools.product(args.batch_size, codecs, args.concurrency):
+                params = {'rows': rows, 'columns': columns, 'type': column_type, 'batch_size': batch_size,
+                          'compression': codec, 'concurrency': concurrency}
+                codec_name = None if codec == 'none' else codec
+                bench.clear()
+                cases = [('put', params, bench.put_case(table, batch_size, codec_name, concurrency))]
+                bench.clear()
+                bench.load(table, batch_size)
+                for partitions in args.partitions:
+                    cases.append(('get', {**params, 'partitions': partitions},
+                                  bench.get_case(table, codec_name, concurrency, partitions)))
+                for op, case_params, metrics in cases:
+                    results.append({'op': op, 'params': case_params, **metrics})
+                    log.info(f"{op} {case_id(case_params)}: {metrics['throughput_mb_s']} MB/s, "
+                             f"p50 {metrics['p50_ms']} ms, p99 {metrics['p99_ms']} ms, "
+                             f"RSS +{metrics['rss_growth_mb']} MB")
+        for flights, concurrency in itertools.product(args.catalog_flights, args.concurrency):
+            bench.clear()
+            params = {'flights': flights, 'concurrency': concurrency}
+            for op, metrics in bench.catalog_case(flights, concurrency).items():
+                results.append({'op': op, 'params': params, **metrics})
+                log.info(f"{op} {case_id(params)}: {metrics['ops_per_s']} ops/s, "
+                         f"p50 {metrics['p50_ms']} ms, p99 {metrics['p99_ms']} ms")
+        bench.clear()
+    finally:
+        bench.close()
+        if server is not None:
+            server.shutdown()
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pyarrow': pyarrow.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'location': args.location or 'in-process',
+            'repeat': args.repeat,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compares a run with a baseline run, case by case.
+
+    A case regresses when a metric is worse than the baseline by more than
+    `tolerance` (a fraction). Cases missing from either run are skipped.
+
+    Returns:
+        list: One dict per regressed metric.
+    """
+    previous = {(r['op'], case_id(r['params'])): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = previous.get((result['op'], case_id(result['params'])))
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, reference = result.get(metric), base.get(metric)
+            if not value or not reference:
+                continue
+            change = (value - reference) / reference
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({'op': result['op'], 'case': case_id(result['params']), 'metric': metric,
+                                    'baseline': reference, 'value': value, 'change': round(change, 3)})
+    return regressions
+
+
+# the values of the sweep axes not given on the command line, and the smaller ones of --quick
+SWEEP = {'rows': [100000, 1000000], 'columns': [3, 30], 'types': ['int64', 'string'],
+         'concurrency': [1, 4], 'partitions': [1, 2, 4, 8], 'catalog_flights': [1000]}
+QUICK_SWEEP = {'rows': [100000], 'columns': [3], 'types': ['int64'],
+               'concurrency': [1, 4], 'partitions': [1, 4], 'catalog_flights': [100]}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Flight transfer benchmark")
+    parser.add_argument("--location", type=str, default=None,
+                        help="Flight URL of a running server, defaults to an in-process server")
+    parser.add_argument("--rows", type=int, nargs='+')
+    parser.add_argument("--columns", type=int, nargs='+')
+    parser.add_argument("--types", nargs='+', choices=COLUMN_TYPES)
+    parser.add_argument("--batch_size", type=int, nargs='+', default=[65536])
+    parser.add_argument("--compression", nargs='+', choices=['none', 'lz4', 'zstd'], default=['none', 'lz4'])
+    parser.add_argument("--concurrency", type=int, nargs='+')
+    parser.add_argument("--partitions", type=int, nargs='+',
+                        help="row range partitions every get reads in parallel")
+    parser.add_argument("--catalog_flights", type=int, nargs='+')
+    parser.add_argument("--repeat", type=int, default=3, help="calls per worker thread in every case")
+    parser.add_argument("--quick", action='store_true',
+                        help="run a small sweep of the axes not given, e.g. as a pre-deploy smoke test")
+    parser.add_argument("--output", type=str, default=None, help="write the JSON report to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown tolerated before a case counts as a regression")
+    args = parser.parse_args(argv)
+    for name, values in (QUICK_SWEEP if args.quick else SWEEP).items():
+        if getattr(args, name) is None:
+            setattr(args, name, values)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report['regressions'] = compare(report, baseline, args.tolerance)
+        for regression in report['regressions']:
+            log.warning(f"regression in {regression['op']} {regression['case']}: {regression['metric']} "
+                        f"{regression['baseline']} -> {regression['value']} ({regression['change']:+.1%})")
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        log.info(f"wrote {len(report['results'])} results to {args.output}")
+    else:
+        print(output)
+    # a non-zero exit code fails a pre-deploy check
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
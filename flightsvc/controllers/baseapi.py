@@ -0,0 +1,200 @@
+import json
+import random
+import logging
+
+import flask
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.datatransmit import resolve_destination
+from flightsvc.controllers.flight_compression import CODECS, compression_setting, negotiate, write_options
+from flightsvc.controllers.flight_http import ARROW_STREAM, ipc_chunks
+from flightsvc.controllers.flight_pool import default_pool
+from flightsvc.controllers.flight_query import query_descriptor
+from flightsvc.controllers.flight_registry import get_router
+from flightsvc.controllers.flight_resume import put_resumable
+
+log = logging.getLogger(__name__)
+
+# producer group used when a request does not name a destination
+DEFAULT_DESTINATION = 'default'
+
+
+def _error(e):
+    if isinstance(e, pyarrow.ArrowKeyError):
+        # the KeyError of a producer that does not hold the flight, without its remote traceback
+        return {'error': 'Flight not found.'}, 404
+    if isinstance(e, (flight.FlightUnavailableError, flight.FlightTimedOutError)):
+        # also raised by producers behind the requested min_version
+        return {'error': str(e)}, 503
+    return {'error': str(e)}, 502
+
+
+def _flight_name(descriptor):
+    if descriptor.descriptor_type == flight.DescriptorType.PATH:
+        return '/'.join(p.decode() if isinstance(p, bytes) else p for p in descriptor.path)
+    return descriptor.command.decode()
+
+
+def _catalog_urls(destination):
+    router = get_router()
+    if router is not None:
+        producers = router.producers(destination)
+        if producers:
+            return sorted(info['location'] for info in producers)
+    return [resolve_destination(destination)]
+
+
+def get_flights(destination=DEFAULT_DESTINATION, prefix=None, after=None, limit=None):
+    """
+    Lists the flights of the producers of a destination.
+
+    A flight held by several producers (replicas or shards) is listed once,
+    with every location holding it.
+
+    Returns:
+        list: One dict per flight in name order, with its schema, row count,
+            size in bytes, version, memory used by its batch indexes and locations.
+    """
+    criteria = json.dumps({'prefix': prefix, 'after': after, 'limit': limit}).encode()
+    flights = {}
+    try:
+        for url in _catalog_urls(destination):
+            with default_pool.connection(url) as client:
+                infos = list(client.list_flights(criteria))
+            for info in infos:
+                name = _flight_name(info.descriptor)
+                if name in flights:
+                    flights[name]['locations'].append(url)
+                    continue
+                metadata = json.loads(info.app_metadata or b'{}')
+                flights[name] = {
+                    'name': name,
+                    'schema': [{'name': field.name, 'type': str(field.type)} for field in info.schema],
+                    'num_rows': info.total_records,
+                    'data_size': info.total_bytes,
+                    'version': metadata.get('version'),
+                    'index_bytes': metadata.get('index_bytes'),
+                    'locations': [url],
+                }
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except (flight.FlightError, pyarrow.ArrowKeyError) as e:
+        return _error(e)
+    names = sorted(flights)[:limit]
+    return [flights[name] for name in names], 200
+
+
+def _endpoint_batches(endpoint, default_location):
+    # an endpoint is read from a random replica, moving on while none of its batches has been sent
+    locations = [location.uri.decode() for location in endpoint.locations] or [default_location]
+    random.shuffle(locations)
+    for i, location in enumerate(locations):
+        sent = False
+        try:
+            with default_pool.connection(location) as client:
+                for chunk in client.do_get(endpoint.ticket):
+                    sent = True
+                    yield chunk.data
+            return
+        except (flight.FlightUnavailableError, flight.FlightTimedOutError):
+            if sent or i == len(locations) - 1:
+                raise
+            log.warning(f'{location} is unavailable, reading the endpoint from another replica')
+
+
+def get_flight_stream(table_name, destination=DEFAULT_DESTINATION, columns=None, filters=None,
+                      min_version=None, compression=None):
+    """
+    Streams a flight as Arrow IPC (application/vnd.apache.arrow.stream).
+
+    The flight is read from the producers over Flight and every record batch
+    is re-encoded into a chunk of the response as soon as it arrives, so the
+    response is never materialized. The projection (`columns`) and the JSON
+    `filters` are applied by the producers, see query_descriptor.
+
+    Args:
+        table_name (str): The name of the flight.
+        destination (str): The producer group holding the flight.
+        columns (list, optional): The columns to return.
+        filters (str, optional): The row filters as a JSON object.
+        min_version (int, optional): The version the read must see.
+        compression (str, optional): The IPC buffer compression of the response, lz4 or zstd.
+    """
+    if compression and compression not in CODECS + ['none']:
+        return {'error': f"Invalid compression {compression!r}, expected one of {CODECS + ['none']}"}, 400
+    try:
+        filters = json.loads(filters) if filters else None
+    except ValueError:
+        return {'error': f'filters must be a JSON object: {filters}'}, 400
+    if isinstance(columns, str):
+        columns = [column for column in columns.split(',') if column]
+
+    try:
+        url = resolve_destination(destination, table_name)
+        descriptor = query_descriptor(table_name, columns, filters, min_version=min_version)
+        with default_pool.connection(url) as client:
+            info = client.get_flight_info(descriptor)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except (flight.FlightError, pyarrow.ArrowKeyError) as e:
+        return _error(e)
+
+    def batches():
+        for endpoint in info.endpoints:
+            yield from _endpoint_batches(endpoint, url)
+
+    codec = None if compression == 'none' else compression
+    headers = {'X-Flight-Rows': str(info.total_records)}
+    version = json.loads(info.app_metadata or b'{}').get('version')
+    if version is not None:
+        headers['X-Flight-Version'] = str(version)
+    log.info(f'streaming {table_name} from {url} over HTTP ({codec or "uncompressed"})')
+    return flask.Response(ipc_chunks(info.schema, batches(), codec), mimetype=ARROW_STREAM, headers=headers)
+
+
+def put_flight_stream(table_name, destination=DEFAULT_DESTINATION, append=False):
+    """
+    Stores the Arrow IPC stream of the request body as a flight, or appends
+    it to the stored flight if `append` is set.
+
+    The body is decoded batch by batch while it arrives and forwarded to a
+    producer of the destination in a single do_put, so a chunked upload is
+    never buffered by the API. The do_put is a resumable upload, which the
+    producer only publishes once it has been told the upload is complete: a
+    body that breaks aborts it, and the flight it would have replaced stays.
+
+    Returns:
+        dict: The table_name, rows and `version` of the stored flight.
+    """
+    try:
+        reader = pyarrow.ipc.open_stream(flask.request.stream)
+    except pyarrow.ArrowInvalid as e:
+        return {'error': f'the body is not an Arrow IPC stream: {e}'}, 400
+
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for batch in reader:
+            yield batch
+            rows += batch.num_rows
+
+    try:
+        url = resolve_destination(destination, table_name if append else None)
+        with default_pool.connection(url) as client:
+            codec = negotiate(client, url, compression_setting(destination))
+        options = flight.FlightCallOptions(write_options=write_options(codec))
+        # the body cannot be read twice, a broken do_put is not resumed
+        result = put_resumable(default_pool, url, table_name, reader.schema, batches, options, append, max_retries=0)
+    except pyarrow.ArrowInvalid as e:
+        return {'error': f'invalid Arrow IPC stream: {e}'}, 400
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except (flight.FlightError, pyarrow.ArrowKeyError) as e:
+        return _error(e)
+    except OSError as e:
+        # the body ended before its end of stream marker
+        return {'error': f'truncated Arrow IPC stream: {e}'}, 400
+    log.info(f"{'appended' if append else 'stored'} {rows} rows of {table_name} from HTTP in {url}")
+    return {'table_name': table_name, 'rows': rows, 'version': result.get('version')}, 200
@@ -1,11 +1,24 @@
 import os
 import pyarrow
 from dotenv import load_dotenv
-from sys import getsizeof
 import pyarrow.flight as flight
 import timeit
 import logging
 
+from flightsvc.controllers.flight_async import run_transmit, run_transmits
+from flightsvc.controllers.flight_compression import compression_setting, negotiate, wire_estimate, write_options
+from flightsvc.controllers.flight_compute import compute_descriptor, exchange
+from flightsvc.controllers.flight_dictionary import (DICTIONARY_ENCODE, EncodedStream, decode_dictionaries,
+                                                     dictionary_encode)
+from flightsvc.controllers.flight_http import get_stream, put_stream, rest_codec, rest_url
+from flightsvc.controllers.flight_pool import default_pool
+from flightsvc.controllers.flight_query import query_descriptor
+from flightsvc.controllers.flight_registry import call_with_failover, get_router
+from flightsvc.controllers.flight_resume import put_resumable
+from flightsvc.controllers.flight_subscribe import subscribe
+from flightsvc.controllers.parallel_flight_client import fetch_endpoints, put_parts, put_shards
+from flightsvc.controllers.synthetic_data import stock_prices
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 load_dotenv()
@@ -13,12 +26,15 @@ load_dotenv()
 
 valid_transmit_methods = ['REST', 'FLIGHT']
 
+# resolved FLIGHT_URL_<DESTINATION> values
+destination_urls = {}
+
 def duplicate_columns(table, x):
     new_cols = []
     for _ in range(x):
-        for col in table.columns:
-            new_col_name = f'{col._name}_{_}'
-            new_cols.append(pyarrow.field(new_col_name, col.type))
+        for field in table.schema:
+            new_col_name = f'{field.name}_{_}'
+            new_cols.append(pyarrow.field(new_col_name, field.type))
     all_cols = list(table.schema) + new_cols
     new_schema = pyarrow.schema(all_cols)
     new_arrays = [*table, *[table[col.name[:col.name.rfind('_')]] for col in new_cols]]
@@ -27,9 +43,9 @@ def duplicate_columns(table, x):
 
 
 def generate_rows(table, x):
-    for _ in range(x):
-        table = pyarrow.concat_tables([table] * 2)
-    return table
+    # 2**x copies combined into contiguous chunks, concatenating doubled
+    # tables left millions of tiny chunks; use synthetic_data for load tests
+    return pyarrow.concat_tables([table] * 2 ** x).combine_chunks()
 
 def transmit_data(transmit_method, payload, head):
     if transmit_method not in valid_transmit_methods:
@@ -39,51 +55,278 @@ def transmit_data(transmit_method, payload, head):
     if transmit_method == 'FLIGHT':
         return transmit_flight(payload, head)
 
+async def transmit_async(transmit_method, payload, head=None, executor=None):
+    # transmit_data for asyncio code, run on a bounded executor so the event loop keeps serving;
+    # the payload's batches may be an async iterable with a schema
+    if transmit_method not in valid_transmit_methods:
+        raise ValueError(f"Invalid transmit method: {transmit_method}")
+    report = await run_transmit(lambda payload, head: transmit_data(transmit_method, payload, head),
+                                payload, head, executor)
+    if report['error'] is not None:
+        raise report['error']
+    return report['result']
+
+async def transmit_many(transmit_method, payloads, head=None, executor=None):
+    # transmits the payloads concurrently, returns one report per payload, see flight_async.run_transmit
+    if transmit_method not in valid_transmit_methods:
+        raise ValueError(f"Invalid transmit method: {transmit_method}")
+    return await run_transmits(lambda payload, head: transmit_data(transmit_method, payload, head),
+                               payloads, head, executor)
+
 def transmit_rest(payload, head):
-    return payload
+    # streams the table or batches to the REST API of the destination (REST_URL_<DESTINATION>)
+    # as a chunked Arrow IPC body, for clients that cannot reach the producers over gRPC
+    destination = payload.get('destination', None)
+    table_name = payload.get('table_name', None)
+    table = payload.get('table', None)
+    batches = payload.get('batches', None)
+    batch_size = payload.get('batch_size', None)
+    table_metadata = payload.get('table_metadata', None) or {}
+    append = payload.get('append', False) or table_metadata.get('append', False)
+
+    url = rest_url(destination)
+    compression = payload.get('compression') or compression_setting(destination)
+    codec = rest_codec(url, compression, table)
+    if batches is None:
+        schema, batches = table.schema, table.to_batches(max_chunksize=batch_size)
+    else:
+        schema = batches.schema
+
+    sent = {'rows': 0, 'nbytes': 0, 'first': None}
+
+    def counted():
+        for batch in batches:
+            sent['rows'] += batch.num_rows
+            sent['nbytes'] += batch.nbytes
+            sent['first'] = sent['first'] or batch
+            yield batch
+
+    tic_write = timeit.default_timer()
+    result = put_stream(url, table_name, schema, counted(), codec, head, destination, append)
+    toc_write = timeit.default_timer()
+    log.info(
+        f'table of: {sent["rows"]} rows, {len(schema)} cols, '
+        f'{sent["nbytes"] / 1024 / 1024:.5f} MB transmitted over HTTP in {(toc_write - tic_write):.2f} seconds '
+        f'({sent["nbytes"] / 1024 / 1024 / (toc_write - tic_write):.2f} MB/s, {codec or "uncompressed"})')
+    return result.get('version')
+
+def fetch_rest(payload, head=None):
+    # fetch_flight over the REST API of the destination, the table arrives as an Arrow IPC stream
+    destination = payload.get('destination', None)
+    table_name = payload.get('table_name', None)
+    table_metadata = payload.get('table_metadata', None) or {}
+
+    url = rest_url(destination)
+    compression = payload.get('compression') or compression_setting(destination)
+    codec = rest_codec(url, compression)
+
+    tic_read = timeit.default_timer()
+    table = get_stream(url, table_name, table_metadata.get('select_fields'), table_metadata.get('filters'),
+                       payload.get('min_version'), codec, head, destination)
+    toc_read = timeit.default_timer()
+    log.info(
+        f'table of: {table.num_rows} rows, {table.num_columns} cols '
+        f'retrieved over HTTP in {(toc_read - tic_read):.2f} seconds ({codec or "uncompressed"})')
+    return table
+
+def resolve_destination(destination, table_name=None):
+    # producers registered in zookeeper take precedence over FLIGHT_URL_<DESTINATION>
+    router = get_router()
+    if router is not None:
+        url = router.route(destination, table_name)
+        if url:
+            return url
+
+    url = destination_urls.get(destination)
+    if url:
+        return url
+
+    url = os.environ.get(f'FLIGHT_URL_{destination.upper()}', None)
+
+    if not url:
+        raise ValueError(f"Invalid destination, please define environment variable for FLIGHT_URL_{destination.upper()}")
+    destination_urls[destination] = url
+    return url
+
+def resolve_shard_locations(destination, shards):
+    # the registered producers of the destination, or FLIGHT_SHARD_URLS_<DESTINATION>
+    router = get_router()
+    if router is not None:
+        locations = sorted(info['location'] for info in router.producers(destination))
+    else:
+        urls = os.environ.get(f'FLIGHT_SHARD_URLS_{destination.upper()}', '')
+        locations = [url.strip() for url in urls.split(',') if url.strip()]
+    if len(locations) < shards:
+        raise ValueError(f"{shards} shards requested but {destination} has {len(locations)} producers, "
+                         f"register more producers or define FLIGHT_SHARD_URLS_{destination.upper()}")
+    return locations[:shards]
 
 def transmit_flight(payload, head):
     destination = payload.get('destination', None)
     table_name = payload.get('table_name', None)
     table_metadata = payload.get('table_metadata', None)
     table = payload.get('table', None)
+    # instead of a table, a re-iterable source of record batches with a schema, e.g. a
+    # synthetic_data.SyntheticData, streamed into do_put without ever building the table
+    batches = payload.get('batches', None)
+    # number of concurrent do_put streams and maximum rows per record batch
+    parts = payload.get('parts', 1)
+    batch_size = payload.get('batch_size', None)
+    # number of producers to shard the flight across, and the column and method to shard by
+    shards = payload.get('shards', 1)
+    shard_by = payload.get('shard_by', None)
+    shard_method = payload.get('shard_method', 'hash')
+    # add the rows to the stored flight instead of replacing it, e.g. the new ticks of a time series
+    append = payload.get('append', False) or (table_metadata or {}).get('append', False)
+    # dictionary-encode the string columns with few distinct values, sent once per stream as deltas
+    encode = payload.get('dictionary_encode', DICTIONARY_ENCODE)
 
-    destination_url = os.environ.get(f'FLIGHT_URL_{destination.upper()}', None)
+    if batches is not None and (parts > 1 or shards > 1):
+        raise ValueError("parts and shards need a table, not a stream of batches")
+    if append and (parts > 1 or shards > 1):
+        raise ValueError("an append is sent as a single stream, without parts or shards")
+    compression = payload.get('compression') or compression_setting(destination)
 
-    if not destination_url:
-        raise ValueError(f"Invalid destination, please define environment variable for FLIGHT_URL_{destination.upper()}")
+    if encode and table is not None:
+        table = dictionary_encode(table, batch_size)
+    if batches is not None and encode:
+        batches = EncodedStream(batches)
+    schema = table.schema if batches is None else batches.schema
+    sent = {'rows': 0, 'nbytes': 0, 'first': None}
+
+    def stream():
+        # called again by every resumed attempt, which skips the batches the server holds
+        if batches is None:
+            yield from table.to_batches(max_chunksize=batch_size)
+            return
+        sent.update(rows=0, nbytes=0, first=None)
+        for batch in batches:
+            sent['rows'] += batch.num_rows
+            sent['nbytes'] += batch.nbytes
+            sent['first'] = sent['first'] or batch
+            yield batch
 
-    client = flight.FlightClient(destination_url)
-    descriptor = flight.FlightDescriptor.for_command(table_name)
-    table_size_mb = round(getsizeof(table) / 1024 / 1024, 5)
+    def put(destination_url):
+        # negotiate the IPC buffer compression with the server
+        with default_pool.connection(destination_url) as client:
+            codec = negotiate(client, destination_url, compression, table)
+        options = flight.FlightCallOptions(write_options=write_options(codec))
+
+        # transmit the table over pooled connections
+        if parts > 1:
+            result = put_parts(default_pool, destination_url, table_name, table, parts, batch_size, options)
+        else:
+            # a broken connection is resumed after the last batch the server holds
+            result = put_resumable(default_pool, destination_url, table_name, schema, stream, options, append)
+        return codec, result
 
-    # transmit the table
     tic_write = timeit.default_timer()
-    writer, reader = client.do_put(descriptor, table.schema)
-    writer.write_table(table)
-    writer.close()
+    if shards > 1:
+        # the shard map pins every shard to its producer, so sharded puts do not fail over
+        locations = resolve_shard_locations(destination, shards)
+        with default_pool.connection(locations[0]) as client:
+            codec = negotiate(client, locations[0], compression, table)
+        options = flight.FlightCallOptions(write_options=write_options(codec))
+        put_shards(default_pool, locations, table_name, table, shard_by, shard_method, batch_size, options)
+        result = {}
+    else:
+        # an append goes to a producer holding the flight
+        codec, result = call_with_failover(
+            lambda: resolve_destination(destination, table_name if append else None), put)
 
     toc_write = timeit.default_timer()
+    if batches is None:
+        num_rows, nbytes = table.num_rows, table.nbytes
+        wire_bytes, ratio = wire_estimate(table, codec)
+    else:
+        num_rows, nbytes = sent['rows'], sent['nbytes']
+        wire_bytes, ratio = wire_estimate(sent['first'], codec, nbytes)
     log.info(
-        f'table of: {table.num_rows} rows, {table.num_columns} cols, '
-        f'{table_size_mb} MB transmitted in {(toc_write - tic_write):.2f} seconds')
+        f'table of: {num_rows} rows, {len(schema)} cols, '
+        f'{nbytes / 1024 / 1024:.5f} MB transmitted in {(toc_write - tic_write):.2f} seconds '
+        f'over {max(parts, shards)} streams ({nbytes / 1024 / 1024 / (toc_write - tic_write):.2f} MB/s), '
+        f'~{wire_bytes / 1024 / 1024:.2f} MB on the wire ({codec or "uncompressed"}, ratio {ratio:.2f}, '
+        f'estimated from a sample)')
 
     table = None
+    # reads passing this as min_version are guaranteed to see this write
+    return result.get('version')
 
-if __name__ == '__main__':
-    table = pyarrow.Table.from_arrays(
-        [
-            pyarrow.array(["AAPL", "GOOG", "MSFT"]),
-            pyarrow.array([1672345600, 1672345600, 1672345600]),  # Timestamps
-            pyarrow.array([150.0, 110.0, 250.0])
-        ],
-        names=["symbol", "timestamp", "price"]
-    )
+def fetch_flight(payload, head=None):
+    destination = payload.get('destination', None)
+    table_name = payload.get('table_name', None)
+    table_metadata = payload.get('table_metadata', None) or {}
+
+    compression = payload.get('compression') or compression_setting(destination)
+
+    def fetch(destination_url):
+        with default_pool.connection(destination_url) as client:
+            codec = negotiate(client, destination_url, compression)
+            # projection and filters are evaluated by the server before it sends anything
+            descriptor = query_descriptor(table_name, table_metadata.get('select_fields'),
+                                          table_metadata.get('filters'), table_metadata.get('partitions'),
+                                          codec, compression == 'adaptive', payload.get('min_version'))
+            flight_info = client.get_flight_info(descriptor)
+        return fetch_endpoints(flight_info, destination_url, pool=default_pool), codec
+
+    # retrieve the table, preferring a producer that already holds it
+    tic_read = timeit.default_timer()
+    table, codec = call_with_failover(lambda: resolve_destination(destination, table_name), fetch)
 
-    table = duplicate_columns(table, 10)
+    toc_read = timeit.default_timer()
+    # the codec requested, the server may still drop an adaptive one for data that does not compress
+    wire_bytes, ratio = wire_estimate(table, codec)
+    log.info(
+        f'table of: {table.num_rows} rows, {table.num_columns} cols, {table.nbytes / 1024 / 1024:.5f} MB '
+        f'retrieved in {(toc_read - tic_read):.2f} seconds, '
+        f'~{wire_bytes / 1024 / 1024:.2f} MB on the wire ({codec or "uncompressed"}, ratio {ratio:.2f}, '
+        f'estimated from a sample)')
+    if payload.get('decode_dictionaries'):
+        # dictionary encoded columns back to plain strings
+        table = decode_dictionaries(table)
+    return table
+
+def compute_flight(payload, head=None):
+    # runs the payload's `compute` (aggregates, group_by, window, join, order_by, limit, see
+    # flight_compute.compute_descriptor) on the producer holding the flight, only the result is sent back
+    destination = payload.get('destination', None)
+    table_name = payload.get('table_name', None)
+    table_metadata = payload.get('table_metadata', None) or {}
+    compute = payload.get('compute', None) or {}
+    # the right side of a join without a table_name
+    table = payload.get('table', None)
+
+    descriptor = compute_descriptor(table_name, filters=table_metadata.get('filters'),
+                                    select_fields=table_metadata.get('select_fields'),
+                                    min_version=payload.get('min_version'), **compute)
 
-    table = generate_rows(table, 15)
+    def run(destination_url):
+        with default_pool.connection(destination_url) as client:
+            return exchange(client, descriptor, table)
 
+    tic_compute = timeit.default_timer()
+    result = call_with_failover(lambda: resolve_destination(destination, table_name), run)
+    toc_compute = timeit.default_timer()
+    log.info(
+        f'computed {result.num_rows} rows, {result.num_columns} cols on {table_name} '
+        f'in {(toc_compute - tic_compute):.2f} seconds, {result.nbytes / 1024:.2f} KB retrieved')
+    return result
+
+def subscribe_flight(payload, head=None):
+    # yields the rows of the flight from the payload's `from_row` (default 0), then every batch appended to
+    # it as soon as a producer publishes it, instead of polling and re-reading the flight; the generator
+    # ends when the flight is removed, see flight_subscribe.subscribe
+    destination = payload.get('destination', None)
+    table_name = payload.get('table_name', None)
+    table_metadata = payload.get('table_metadata', None) or {}
+
+    log.info(f'subscribing to {table_name} from row {payload.get("from_row", 0)}')
+    yield from subscribe(lambda: resolve_destination(destination, table_name), table_name,
+                         payload.get('from_row', 0), table_metadata.get('select_fields'),
+                         table_metadata.get('filters'), payload.get('heartbeat'))
+
+if __name__ == '__main__':
+    # about 900 MB of stock prices in 4 MB record batches, generated while they are sent
     payload = {
         'destination': 'overlay',
         'table_name': 'stock_prices',
@@ -91,6 +334,6 @@ if __name__ == '__main__':
             'select_fields': [],
             'filters': {},
         },
-        'table': table
+        'batches': stock_prices(rows=1 << 22, copies=10, seed=0),
     }
     res = transmit_data('FLIGHT', payload, None)
@@ -0,0 +1,275 @@
+import collections
+import os
+import threading
+import time
+import logging
+
+import pyarrow.flight as flight
+
+log = logging.getLogger(__name__)
+
+# the methods admission control applies to; a live tail is counted as 'subscribe', not as a do_get
+METHODS = ('do_put', 'do_get', 'do_exchange', 'subscribe')
+# calls waiting for a slot beyond this many are rejected at once
+MAX_QUEUE = int(os.environ.get('FLIGHT_ADMISSION_QUEUE', '64'))
+# seconds a call waits for a slot, or for its bytes to fit, before it is rejected
+QUEUE_TIMEOUT = float(os.environ.get('FLIGHT_ADMISSION_TIMEOUT', '30'))
+
+
+def _limit(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def method_limits(prefix):
+    """
+    Returns the per-method limits set as <prefix>_<METHOD>, e.g.
+    FLIGHT_MAX_STREAMS_DO_PUT=4, leaving out the methods without one.
+    """
+    limits = {method: _limit(f'{prefix}_{method.upper()}') for method in METHODS}
+    return {method: limit for method, limit in limits.items() if limit}
+
+
+def client_id(context):
+    """
+    Returns the client a call is counted against: its authenticated identity,
+    or else its address without the port, so all the connections of a host share the limits.
+    """
+    identity = context.peer_identity()
+    if identity:
+        return identity.decode()
+    return context.peer().rsplit(':', 1)[0]
+
+
+class Admission:
+    """
+    The slot of one admitted call, see AdmissionController.admit. Release it
+    once the call has completed, e.g. with release_on_completion.
+    """
+
+    def __init__(self, controller, method, client):
+        self.controller = controller
+        self.method = method
+        self.client = client
+        self.nbytes = 0
+        self.released = False
+
+    def charge(self, nbytes):
+        self.controller._charge(self, nbytes)
+
+    def release(self):
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    Caps the streams a Flight server runs at the same time, and the bytes
+    its uploads hold, so that a burst of large puts waits its turn instead
+    of running the process out of memory.
+
+    A call over a limit waits in a queue; once MAX_QUEUE calls are waiting,
+    or after QUEUE_TIMEOUT seconds, it is rejected with
+    FlightUnavailableError, which the clients retry with backoff, see
+    flight_resume. A put whose bytes do not fit stops reading until they do,
+    so the client is slowed down by flow control rather than buffered. The
+    oldest stream of a method, and of a client, can always read on, so the
+    streams holding bytes never wait on each other.
+
+    Reads are paced to `egress_rate` bytes per second across all do_get
+    streams, with one second of burst: small reads are not slowed down.
+
+    Args:
+        max_streams (dict, optional): The concurrent streams per method, see METHODS.
+            Defaults to FLIGHT_MAX_STREAMS_<METHOD>.
+        max_bytes (dict, optional): The bytes read by the running calls per method,
+            until they complete. Defaults to FLIGHT_MAX_BYTES_<METHOD>.
+        max_client_streams (int, optional): The concurrent streams of one client, except
+            subscriptions. Defaults to FLIGHT_MAX_CLIENT_STREAMS.
+        max_client_bytes (int, optional): The bytes read by the running calls of one
+            client. Defaults to FLIGHT_MAX_CLIENT_BYTES.
+        max_queue (int): The number of calls that may wait for a slot.
+        queue_timeout (float): The seconds a call waits before it is rejected.
+        egress_rate (int, optional): The do_get budget in bytes per second.
+            Defaults to FLIGHT_EGRESS_BYTES_PER_SECOND.
+    """
+
+    def __init__(self, max_streams=None, max_bytes=None, max_client_streams=None, max_client_bytes=None,
+                 max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT, egress_rate=None):
+        self.max_streams = method_limits('FLIGHT_MAX_STREAMS') if max_streams is None else max_streams
+        self.max_bytes = method_limits('FLIGHT_MAX_BYTES') if max_bytes is None else max_bytes
+        self.max_client_streams = (_limit('FLIGHT_MAX_CLIENT_STREAMS')
+                                   if max_client_streams is None else max_client_streams)
+        self.max_client_bytes = _limit('FLIGHT_MAX_CLIENT_BYTES') if max_client_bytes is None else max_client_bytes
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.egress_rate = _limit('FLIGHT_EGRESS_BYTES_PER_SECOND') if egress_rate is None else egress_rate
+        # running slots in admission order, per method and per client
+        self._running = collections.defaultdict(dict)
+        self._client_running = collections.defaultdict(dict)
+        self._bytes = collections.Counter()
+        self._client_bytes = collections.Counter()
+        self._queued = collections.Counter()
+        self._rejected = collections.Counter()
+        self._waited = collections.Counter()
+        self._tokens = float(self.egress_rate or 0)
+        self._refilled = time.monotonic()
+        self._throttled = 0.0
+        self._cond = threading.Condition()
+
+    def _reject(self, method, reason):
+        # must be called with the lock held
+        self._rejected[method] += 1
+        raise flight.FlightUnavailableError(f'server busy: {reason}, retry later')
+
+    def _wait(self, method, ready, reason):
+        # waits with the lock held until ready() is true, rejecting the call after queue_timeout
+        if ready():
+            return
+        if sum(self._queued.values()) >= self.max_queue:
+            self._reject(method, f'{self.max_queue} calls already waiting')
+        self._queued[method] += 1
+        started = time.monotonic()
+        try:
+            if not self._cond.wait_for(ready, self.queue_timeout):
+                self._reject(method, reason)
+        finally:
+            self._queued[method] -= 1
+            self._waited[method] += time.monotonic() - started
+
+    def admit(self, method, client):
+        """
+        Waits for a slot for a call of `method` from `client`.
+
+        Raises:
+            FlightUnavailableError: If the queue is full or the wait timed out.
+
+        Returns:
+            Admission: The slot to release when the call completes.
+        """
+        limit = self.max_streams.get(method)
+        client_limit = self.max_client_streams if method != 'subscribe' else None
+
+        def ready():
+            return ((limit is None or len(self._running[method]) < limit)
+                    and (client_limit is None or len(self._client_running[client]) < client_limit))
+
+        slot = Admission(self, method, client)
+        with self._cond:
+            self._wait(method, ready, f'{method} streams at their limit')
+            self._running[method][slot] = True
+            if method != 'subscribe':
+                self._client_running[client][slot] = True
+        return slot
+
+    def _charge(self, slot, nbytes):
+        limit = self.max_bytes.get(slot.method)
+        client_limit = self.max_client_bytes
+        if limit is None and client_limit is None:
+            return
+
+        def ready():
+            # the oldest stream reads on, the bytes of the others are released when it completes
+            if limit is not None and self._bytes[slot.method] + nbytes > limit \
+                    and next(iter(self._running[slot.method]), None) is not slot:
+                return False
+            if client_limit is not None and self._client_bytes[slot.client] + nbytes > client_limit \
+                    and next(iter(self._client_running[slot.client]), None) is not slot:
+                return False
+            return True
+
+        with self._cond:
+            self._wait(slot.method, ready, f'{slot.method} bytes at their limit')
+            slot.nbytes += nbytes
+            self._bytes[slot.method] += nbytes
+            self._client_bytes[slot.client] += nbytes
+
+    def _release(self, slot):
+        with self._cond:
+            if slot.released:
+                return
+            slot.released = True
+            self._running[slot.method].pop(slot, None)
+            clients = self._client_running.get(slot.client)
+            if clients is not None:
+                clients.pop(slot, None)
+                if not clients:
+                    del self._client_running[slot.client]
+            self._bytes[slot.method] -= slot.nbytes
+            self._client_bytes[slot.client] -= slot.nbytes
+            if not self._client_bytes[slot.client]:
+                del self._client_bytes[slot.client]
+            self._cond.notify_all()
+
+    def throttled(self, batches):
+        """
+        Yields `batches`, sleeping as needed to keep the reads of the server
+        within `egress_rate`. The budget is shared by every stream, a stream
+        waits for the bytes it sends.
+        """
+        for batch in batches:
+            if self.egress_rate:
+                delay = self._egress_delay(batch.nbytes)
+                if delay:
+                    time.sleep(delay)
+            yield batch
+
+    def _egress_delay(self, nbytes):
+        # a token bucket refilled at egress_rate up to one second of it; a
+        # batch takes its bytes at once and waits until they are paid for
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = min(self.egress_rate, self._tokens + (now - self._refilled) * self.egress_rate)
+            self._refilled = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self.egress_rate if self._tokens < 0 else 0
+            self._throttled += delay
+            return delay
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The running, queued and rejected calls and the bytes in flight per
+            method, the number of clients with running calls and the seconds reads were throttled.
+        """
+        with self._cond:
+            return {
+                'running': {method: len(slots) for method, slots in self._running.items() if slots},
+                'queued': {method: count for method, count in self._queued.items() if count},
+                'rejected': dict(self._rejected),
+                'wait_seconds': {method: round(seconds, 3) for method, seconds in self._waited.items()},
+                'bytes_in_flight': {method: count for method, count in self._bytes.items() if count},
+                'clients': len(self._client_running),
+                'egress_throttled_seconds': round(self._throttled, 3),
+            }
+
+
+class AdmittedReader:
+    """
+    Wraps a do_put or do_exchange reader, charging every batch read to the slot of the call.
+    """
+
+    def __init__(self, reader, slot):
+        self.reader = reader
+        self.slot = slot
+
+    @property
+    def schema(self):
+        return self.reader.schema
+
+    def read_chunk(self):
+        chunk = self.reader.read_chunk()
+        if chunk.data is not None:
+            self.slot.charge(chunk.data.get_total_buffer_size())
+        return chunk
+
+
+def release_on_completion(slot, call):
+    """
+    Releases `slot` when the call completes, after the last batch of its
+    stream has been sent. `call` is the MetricsMiddleware of the call; without
+    one the slot is released at once.
+    """
+    if call is None:
+        slot.release()
+    else:
+        call.add_done_callback(slot.release)
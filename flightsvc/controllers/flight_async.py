@@ -0,0 +1,152 @@
+import asyncio
+import concurrent.futures
+import os
+import timeit
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# maximum number of blocking transmits running at once on the shared executor
+TRANSMIT_WORKERS = int(os.environ.get('FLIGHT_TRANSMIT_WORKERS', '8'))
+# seconds the writing thread waits for the next batch of an async source before giving up
+BATCH_TIMEOUT = float(os.environ.get('FLIGHT_ASYNC_BATCH_TIMEOUT', '300'))
+
+_END = object()
+
+
+class AsyncBatches:
+    """
+    Adapts an async iterable of record batches to the blocking iterator
+    transmit_flight writes into do_put.
+
+    The worker thread writing the flight pulls one batch at a time from the
+    event loop, so the loop is never blocked by the write and a slow source
+    of batches slows down the upload instead of buffering in memory. The
+    thread gives up if the next batch takes longer than `timeout`, or once the
+    transmit is cancelled, so it is never left waiting on a stopped loop.
+
+    Args:
+        batches: The async iterable of pyarrow.RecordBatch.
+        schema (pyarrow.Schema, optional): The schema of the batches. Defaults
+            to the `schema` attribute of `batches`.
+        loop (asyncio.AbstractEventLoop, optional): The loop running the
+            iterable. Defaults to the running loop.
+        timeout (float): The seconds to wait for a batch. Defaults to FLIGHT_ASYNC_BATCH_TIMEOUT.
+    """
+
+    def __init__(self, batches, schema=None, loop=None, timeout=BATCH_TIMEOUT):
+        self.schema = schema if schema is not None else getattr(batches, 'schema', None)
+        if self.schema is None:
+            raise ValueError("an async iterable of batches needs a schema, pass it as the payload's 'schema'")
+        self._iterator = batches.__aiter__()
+        self._loop = loop or asyncio.get_running_loop()
+        self.timeout = timeout
+        self._consumed = False
+        self._cancelled = False
+        self._pending = None
+
+    async def _next(self):
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            return _END
+
+    def cancel(self):
+        """
+        Stops the iteration: the batch being waited for, and every later one, raises CancelledError.
+        """
+        self._cancelled = True
+        pending = self._pending
+        if pending is not None:
+            pending.cancel()
+
+    def __iter__(self):
+        if self._consumed:
+            # retrying after part of the stream was written would commit a truncated flight
+            raise RuntimeError("an async iterable of batches can only be transmitted once")
+        self._consumed = True
+        while True:
+            if self._cancelled:
+                raise concurrent.futures.CancelledError('the transmit was cancelled')
+            self._pending = asyncio.run_coroutine_threadsafe(self._next(), self._loop)
+            try:
+                batch = self._pending.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                self._pending.cancel()
+                raise TimeoutError(f'no batch from the async source in {self.timeout} seconds')
+            finally:
+                self._pending = None
+            if batch is _END:
+                return
+            yield batch
+
+
+async def run_transmit(transmit, payload, head=None, executor=None):
+    """
+    Runs a blocking `transmit(payload, head)` on an executor thread.
+
+    Args:
+        transmit (callable): The blocking transmit, e.g. DataTransmitter.transmit_flight.
+        payload (dict): The payload. Its `batches` may be an async iterable.
+        head (dict, optional): Additional headers for the transmission.
+        executor (concurrent.futures.Executor, optional): Defaults to default_executor.
+
+    Returns:
+        dict: The table_name and destination of the payload, the `result` of the
+            transmit (the flight version for FLIGHT), the `error` it raised or
+            None, the `queued_seconds` spent waiting for a worker and the
+            `seconds` the transmit took.
+    """
+    loop = asyncio.get_running_loop()
+    batches = None
+    if hasattr(payload.get('batches'), '__aiter__'):
+        batches = AsyncBatches(payload['batches'], payload.get('schema'), loop)
+        payload = {**payload, 'batches': batches}
+
+    started = []
+
+    def call():
+        started.append(timeit.default_timer())
+        return transmit(payload, head)
+
+    report = {'table_name': payload.get('table_name'), 'destination': payload.get('destination'),
+              'result': None, 'error': None}
+    tic = timeit.default_timer()
+    try:
+        report['result'] = await loop.run_in_executor(executor or default_executor, call)
+    except asyncio.CancelledError:
+        # the thread cannot be interrupted, but it stops at the next batch it pulls
+        if batches is not None:
+            batches.cancel()
+        raise
+    except Exception as e:
+        # logged by whoever handles the report, see run_transmits
+        report['error'] = e
+    toc = timeit.default_timer()
+    start = started[0] if started else toc
+    report['queued_seconds'] = round(start - tic, 4)
+    report['seconds'] = round(toc - start, 4)
+    return report
+
+
+async def run_transmits(transmit, payloads, head=None, executor=None):
+    """
+    Runs `transmit` for every payload concurrently, at most as many at once as
+    the executor has workers. A failed transmit does not cancel the others.
+
+    Returns:
+        list: The report of each payload in payload order, see run_transmit.
+    """
+    tic = timeit.default_timer()
+    reports = await asyncio.gather(*(run_transmit(transmit, payload, head, executor) for payload in payloads))
+    toc = timeit.default_timer()
+    for report in reports:
+        if report['error'] is not None:
+            log.error(f"transmit of {report['table_name']} to {report['destination']} failed: {report['error']}")
+    failed = sum(report['error'] is not None for report in reports)
+    log.info(f'{len(reports)} tables transmitted in {(toc - tic):.2f} seconds, {failed} failed')
+    return reports
+
+
+default_executor = ThreadPoolExecutor(max_workers=TRANSMIT_WORKERS, thread_name_prefix='flight-transmit')
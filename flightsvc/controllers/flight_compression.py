@@ -0,0 +1,155 @@
+import ipaddress
+import json
+import os
+import socket
+import logging
+from urllib.parse import urlparse
+
+import pyarrow
+import pyarrow.flight as flight
+
+log = logging.getLogger(__name__)
+
+# buffer codecs supported by the Arrow IPC format, in order of preference
+CODECS = ['lz4', 'zstd']
+COMPRESSION_SETTINGS = ['none', 'adaptive'] + CODECS
+
+# adaptive mode compresses only if a sample shrinks by at least this factor
+MIN_COMPRESSION_RATIO = 1.2
+SAMPLE_ROWS = 65536
+
+# codecs advertised by each server, by Flight URL
+server_codecs = {}
+
+
+def available_codecs():
+    return [codec for codec in CODECS if pyarrow.Codec.is_available(codec)]
+
+
+def compression_setting(destination, default='adaptive'):
+    """
+    Returns the compression setting of a destination from FLIGHT_COMPRESSION_<DESTINATION>:
+    one of none, adaptive, lz4 or zstd.
+    """
+    setting = os.environ.get(f'FLIGHT_COMPRESSION_{destination.upper()}', default).lower()
+    if setting not in COMPRESSION_SETTINGS:
+        raise ValueError(f"Invalid compression {setting!r} for {destination}, expected one of {COMPRESSION_SETTINGS}")
+    return setting
+
+
+def is_local(url):
+    """
+    Returns True if the Flight URL points at this host, where compression only costs CPU.
+    """
+    host = urlparse(url).hostname
+    if host in (None, 'localhost', socket.gethostname()):
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_unspecified
+
+
+def write_options(codec):
+    # a dictionary that grows from batch to batch is sent as deltas, not resent whole
+    if not codec:
+        return pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+    return pyarrow.ipc.IpcWriteOptions(compression=codec, emit_dictionary_deltas=True)
+
+
+def ipc_size(batches, schema, codec=None):
+    sink = pyarrow.MockOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema, options=write_options(codec)) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    return sink.size()
+
+
+def sample_ratio(data, codec, sample_rows=SAMPLE_ROWS):
+    """
+    Estimates the compression ratio of `codec` on the first `sample_rows` rows of a table or batch.
+    """
+    sample = data.slice(0, sample_rows)
+    batches = sample.to_batches() if isinstance(sample, pyarrow.Table) else [sample]
+    compressed = ipc_size(batches, data.schema, codec)
+    return ipc_size(batches, data.schema) / compressed if compressed else 1.0
+
+
+def negotiate(client, url, setting, data=None):
+    """
+    Picks the codec to use with a server.
+
+    The codecs the server supports are asked for once per URL with the
+    `codecs` action. In adaptive mode compression is skipped for local
+    servers and for data whose sample does not compress.
+
+    Args:
+        client (pyarrow.flight.FlightClient): A client connected to `url`.
+        url (str): The Flight URL of the server.
+        setting (str): none, adaptive, lz4 or zstd.
+        data (pyarrow.Table, optional): The data about to be sent, sampled in adaptive mode.
+
+    Returns:
+        str: The codec name, or None for no compression.
+    """
+    if setting == 'none' or (setting == 'adaptive' and is_local(url)):
+        return None
+
+    if url not in server_codecs:
+        try:
+            results = list(client.do_action(flight.Action('codecs', b'')))
+            server_codecs[url] = json.loads(results[0].body.to_pybytes())
+        except flight.FlightError:
+            # servers without the action accept uncompressed streams only
+            server_codecs[url] = []
+    codecs = [codec for codec in available_codecs() if codec in server_codecs[url]]
+
+    if setting == 'adaptive':
+        if not codecs:
+            return None
+        if data is not None and sample_ratio(data, codecs[0]) < MIN_COMPRESSION_RATIO:
+            return None
+        return codecs[0]
+    if setting not in codecs:
+        log.warning(f'{setting} compression is not supported by {url}, sending uncompressed')
+        return None
+    return setting
+
+
+def ticket_options(query, sample=None):
+    """
+    Returns the IpcWriteOptions a do_get should use for a ticket's query.
+
+    The client asks for a codec with `compression`; if it also set `adaptive`
+    the codec is dropped when `sample` (the first stored batch) does not compress.
+    """
+    codec = query.get('compression')
+    if codec and query.get('adaptive') and sample is not None \
+            and sample_ratio(sample, codec) < MIN_COMPRESSION_RATIO:
+        codec = None
+    return write_options(codec)
+
+
+
+def wire_estimate(sample, codec, nbytes=None):
+    """
+    Estimates the bytes a transfer took on the wire with `codec`.
+
+    The Flight writer and reader do not count the bytes they move, so this
+    is the uncompressed IPC size divided by the compression ratio of the first
+    SAMPLE_ROWS rows, see sample_ratio. Without a codec the ratio is 1.
+
+    Args:
+        sample (pyarrow.Table or pyarrow.RecordBatch): The data sent, or its first batch if `nbytes` is given.
+        codec (str): The codec of the stream, or None.
+        nbytes (int, optional): The uncompressed bytes sent. Defaults to the IPC size of `sample`.
+
+    Returns:
+        tuple: (estimated wire bytes, estimated compression ratio)
+    """
+    if nbytes is None:
+        batches = sample.to_batches() if isinstance(sample, pyarrow.Table) else [sample]
+        nbytes = ipc_size([], sample.schema) + sum(pyarrow.ipc.get_record_batch_size(batch) for batch in batches)
+    ratio = sample_ratio(sample, codec) if codec and sample is not None and sample.num_rows else 1.0
+    return int(nbytes / ratio), ratio
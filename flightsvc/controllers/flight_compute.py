@@ -0,0 +1,281 @@
+import json
+import os
+import timeit
+import logging
+
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_dictionary import decode_dictionaries
+from flightsvc.controllers.flight_index import batch_filter
+from flightsvc.controllers.flight_query import parse_descriptor, project_schema, query_batches
+from flightsvc.controllers.flight_replication import check_version
+from flightsvc.controllers.flight_store import key_name
+
+log = logging.getLogger(__name__)
+
+# batches received over Flight are not 64-byte aligned, let Acero copy them instead of warning on every plan
+os.environ.setdefault('ACERO_ALIGNMENT_HANDLING', 'reallocate')
+
+# hash aggregate functions of pyarrow, plus vwap (sum(column * weight) / sum(weight))
+AGGREGATE_FUNCTIONS = ['count', 'count_all', 'count_distinct', 'sum', 'mean', 'min', 'max', 'first', 'last',
+                       'stddev', 'variance', 'approximate_median', 'vwap']
+JOIN_TYPES = ['inner', 'left outer', 'right outer', 'full outer', 'left semi', 'right semi', 'left anti',
+              'right anti']
+
+
+def compute_descriptor(table_name, aggregates=None, group_by=None, window=None, join=None, filters=None,
+                       select_fields=None, order_by=None, limit=None, min_version=None):
+    """
+    Builds the do_exchange descriptor of a computation on a stored flight.
+
+    The producer holding the flight filters it, optionally joins it with
+    another flight, groups and aggregates it, and streams back only the
+    result. For example the VWAP and price range by symbol per minute:
+
+        compute_descriptor('trades', group_by=['symbol'], window={'column': 'timestamp', 'size': 60},
+                           aggregates=[{'function': 'vwap', 'column': 'price', 'weight': 'volume'},
+                                       {'function': 'min', 'column': 'price'},
+                                       {'function': 'max', 'column': 'price'}])
+
+    Args:
+        table_name (str): The flight to compute on.
+        aggregates (list, optional): One dict per result column with the `function` (see
+            AGGREGATE_FUNCTIONS), the input `column` (not needed by count_all), the `weight`
+            column of vwap (default: volume) and an optional result `name` (default:
+            <column>_<function>). Without aggregates the (joined) rows are returned.
+        group_by (list, optional): The key columns. Defaults to one group over all rows.
+        window (dict, optional): Groups rows into fixed windows of a `column`, in addition
+            to `group_by`. The `size` is in seconds for timestamp columns and in column units
+            otherwise. The window start replaces the column in the result.
+        join (dict, optional): Joins the filtered rows with another flight before aggregating:
+            its `table_name` (omit it to join the table sent with the exchange), the `keys`,
+            optional `right_keys`, the join `type` (see JOIN_TYPES, default inner) and the
+            `select_fields` and `filters` applied to the right side.
+        filters (dict, optional): The row filters of the flight, see query_descriptor.
+        select_fields (list, optional): The columns to return when there are no aggregates.
+        order_by (list, optional): Column names, or [name, 'ascending' | 'descending'] pairs.
+        limit (int, optional): The maximum number of result rows.
+        min_version (int, optional): The version of the flight the computation must see.
+
+    Returns:
+        pyarrow.flight.FlightDescriptor: The descriptor to pass to do_exchange.
+    """
+    for aggregate in aggregates or []:
+        if aggregate.get('function') not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"Invalid aggregate function {aggregate.get('function')!r}, "
+                             f"expected one of {AGGREGATE_FUNCTIONS}")
+    if join and join.get('type', 'inner') not in JOIN_TYPES:
+        raise ValueError(f"Invalid join type {join['type']!r}, expected one of {JOIN_TYPES}")
+    compute = {'aggregates': aggregates, 'group_by': group_by, 'window': window, 'join': join,
+               'order_by': order_by, 'limit': limit}
+    query = {'table_name': table_name, 'compute': {k: v for k, v in compute.items() if v is not None}}
+    if filters:
+        query['filters'] = filters
+    if select_fields:
+        query['select_fields'] = list(select_fields)
+    if min_version:
+        query['min_version'] = int(min_version)
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def exchange(client, descriptor, table=None, options=None):
+    """
+    Runs a computation with do_exchange and returns its result.
+
+    Args:
+        client (pyarrow.flight.FlightClient): A client of the producer holding the flight.
+        descriptor (pyarrow.flight.FlightDescriptor): See compute_descriptor.
+        table (pyarrow.Table, optional): The right side of a join without a `table_name`.
+        options (pyarrow.flight.FlightCallOptions, optional): The call options.
+
+    Returns:
+        pyarrow.Table: The result.
+    """
+    writer, reader = client.do_exchange(descriptor, options=options)
+    if table is not None:
+        writer.begin(table.schema)
+        writer.write_table(table)
+    writer.done_writing()
+    result = reader.read_all()
+    writer.close()
+    return result
+
+
+def stored_table(flights, key, query):
+    """
+    Returns the rows of a stored flight selected by the projection and filters of `query`.
+
+    Raises:
+        KeyError: If the flight is not stored.
+        ValueError: If the flight is sharded, a producer only holds some of its rows.
+    """
+    entry = flights.get(key)
+    if entry is None:
+        raise KeyError(f'Flight {key_name(key)} not found.')
+    if entry.shards:
+        raise ValueError(f'{key_name(key)} is sharded across {len(entry.shards)} producers, '
+                         f'compute on the shards separately')
+    check_version(key, entry, min_version=query.get('min_version'))
+    schema = project_schema(entry.schema, query.get('select_fields'))
+    batches = entry.iter_batches(keep=batch_filter(entry.schema, query.get('filters')))
+    return pyarrow.Table.from_batches(query_batches(batches, query), schema=schema)
+
+
+def read_table(reader):
+    """
+    Reads the table a client sent with do_exchange, or None if it sent nothing.
+    """
+    batches = []
+    while True:
+        try:
+            chunk = reader.read_chunk()
+        except StopIteration:
+            break
+        if chunk.data is not None:
+            batches.append(chunk.data)
+    if not batches:
+        return None
+    return pyarrow.Table.from_batches(batches, schema=reader.schema)
+
+
+def input_columns(query, schema):
+    """
+    Returns the columns of the flight the computation reads, or None for all of them.
+    """
+    compute = query['compute']
+    aggregates = compute.get('aggregates')
+    if not aggregates:
+        if compute.get('join') or not query.get('select_fields'):
+            # a join selects its result columns once it is joined
+            return None
+        columns = list(query['select_fields'])
+        columns += [item if isinstance(item, str) else item[0] for item in compute.get('order_by') or []]
+        return [name for name in dict.fromkeys(columns) if name in schema.names]
+    columns = list(compute.get('group_by') or [])
+    if compute.get('window'):
+        columns.append(compute['window']['column'])
+    if compute.get('join'):
+        columns += compute['join']['keys']
+    for aggregate in aggregates:
+        if aggregate.get('column'):
+            columns.append(aggregate['column'])
+        if aggregate['function'] == 'vwap':
+            columns.append(aggregate.get('weight', 'volume'))
+    # the others come from the right side of the join
+    return [name for name in dict.fromkeys(columns) if name in schema.names]
+
+
+def _window(table, window):
+    column = table.column(window['column'])
+    size = window['size']
+    if pyarrow.types.is_timestamp(column.type):
+        start = pc.floor_temporal(column, multiple=int(size), unit='second')
+    else:
+        start = pc.multiply(pc.floor(pc.divide(pc.cast(column, pyarrow.float64()), size)), size)
+        start = start.cast(column.type, safe=False)
+    return table.set_column(table.schema.get_field_index(window['column']), window['column'], start)
+
+
+def _join(table, join, flights, right):
+    if join.get('table_name'):
+        right_key = parse_descriptor(flight.FlightDescriptor.for_command(join['table_name']))[0]
+        right = stored_table(flights, right_key, {'filters': join.get('filters'),
+                                                  'select_fields': join.get('select_fields')})
+    elif right is None:
+        raise ValueError('the join has no table_name and no table was sent with the exchange')
+    return decode_dictionaries(table).join(decode_dictionaries(right), join['keys'],
+                                            right_keys=join.get('right_keys'),
+                                            join_type=join.get('type', 'inner'))
+
+
+def aggregate_name(aggregate):
+    column, function = aggregate.get('column'), aggregate['function']
+    return aggregate.get('name') or (f'{column}_{function}' if column else function)
+
+
+def _aggregate(table, aggregates, keys):
+    # the output name of every spec, in order
+    specs, outputs = [], []
+    for aggregate in aggregates:
+        function, column, name = aggregate['function'], aggregate.get('column'), aggregate_name(aggregate)
+        if function == 'vwap':
+            # sum(column * weight) and sum(weight), divided once the groups are reduced; the weight
+            # is copied so that its sum does not clash with another aggregate of the same column
+            weight = aggregate.get('weight', 'volume')
+            table = table.append_column(f'__{name}_weighted',
+                                        pc.multiply(table.column(column), table.column(weight)))
+            table = table.append_column(f'__{name}_weight', table.column(weight))
+            specs += [(f'__{name}_weighted', 'sum'), (f'__{name}_weight', 'sum')]
+            outputs += [f'__{name}_weighted', f'__{name}_weight']
+        elif function == 'count_all' or (function == 'count' and not column):
+            specs.append(([], 'count_all'))
+            outputs.append(name)
+        else:
+            specs.append((column, function))
+            outputs.append(name)
+    # aggregate kernels do not take dictionary inputs, unlike group keys
+    table = decode_dictionaries(table, {column for column, _ in specs if column and column not in keys})
+    result = table.group_by(keys, use_threads=True).aggregate(specs)
+    # pyarrow names the aggregates <column>_<function>, which two aggregates can share,
+    # so they are renamed by position: one column per spec after the keys
+    result = result.rename_columns(list(keys) + outputs)
+    for aggregate in aggregates:
+        if aggregate['function'] == 'vwap':
+            name = aggregate_name(aggregate)
+            result = result.append_column(name, pc.divide(pc.cast(result.column(f'__{name}_weighted'),
+                                                                  pyarrow.float64()),
+                                                          result.column(f'__{name}_weight')))
+    return result.select(list(keys) + [aggregate_name(aggregate) for aggregate in aggregates])
+
+
+def run_compute(flights, key, query, reader=None):
+    """
+    Runs the computation of a compute_descriptor query on a flight store.
+
+    The flight is filtered and projected to the columns the computation
+    reads, then joined, grouped into windows and aggregated with Arrow's
+    vectorized kernels.
+
+    Args:
+        flights (FlightStore): The store holding the flight.
+        key (tuple): The flight key.
+        query (dict): The query of the descriptor, with the computation under `compute`.
+        reader (optional): The do_exchange reader, read if the join needs the client's table.
+
+    Returns:
+        pyarrow.Table: The result.
+    """
+    tic = timeit.default_timer()
+    compute = query['compute']
+    entry = flights.get(key)
+    columns = input_columns(query, entry.schema) if entry is not None else None
+    # one contiguous, aligned chunk per column for the Arrow kernels
+    table = stored_table(flights, key, {**query, 'select_fields': columns}).combine_chunks()
+    rows_in = table.num_rows
+
+    join = compute.get('join')
+    if join:
+        right = read_table(reader) if reader is not None and not join.get('table_name') else None
+        table = _join(table, join, flights, right)
+    if compute.get('window'):
+        table = _window(table, compute['window'])
+    if compute.get('aggregates'):
+        keys = list(compute.get('group_by') or [])
+        if compute.get('window') and compute['window']['column'] not in keys:
+            keys.append(compute['window']['column'])
+        table = _aggregate(table, compute['aggregates'], keys)
+    if compute.get('order_by'):
+        # sorting does not take dictionary columns, the result is small
+        table = decode_dictionaries(table).sort_by([(item, 'ascending') if isinstance(item, str) else tuple(item)
+                                                     for item in compute['order_by']])
+    if compute.get('limit') is not None:
+        table = table.slice(0, compute['limit'])
+    if not compute.get('aggregates') and query.get('select_fields'):
+        table = table.select(query['select_fields'])
+
+    toc = timeit.default_timer()
+    log.info(f'computed {table.num_rows} rows from {rows_in} rows of {key_name(key)} '
+             f'in {(toc - tic):.3f} seconds')
+    return table
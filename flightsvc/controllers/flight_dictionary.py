@@ -0,0 +1,255 @@
+import collections
+import itertools
+import os
+import logging
+
+import pyarrow
+import pyarrow.compute as pc
+
+log = logging.getLogger(__name__)
+
+# set FLIGHT_DICTIONARY_ENCODE=1 to dictionary-encode low-cardinality string columns
+# by default, on the client before an upload and on the server at ingest
+DICTIONARY_ENCODE = os.environ.get('FLIGHT_DICTIONARY_ENCODE', '0') == '1'
+# a string column is encoded when its first rows have at most this share of
+# distinct values, and at most MAX_DISTINCT of them
+MAX_DISTINCT_RATIO = 0.5
+MAX_DISTINCT = 1 << 16
+SAMPLE_ROWS = 1 << 18
+# a batch's dictionary may hold as many values as the batch has rows, or this many
+MIN_DICTIONARY = 1024
+INDEX_TYPE = pyarrow.int32()
+
+# what read_chunk returns, like pyarrow.flight.FlightStreamChunk
+Chunk = collections.namedtuple('Chunk', ['data', 'app_metadata'])
+
+
+def _is_text(data_type):
+    return pyarrow.types.is_string(data_type) or pyarrow.types.is_large_string(data_type)
+
+
+def low_cardinality_columns(batch, max_ratio=MAX_DISTINCT_RATIO, max_distinct=MAX_DISTINCT):
+    """
+    Returns the names of the string columns of a record batch or table with
+    few enough distinct values to be worth dictionary-encoding.
+    """
+    names = []
+    for field in batch.schema:
+        if not _is_text(field.type) or not batch.num_rows:
+            continue
+        distinct = pc.count_distinct(batch.column(field.name)).as_py()
+        if distinct <= max_distinct and distinct <= max_ratio * batch.num_rows:
+            names.append(field.name)
+    return names
+
+
+def decode_dictionaries(table, names=None):
+    """
+    Casts the dictionary columns of a table or batch, or those in `names`, back to their value type.
+    """
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_dictionary(field.type) and (names is None or field.name in names):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    return table
+
+
+class DictionaryEncoder:
+    """
+    Dictionary-encodes string columns of successive record batches.
+
+    Every column has one dictionary that only grows: the values a batch adds
+    go after those of the previous batches, and a batch without new values
+    shares the previous dictionary. An IPC writer with emit_dictionary_deltas
+    (see flight_compression.write_options) then sends each value once, as a
+    delta, and an IPC file can hold the batches.
+
+    Every batch holds its own copy of a grown dictionary, so the dictionary
+    starts over from the values of the batch when it would outgrow the batch
+    (more values than rows, at least MIN_DICTIONARY, at most MAX_DISTINCT),
+    or when the batch adds more than MAX_DISTINCT_RATIO of its rows as new
+    values, i.e. the column no longer has a low cardinality. A restarted
+    dictionary is sent whole, as a replacement, and the stored batches stay
+    about the size of plain strings whatever the values do.
+
+    Args:
+        schema (pyarrow.Schema): The schema of the plain batches.
+        columns (list): The names of the string columns to encode.
+        dictionaries (dict, optional): The dictionary to continue per column,
+            e.g. those of the last batch of a flight being appended to.
+        decode (list, optional): The names of dictionary columns to decode instead.
+    """
+
+    def __init__(self, schema, columns, dictionaries=None, decode=None):
+        self.columns = [name for name in columns if _is_text(schema.field(name).type)]
+        self.decode = [name for name in decode or [] if pyarrow.types.is_dictionary(schema.field(name).type)]
+        fields = []
+        for field in schema:
+            if field.name in self.columns:
+                field = pyarrow.field(field.name, pyarrow.dictionary(INDEX_TYPE, field.type),
+                                      field.nullable, field.metadata)
+            elif field.name in self.decode:
+                field = pyarrow.field(field.name, field.type.value_type, field.nullable, field.metadata)
+            fields.append(field)
+        self.schema = pyarrow.schema(fields, metadata=schema.metadata)
+        self.dictionaries = {name: (dictionaries or {}).get(name, pyarrow.array([], schema.field(name).type))
+                             for name in self.columns}
+
+    def _encode_column(self, name, column):
+        dictionary = self.dictionaries[name]
+        positions = pc.index_in(column, value_set=dictionary)
+        if positions.null_count > column.null_count:
+            # values not in the dictionary yet, added in order of first appearance
+            added = pc.unique(column.filter(pc.and_(pc.is_null(positions), pc.is_valid(column))))
+            limit = min(MAX_DISTINCT, max(len(column), MIN_DICTIONARY))
+            if len(dictionary) + len(added) > limit or len(added) > MAX_DISTINCT_RATIO * len(column):
+                dictionary = pc.unique(column).drop_null()
+            else:
+                dictionary = pyarrow.concat_arrays([dictionary, added])
+            self.dictionaries[name] = dictionary
+            positions = pc.index_in(column, value_set=dictionary)
+        return pyarrow.DictionaryArray.from_arrays(positions.cast(INDEX_TYPE), dictionary)
+
+    def encode(self, batch):
+        """
+        Returns:
+            pyarrow.RecordBatch: `batch` with the encoded columns, in the encoder's schema.
+        """
+        if not self.columns and not self.decode:
+            return batch
+        arrays = []
+        for field, column in zip(batch.schema, batch.columns):
+            if field.name in self.dictionaries:
+                column = self._encode_column(field.name, column)
+            elif field.name in self.decode:
+                column = column.cast(field.type.value_type)
+            arrays.append(column)
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def encode_table(self, table, max_chunksize=None):
+        return pyarrow.Table.from_batches([self.encode(batch) for batch in table.to_batches(max_chunksize)],
+                                          schema=self.schema)
+
+
+def dictionary_encode(table, max_chunksize=None):
+    """
+    Dictionary-encodes the low-cardinality string columns of a table, with
+    dictionaries chained from batch to batch, see DictionaryEncoder.
+
+    Returns:
+        pyarrow.Table: The encoded table, or `table` if no column is worth encoding.
+    """
+    columns = low_cardinality_columns(table.slice(0, SAMPLE_ROWS))
+    if not columns:
+        return table
+    log.info(f'dictionary encoding {", ".join(columns)}')
+    return DictionaryEncoder(table.schema, columns).encode_table(table, max_chunksize)
+
+
+class EncodedStream:
+    """
+    Dictionary-encodes a re-iterable source of record batches, with the
+    columns picked from its first batch.
+
+    Every iteration encodes the source again from its start with a new
+    encoder, so it yields the same batches every time, e.g. for an upload
+    that is resumed.
+
+    Args:
+        batches: The source, with a `schema`, see synthetic_data.SyntheticData.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+        self._pending = iter(batches)
+        first = next(self._pending, None)
+        self.columns = low_cardinality_columns(first) if first is not None else []
+        self.schema = DictionaryEncoder(batches.schema, self.columns).schema
+        if first is not None:
+            self._pending = itertools.chain([first], self._pending)
+
+    def __iter__(self):
+        # the first iteration continues from the batch the columns were picked from
+        batches, self._pending = self._pending or iter(self.batches), None
+        return map(DictionaryEncoder(self.batches.schema, self.columns).encode, batches)
+
+
+class DictionaryEncodingReader:
+    """
+    Wraps a do_put reader, dictionary-encoding the string columns found to
+    have a low cardinality in the first batch.
+
+    The first batch is read when the reader is created, so that its schema
+    is known before anything is stored.
+
+    Args:
+        reader: The do_put reader.
+        columns (list, optional): The columns to encode. Defaults to those found in the first batch.
+        dictionaries (dict, optional): The dictionaries to continue, see DictionaryEncoder.
+        decode (list, optional): The dictionary columns to decode instead.
+    """
+
+    def __init__(self, reader, columns=None, dictionaries=None, decode=None):
+        self.reader = reader
+        try:
+            self._pending = [reader.read_chunk()]
+        except StopIteration:
+            self._pending = [None]
+        if columns is None:
+            first = self._pending[0]
+            columns = low_cardinality_columns(first.data) if first is not None and first.data is not None else []
+        self.encoder = DictionaryEncoder(reader.schema, columns, dictionaries, decode)
+
+    @property
+    def schema(self):
+        return self.encoder.schema
+
+    def read_chunk(self):
+        chunk = self._pending.pop() if self._pending else self.reader.read_chunk()
+        if chunk is None:
+            raise StopIteration
+        if chunk.data is None:
+            return chunk
+        return Chunk(self.encoder.encode(chunk.data), chunk.app_metadata)
+
+
+def conform_reader(reader, schema, last=None):
+    """
+    Wraps a do_put reader so that its string columns are dictionary encoded,
+    or decoded, like the same columns of `schema`, e.g. the schema of the
+    flight an upload is appended to. The encoded columns continue the
+    dictionaries of `last`, the flight's last batch.
+
+    Returns:
+        The reader, wrapped only if a column needs converting.
+    """
+    encode, decode = [], []
+    for field in reader.schema:
+        if field.name not in schema.names:
+            continue
+        target = schema.field(field.name).type
+        if pyarrow.types.is_dictionary(target) and target.value_type.equals(field.type):
+            encode.append(field.name)
+        elif pyarrow.types.is_dictionary(field.type) and field.type.value_type.equals(target):
+            decode.append(field.name)
+    if not encode and not decode:
+        return reader
+    dictionaries = {name: last.column(name).dictionary for name in encode} if last is not None else None
+    return DictionaryEncodingReader(reader, encode, dictionaries, decode)
+
+
+def file_batches(schema, batches):
+    """
+    Returns the batches in a form an IPC file can hold: unchanged if the
+    dictionaries of every column only grow from batch to batch, otherwise
+    with the dictionaries unified across the batches.
+    """
+    columns = [i for i, field in enumerate(schema) if pyarrow.types.is_dictionary(field.type)]
+    for i in columns:
+        previous = None
+        for batch in batches:
+            dictionary = batch.column(i).dictionary
+            if previous is not None and not (
+                    len(dictionary) >= len(previous) and dictionary.slice(0, len(previous)).equals(previous)):
+                return pyarrow.Table.from_batches(batches, schema=schema).unify_dictionaries().to_batches()
+            previous = dictionary
+    return batches
@@ -0,0 +1,139 @@
+import io
+import json
+import os
+import logging
+from urllib.parse import quote, urlencode
+from urllib.request import Request, urlopen
+
+import pyarrow
+
+from flightsvc.controllers.flight_compression import (MIN_COMPRESSION_RATIO, available_codecs, is_local,
+                                                      sample_ratio, write_options)
+
+log = logging.getLogger(__name__)
+
+# media type of the Arrow IPC stream format
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+# seconds to wait for the HTTP server to accept a request or send the next chunk
+HTTP_TIMEOUT = 300
+
+
+def ipc_chunks(schema, batches, codec=None):
+    """
+    Encodes record batches as an Arrow IPC stream, one chunk of bytes at a time.
+
+    The first chunk holds the schema and every following chunk one batch
+    (with its dictionaries), so a chunked HTTP body never holds more than one
+    encoded batch.
+
+    Args:
+        schema (pyarrow.Schema): The schema of the batches.
+        batches: An iterable of pyarrow.RecordBatch.
+        codec (str, optional): The IPC buffer compression, lz4 or zstd.
+
+    Yields:
+        bytes: The encoded stream.
+    """
+    buffer = io.BytesIO()
+
+    def drain():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    with pyarrow.ipc.new_stream(pyarrow.PythonFile(buffer, mode='w'), schema,
+                                options=write_options(codec)) as writer:
+        yield drain()
+        for batch in batches:
+            writer.write_batch(batch)
+            yield drain()
+    # the end of stream marker
+    yield drain()
+
+
+def rest_url(destination):
+    """
+    Returns the base URL of the Flight service REST API of a destination from
+    REST_URL_<DESTINATION>, e.g. http://flightsvc:8080/api/v1.
+    """
+    url = os.environ.get(f'REST_URL_{destination.upper()}', None)
+    if not url:
+        raise ValueError(f"Invalid destination, please define environment variable for REST_URL_{destination.upper()}")
+    return url.rstrip('/')
+
+
+def rest_codec(url, setting, data=None):
+    """
+    Picks the codec of a REST upload, like negotiate but without asking the
+    server: every Arrow reader decodes both codecs.
+
+    Args:
+        url (str): The REST URL of the server.
+        setting (str): none, adaptive, lz4 or zstd.
+        data (pyarrow.Table or pyarrow.RecordBatch, optional): A sample of the data, used in adaptive mode.
+
+    Returns:
+        str: The codec name, or None for no compression.
+    """
+    if setting == 'none' or (setting == 'adaptive' and is_local(url)):
+        return None
+    codecs = available_codecs()
+    if setting == 'adaptive':
+        if not codecs or (data is not None and sample_ratio(data, codecs[0]) < MIN_COMPRESSION_RATIO):
+            return None
+        return codecs[0]
+    if setting not in codecs:
+        log.warning(f'{setting} compression is not available, sending uncompressed')
+        return None
+    return setting
+
+
+def flight_url(base_url, table_name, **params):
+    query = urlencode({k: v for k, v in params.items() if v is not None})
+    return f"{base_url}/flights/{quote(table_name, safe='')}" + (f'?{query}' if query else '')
+
+
+def put_stream(base_url, table_name, schema, batches, codec=None, headers=None, destination=None, append=False):
+    """
+    Uploads record batches to the REST API as a chunked Arrow IPC stream.
+
+    Args:
+        base_url (str): The base URL of the REST API.
+        table_name (str): The name of the flight.
+        schema (pyarrow.Schema): The schema of the batches.
+        batches: An iterable of pyarrow.RecordBatch.
+        codec (str, optional): The IPC buffer compression.
+        headers (dict, optional): Additional HTTP headers, e.g. Authorization.
+        destination (str, optional): The producer group the API stores the flight in.
+        append (bool): If True, the batches are appended to the stored flight.
+
+    Returns:
+        dict: The put result, with the `version` of the stored flight.
+    """
+    request = Request(flight_url(base_url, table_name, destination=destination, append='true' if append else None),
+                      data=ipc_chunks(schema, batches, codec), method='PUT',
+                      headers={**(headers or {}), 'Content-Type': ARROW_STREAM})
+    with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        return json.loads(response.read() or b'{}')
+
+
+def get_stream(base_url, table_name, select_fields=None, filters=None, min_version=None, codec=None,
+               headers=None, destination=None):
+    """
+    Downloads a flight from the REST API as an Arrow IPC stream.
+
+    The projection and filters are applied by the server, see query_descriptor.
+
+    Returns:
+        pyarrow.Table: The flight.
+    """
+    url = flight_url(base_url, table_name, destination=destination,
+                     columns=','.join(select_fields) if select_fields else None,
+                     filters=json.dumps(filters) if filters else None,
+                     min_version=min_version, compression=codec)
+    request = Request(url, headers={**(headers or {}), 'Accept': ARROW_STREAM})
+    with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        # the batches are decoded while the body arrives
+        return pyarrow.ipc.open_stream(response).read_all()
@@ -0,0 +1,282 @@
+import functools
+import math
+import operator
+import os
+import sys
+import logging
+
+import numpy
+import pyarrow
+import pyarrow.compute as pc
+
+log = logging.getLogger(__name__)
+
+# set FLIGHT_BATCH_INDEXES=0 to store batches without indexing them
+BATCH_INDEXES = os.environ.get('FLIGHT_BATCH_INDEXES', '1') != '0'
+# string columns keep the set of their distinct values per batch up to this many values,
+# and a bloom filter of them up to BLOOM_MAX_DISTINCT values
+MAX_DISTINCT = 256
+BLOOM_MAX_DISTINCT = 16384
+# about 2% false positives
+BLOOM_BITS_PER_VALUE = 10
+BLOOM_HASHES = 3
+# rows of a larger string column counted first, to skip the columns with too many distinct values to index
+SAMPLE_ROWS = 4096
+# the distinct values expected in SAMPLE_ROWS rows drawn from BLOOM_MAX_DISTINCT values
+SAMPLE_MAX_DISTINCT = BLOOM_MAX_DISTINCT * (1 - math.exp(-SAMPLE_ROWS / BLOOM_MAX_DISTINCT))
+
+# the polynomial string hash of hash_strings, see below
+_PRIME = numpy.uint64(0x100000001b3)
+_PRIME_INVERSE = numpy.uint64(pow(0x100000001b3, -1, 1 << 64))
+
+_COMPARISONS = {'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge}
+
+
+def hash_strings(values):
+    """
+    Hashes every string of a string array without nulls to 64 bits, with
+    numpy operations over its data buffer rather than a Python call per value.
+
+    The hash of the bytes b[s:e] of a string is sum(b[j] * P ** (e - 1 - j)),
+    modulo 2 ** 64. It is derived from the running sum S[k] of b[j] * P ** -j
+    as (S[e] - S[s]) * P ** (e - 1), so all strings are hashed at once. The
+    length and a final mix spread the bits.
+
+    Returns:
+        numpy.ndarray: The uint64 hash of every value.
+    """
+    offsets_buffer, data_buffer = values.buffers()[1:3]
+    offset_type = numpy.int64 if pyarrow.types.is_large_string(values.type) else numpy.int32
+    offsets = numpy.frombuffer(offsets_buffer, offset_type)[values.offset:values.offset + len(values) + 1]
+    offsets = offsets.astype(numpy.int64)
+    start, end = offsets[0], offsets[-1]
+    data = (numpy.frombuffer(data_buffer, numpy.uint8, end - start, start) if end > start
+            else numpy.zeros(0, numpy.uint8))
+    offsets = offsets - start
+    with numpy.errstate(over='ignore'):
+        # P ** j and P ** -j for every byte position, and the running sums over the bytes
+        powers = numpy.empty(len(data) + 1, numpy.uint64)
+        powers[0], powers[1:] = 1, _PRIME
+        powers = numpy.cumprod(powers)
+        inverses = numpy.empty(len(data) + 1, numpy.uint64)
+        inverses[0], inverses[1:] = 1, _PRIME_INVERSE
+        inverses = numpy.cumprod(inverses)
+        sums = numpy.zeros(len(data) + 1, numpy.uint64)
+        numpy.cumsum(data * inverses[:-1], out=sums[1:])
+        lengths = numpy.diff(offsets)
+        h = (sums[offsets[1:]] - sums[offsets[:-1]]) * powers[numpy.maximum(offsets[1:] - 1, 0)]
+        h ^= lengths.astype(numpy.uint64) * numpy.uint64(0x9e3779b97f4a7c15)
+        # splitmix64 finalizer
+        h ^= h >> numpy.uint64(30)
+        h *= numpy.uint64(0xbf58476d1ce4e5b9)
+        h ^= h >> numpy.uint64(27)
+        h *= numpy.uint64(0x94d049bb133111eb)
+        h ^= h >> numpy.uint64(31)
+    return h
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_value(value):
+    # the filter values are hashed once, not once per batch
+    return int(hash_strings(pyarrow.array([value], pyarrow.string()))[0])
+
+
+class BloomFilter:
+    """
+    A bloom filter of the distinct values of a column in one batch.
+
+    Args:
+        values (pyarrow.Array): The distinct values, a string array without nulls.
+    """
+
+    def __init__(self, values, bits_per_value=BLOOM_BITS_PER_VALUE, hashes=BLOOM_HASHES):
+        self.size = max(64, len(values) * bits_per_value)
+        self.hashes = hashes
+        bits = numpy.zeros(self.size, numpy.bool_)
+        if len(values):
+            bits[self._positions(hash_strings(values))] = True
+        self.bits = numpy.packbits(bits, bitorder='little').tobytes()
+
+    def _positions(self, h):
+        # double hashing: the positions are h1 + i * h2 for the two halves of the hash
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        if isinstance(h, int):
+            return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+        return numpy.concatenate([(h1 + numpy.uint64(i) * h2) % numpy.uint64(self.size) for i in range(self.hashes)])
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(_hash_value(value)))
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.bits)
+
+
+def _is_ranged(data_type):
+    return (pyarrow.types.is_integer(data_type) or pyarrow.types.is_floating(data_type)
+            or pyarrow.types.is_temporal(data_type) or pyarrow.types.is_decimal(data_type)
+            or pyarrow.types.is_boolean(data_type))
+
+
+def _is_text(data_type):
+    return pyarrow.types.is_string(data_type) or pyarrow.types.is_large_string(data_type)
+
+
+def index_batch(batch):
+    """
+    Builds the index of a record batch, one entry per indexed column:
+
+        ('range', min, max, has_nan) for numeric, temporal and boolean columns,
+        ('values', frozenset) for string columns with few distinct values,
+        ('bloom', BloomFilter) for string columns with more distinct values.
+
+    Dictionary columns are indexed by the values their indices use, without
+    decoding the rows. Nulls are left out, no filter matches them. The
+    distinct values of the first SAMPLE_ROWS rows of a larger string column
+    are counted first: a column with more of them than a sample of
+    BLOOM_MAX_DISTINCT values would have is skipped without building the set
+    of all its values.
+
+    Returns:
+        tuple: (index dict, estimated memory in bytes)
+    """
+    index = {}
+    nbytes = sys.getsizeof(index)
+    for field, column in zip(batch.schema, batch.columns):
+        data_type = field.type
+        if pyarrow.types.is_dictionary(data_type):
+            if not _is_text(data_type.value_type):
+                continue
+            values = column.dictionary.take(pc.unique(column.indices).drop_null())
+        elif _is_text(data_type):
+            values = None
+        elif _is_ranged(data_type):
+            bounds = pc.min_max(column).as_py()
+            has_nan = pyarrow.types.is_floating(data_type) and pc.any(pc.is_nan(column)).as_py()
+            index[field.name] = ('range', bounds['min'], bounds['max'], bool(has_nan))
+            nbytes += sys.getsizeof(bounds['min']) + sys.getsizeof(bounds['max']) + 96
+            continue
+        else:
+            continue
+
+        if values is None:
+            if len(column) > SAMPLE_ROWS and pc.count_distinct(column.slice(0, SAMPLE_ROWS)).as_py() > SAMPLE_MAX_DISTINCT:
+                continue
+            values = pc.unique(column).drop_null()
+        if len(values) > BLOOM_MAX_DISTINCT:
+            continue
+        if len(values) <= MAX_DISTINCT:
+            values = values.to_pylist()
+            present = frozenset(values)
+            index[field.name] = ('values', present)
+            nbytes += sys.getsizeof(present) + sum(sys.getsizeof(value) for value in values) + 64
+        else:
+            bloom = BloomFilter(values)
+            index[field.name] = ('bloom', bloom)
+            nbytes += bloom.nbytes + 112
+    return index, nbytes
+
+
+def _may_match(stats, op, value):
+    kind = stats[0]
+    values = value if op == 'in' else [value]
+    if kind == 'range':
+        _, low, high, has_nan = stats
+        if low is None:
+            return False
+        if op in ('eq', 'in'):
+            # NaN only equals NaN in a value set
+            return any(low <= v <= high or (v != v and has_nan) for v in values)
+        if op == 'ne':
+            return has_nan or not low == high == value
+        return _COMPARISONS[op](high if op in ('gt', 'ge') else low, value)
+    if kind == 'values':
+        present = stats[1]
+        if op in ('eq', 'in'):
+            return any(v in present for v in values)
+        if op == 'ne':
+            return any(v != value for v in present)
+        return any(_COMPARISONS[op](v, value) for v in present)
+    if op in ('eq', 'in'):
+        return any(v in stats[1] for v in values)
+    return True
+
+
+def batch_filter(schema, filters):
+    """
+    Builds the test telling from the index of a batch whether the batch may
+    hold rows matching `filters`, see flight_query.query_descriptor.
+
+    The filter values are converted to the column types once, so the test of
+    a batch is a few comparisons per filtered column. It errs on the side of
+    keeping a batch: a bloom filter false positive or a condition it cannot
+    evaluate only costs the filtering of that batch.
+
+    Returns:
+        callable: index -> bool, or None if the filters use no indexable column.
+    """
+    checks = []
+    for name, condition in (filters or {}).items():
+        if name not in schema.names:
+            continue
+        data_type = schema.field(name).type
+        if pyarrow.types.is_dictionary(data_type):
+            data_type = data_type.value_type
+        if not (_is_ranged(data_type) or _is_text(data_type)):
+            continue
+
+        def convert(value, data_type=data_type):
+            return pyarrow.scalar(value).cast(data_type).as_py()
+
+        if isinstance(condition, dict):
+            terms = list(condition.items())
+        elif isinstance(condition, (list, tuple)):
+            terms = [('in', condition)]
+        else:
+            terms = [('eq', condition)]
+        try:
+            terms = [(op, [convert(v) for v in value] if op == 'in' else convert(value)) for op, value in terms
+                     if op in ('eq', 'ne', 'in') or op in _COMPARISONS]
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, TypeError):
+            # the filter itself reports the invalid value
+            continue
+        # a null in a value set matches the null rows, which the index leaves out
+        terms = [(op, value) for op, value in terms if value is not None and not (op == 'in' and None in value)]
+        if terms:
+            checks.append((name, terms))
+    if not checks:
+        return None
+
+    def may_match(index):
+        if index is None:
+            return True
+        for name, terms in checks:
+            stats = index.get(name)
+            if stats is None:
+                continue
+            for op, value in terms:
+                try:
+                    if not _may_match(stats, op, value):
+                        return False
+                except TypeError:
+                    # e.g. a null filter value
+                    pass
+        return True
+
+    return may_match
+
+
+def overlapping(ranges, spans):
+    """
+    Returns the [start, stop] row ranges that overlap any of the sorted,
+    disjoint (start, stop) `spans`, all of them if `spans` is None.
+    """
+    if spans is None:
+        return list(ranges)
+    kept, i = [], 0
+    for start, stop in ranges:
+        while i < len(spans) and spans[i][1] <= start:
+            i += 1
+        if i < len(spans) and spans[i][0] < stop:
+            kept.append([start, stop])
+    return kept
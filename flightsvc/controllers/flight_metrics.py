@@ -0,0 +1,280 @@
+import threading
+import time
+import weakref
+import logging
+
+import pyarrow
+import pyarrow.flight as flight
+
+log = logging.getLogger(__name__)
+
+# key of the metrics middleware, see ServerCallContext.get_middleware
+MIDDLEWARE_KEY = 'metrics'
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# FlightServer instances of this process, exported by the /metrics endpoint
+local_servers = weakref.WeakSet()
+
+
+def batch_bytes(batch):
+    # size of the batch as an uncompressed IPC message: the bytes on the wire without
+    # buffer compression, an upper bound of them with it, see flight_compression
+    return pyarrow.ipc.get_record_batch_size(batch)
+
+
+class FlightMetrics:
+    """
+    Thread safe per-method RPC metrics of a Flight server: call and error
+    counts, rows and bytes in and out, a latency histogram and the number of
+    calls in flight. The bytes are those of the uncompressed IPC messages, see batch_bytes.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._methods = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _method(self, method):
+        if method not in self._methods:
+            self._methods[method] = {
+                'calls': 0, 'errors': 0, 'rows_in': 0, 'bytes_in': 0, 'rows_out': 0, 'bytes_out': 0,
+                'latency': {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0},
+            }
+        return self._methods[method]
+
+    def call_started(self, method):
+        with self._lock:
+            self._in_flight[method] = self._in_flight.get(method, 0) + 1
+
+    def call_completed(self, method, seconds, error, rows_in=0, bytes_in=0, rows_out=0, bytes_out=0):
+        with self._lock:
+            self._in_flight[method] -= 1
+            stats = self._method(method)
+            stats['calls'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['rows_in'] += rows_in
+            stats['bytes_in'] += bytes_in
+            stats['rows_out'] += rows_out
+            stats['bytes_out'] += bytes_out
+            latency = stats['latency']
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            latency['buckets'][bucket] += 1
+            latency['sum'] += seconds
+            latency['count'] += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: A copy of the metrics, see prometheus_text for the format.
+        """
+        with self._lock:
+            methods = {method: {**stats, 'latency': {**stats['latency'], 'buckets': list(stats['latency']['buckets'])}}
+                       for method, stats in self._methods.items()}
+            return {
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'latency_buckets': LATENCY_BUCKETS,
+                'methods': methods,
+                'in_flight': dict(self._in_flight),
+            }
+
+
+class MetricsMiddleware(flight.ServerMiddleware):
+    """
+    Measures one call. Handlers add the rows and bytes they read or write
+    with `received` and `sent`; they are counted when the call completes,
+    after the last batch of a stream has been sent. Handlers can also add
+    callbacks to run then, see add_done_callback.
+    """
+
+    def __init__(self, metrics, method):
+        self.metrics = metrics
+        self.method = method
+        self.rows_in = self.bytes_in = self.rows_out = self.bytes_out = 0
+        self._started = time.perf_counter()
+        self._callbacks = []
+        metrics.call_started(method)
+
+    def add_done_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def received(self, batch):
+        self.rows_in += batch.num_rows
+        self.bytes_in += batch_bytes(batch)
+
+    def sent(self, batch):
+        self.rows_out += batch.num_rows
+        self.bytes_out += batch_bytes(batch)
+
+    def call_completed(self, exception):
+        self.metrics.call_completed(self.method, time.perf_counter() - self._started, exception is not None,
+                                    self.rows_in, self.bytes_in, self.rows_out, self.bytes_out)
+        for callback in self._callbacks:
+            try:
+                callback()
+            except Exception:
+                log.exception(f'callback of a completed {self.method} call failed')
+
+
+class MetricsMiddlewareFactory(flight.ServerMiddlewareFactory):
+    """
+    Installs a MetricsMiddleware on every call, pass it to FlightServerBase
+    as middleware={MIDDLEWARE_KEY: factory}.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def start_call(self, info, headers):
+        return MetricsMiddleware(self.metrics, info.method.name.lower())
+
+
+def call_metrics(context):
+    """
+    Returns the MetricsMiddleware of a call, or None if metrics are not installed.
+    """
+    try:
+        return context.get_middleware(MIDDLEWARE_KEY)
+    except Exception:
+        return None
+
+
+def counted_batches(batches, call):
+    """
+    Yields `batches`, counting each one as sent by `call` (a MetricsMiddleware or None).
+    """
+    for batch in batches:
+        if call is not None:
+            call.sent(batch)
+        yield batch
+
+
+class CountedReader:
+    """
+    Wraps a do_put reader, counting every batch read as received by `call`.
+    """
+
+    def __init__(self, reader, call):
+        self.reader = reader
+        self.call = call
+
+    @property
+    def schema(self):
+        return self.reader.schema
+
+    def read_chunk(self):
+        chunk = self.reader.read_chunk()
+        if chunk.data is not None:
+            self.call.received(chunk.data)
+        return chunk
+
+
+def counted_reader(reader, call):
+    return reader if call is None else CountedReader(reader, call)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+# the metric of every admission control counter, see flight_admission.AdmissionController.snapshot
+ADMISSION_METRICS = {
+    'running': 'flight_admission_running',
+    'queued': 'flight_admission_queued',
+    'rejected': 'flight_admission_rejected_total',
+    'wait_seconds': 'flight_admission_wait_seconds_total',
+    'bytes_in_flight': 'flight_admission_bytes_in_flight',
+    'clients': 'flight_admission_clients',
+    'egress_throttled_seconds': 'flight_admission_egress_throttled_seconds_total',
+}
+
+
+def prometheus_text(stats, labels=None):
+    """
+    Renders the `stats` action result of a server in the Prometheus text format.
+
+    Args:
+        stats (dict): The metrics snapshot, with the store usage under `store` and
+            the admission control counters under `admission`.
+        labels (dict, optional): Labels added to every sample, e.g. the server location.
+
+    Returns:
+        list: The sample lines, without HELP and TYPE comments.
+    """
+    labels = labels or {}
+    lines = []
+    for method, values in sorted(stats['methods'].items()):
+        method_labels = {**labels, 'method': method}
+        lines.append(f'flight_calls_total{_labels(method_labels)} {values["calls"]}')
+        lines.append(f'flight_errors_total{_labels(method_labels)} {values["errors"]}')
+        for direction in ('in', 'out'):
+            lines.append(f'flight_rows_total{_labels({**method_labels, "direction": direction})} '
+                         f'{values["rows_" + direction]}')
+            lines.append(f'flight_bytes_total{_labels({**method_labels, "direction": direction})} '
+                         f'{values["bytes_" + direction]}')
+        latency = values['latency']
+        cumulative = 0
+        for bound, count in zip(stats['latency_buckets'] + ['+Inf'], latency['buckets']):
+            cumulative += count
+            lines.append(f'flight_call_seconds_bucket{_labels({**method_labels, "le": bound})} {cumulative}')
+        lines.append(f'flight_call_seconds_sum{_labels(method_labels)} {latency["sum"]}')
+        lines.append(f'flight_call_seconds_count{_labels(method_labels)} {latency["count"]}')
+    for method, count in sorted(stats['in_flight'].items()):
+        lines.append(f'flight_calls_in_flight{_labels({**labels, "method": method})} {count}')
+    admission = stats.get('admission', {})
+    for name, metric in ADMISSION_METRICS.items():
+        value = admission.get(name)
+        if isinstance(value, dict):
+            for method, count in sorted(value.items()):
+                lines.append(f'{metric}{_labels({**labels, "method": method})} {count}')
+        elif value is not None:
+            lines.append(f'{metric}{_labels(labels)} {value}')
+    for name, value in sorted(stats.get('store', {}).items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f'flight_store_{name}{_labels(labels)} {value}')
+    lines.append(f'flight_uptime_seconds{_labels(labels)} {stats["uptime_seconds"]}')
+    return lines
+
+
+METRIC_TYPES = {
+    'flight_calls_total': ('counter', 'Completed Flight calls.'),
+    'flight_errors_total': ('counter', 'Flight calls that raised an error.'),
+    'flight_rows_total': ('counter', 'Rows received (in) or sent (out).'),
+    'flight_bytes_total': ('counter', 'Arrow IPC bytes of the record batches received (in) or sent (out), '
+                                      'uncompressed: before any IPC buffer compression.'),
+    'flight_call_seconds': ('histogram', 'Flight call latency, including streaming.'),
+    'flight_calls_in_flight': ('gauge', 'Flight calls currently running.'),
+    'flight_admission_running': ('gauge', 'Admitted calls currently running.'),
+    'flight_admission_queued': ('gauge', 'Calls waiting for admission.'),
+    'flight_admission_rejected_total': ('counter', 'Calls rejected by admission control as the server was busy.'),
+    'flight_admission_wait_seconds_total': ('counter', 'Seconds calls waited for admission.'),
+    'flight_admission_bytes_in_flight': ('gauge', 'Bytes read by the running calls.'),
+    'flight_admission_clients': ('gauge', 'Clients with running calls.'),
+    'flight_admission_egress_throttled_seconds_total': ('counter', 'Seconds reads waited for the egress budget.'),
+    'flight_uptime_seconds': ('gauge', 'Seconds since the server started.'),
+    'flight_up': ('gauge', 'Whether the stats of the server could be collected.'),
+}
+
+
+def prometheus_document(lines):
+    """
+    Groups sample lines by metric and adds the HELP and TYPE comments.
+    """
+    families = {}
+    for line in lines:
+        name = line.split('{', 1)[0].split(' ', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRIC_TYPES:
+                name = name[:-len(suffix)]
+        families.setdefault(name, []).append(line)
+    output = []
+    for name, samples in families.items():
+        kind, description = METRIC_TYPES.get(name, ('gauge', 'Flight store usage.'))
+        output.append(f'# HELP {name} {description}')
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(samples)
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,144 @@
+import atexit
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import pyarrow.flight as flight
+
+log = logging.getLogger(__name__)
+
+# errors after which the channel of a client is not trusted: others, e.g. a flight not found, leave it usable
+TRANSPORT_ERRORS = (flight.FlightUnavailableError, flight.FlightTimedOutError, flight.FlightCancelledError, OSError)
+
+
+def normalize_url(url):
+    # grpc:// is an alias of grpc+tcp://, both must map to the same pool slot
+    if url.startswith('grpc://'):
+        return 'grpc+tcp://' + url[len('grpc://'):]
+    return url
+
+
+class FlightClientPool:
+    """
+    Thread safe pool of long-lived FlightClient connections keyed by destination URL.
+
+    Args:
+        max_per_destination (int): The maximum number of open clients per destination.
+            Callers wait for a free client once the cap is reached.
+        idle_check_seconds (float): Clients idle for longer than this are health
+            checked before they are handed out again.
+        health_check_timeout (float): The timeout of the health check call in seconds.
+    """
+
+    def __init__(self, max_per_destination=4, idle_check_seconds=30, health_check_timeout=1.0):
+        self.max_per_destination = max_per_destination
+        self.idle_check_seconds = idle_check_seconds
+        self.health_check_timeout = health_check_timeout
+        self._idle = {}
+        self._open = {}
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @contextmanager
+    def connection(self, url, timeout=None):
+        """
+        Borrows a client for `url`. A client whose connection failed, see
+        TRANSPORT_ERRORS, is discarded instead of being returned to the pool.
+        """
+        client = self.acquire(url, timeout)
+        try:
+            yield client
+        except TRANSPORT_ERRORS:
+            self.discard(url, client)
+            raise
+        except BaseException:
+            self.release(url, client)
+            raise
+        self.release(url, client)
+
+    def acquire(self, url, timeout=None):
+        """
+        Returns an idle client for `url`, or a new one if the cap allows it.
+
+        Raises:
+            RuntimeError: If the pool has been closed.
+            TimeoutError: If no client became available within `timeout` seconds.
+        """
+        url = normalize_url(url)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("FlightClientPool is closed")
+                    idle = self._idle.get(url)
+                    if idle:
+                        # most recently used first, so warm channels are reused
+                        client, last_used = idle.pop()
+                        break
+                    if self._open.get(url, 0) < self.max_per_destination:
+                        self._open[url] = self._open.get(url, 0) + 1
+                        client, last_used = None, None
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"no Flight connection to {url} available")
+                    self._cond.wait(remaining)
+
+            if client is None:
+                try:
+                    return flight.FlightClient(url)
+                except Exception:
+                    self._forget(url)
+                    raise
+            if time.monotonic() - last_used < self.idle_check_seconds or self._healthy(client):
+                return client
+            log.info(f'dropping stale Flight connection to {url}')
+            self.discard(url, client)
+
+    def release(self, url, client):
+        url = normalize_url(url)
+        with self._cond:
+            if self._closed:
+                client.close()
+                return
+            self._idle.setdefault(url, []).append((client, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, url, client):
+        try:
+            client.close()
+        except Exception:
+            pass
+        self._forget(url)
+
+    def _forget(self, url):
+        url = normalize_url(url)
+        with self._cond:
+            self._open[url] -= 1
+            self._cond.notify()
+
+    def _healthy(self, client):
+        try:
+            options = flight.FlightCallOptions(timeout=self.health_check_timeout)
+            list(client.list_actions(options=options))
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        """
+        Closes all idle clients. Clients still borrowed are closed when released.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+            self._cond.notify_all()
+        for clients in idle.values():
+            for client, _ in clients:
+                client.close()
+
+
+default_pool = FlightClientPool()
+atexit.register(default_pool.close)
@@ -0,0 +1,320 @@
+import json
+import struct
+import logging
+
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.flight as flight
+
+log = logging.getLogger(__name__)
+
+# binary ticket layout, see encode_ticket: format, descriptor type, flags, version, number of key parts
+TICKET_FORMAT = 1
+_TICKET_HEADER = struct.Struct('>BBBqH')
+_PART_LENGTH = struct.Struct('>I')
+_ROW_RANGE = struct.Struct('>qq')
+_HAS_VERSION, _HAS_ROW_RANGE, _HAS_OPTIONS, _IS_PATH = 1, 2, 4, 8
+
+# comparison operators accepted in range filters
+FILTER_OPERATORS = {
+    'eq': pc.equal,
+    'ne': pc.not_equal,
+    'lt': pc.less,
+    'le': pc.less_equal,
+    'gt': pc.greater,
+    'ge': pc.greater_equal,
+}
+
+
+def query_descriptor(table_name, select_fields=None, filters=None, partitions=None,
+                     compression=None, adaptive=False, min_version=None):
+    """
+    Builds a descriptor for `table_name` that carries a projection and filters.
+
+    The filters are a dict keyed by column name, where the value is either a
+    scalar (equality), a list (IN list) or a dict of operators to values, e.g.
+
+        {'symbol': ['AAPL', 'MSFT'], 'timestamp': {'ge': 1672345600, 'lt': 1672349200}}
+
+    Args:
+        table_name (str): The name of the stored flight.
+        select_fields (list, optional): The columns to return. Defaults to all columns.
+        filters (dict, optional): The row filters. Defaults to no filtering.
+        partitions (int, optional): The number of row range endpoints to split the
+            flight into. Defaults to the server's partitioning.
+        compression (str, optional): The codec the server should compress the stream with.
+        adaptive (bool): If True, the server skips compression when the data does not compress.
+        min_version (int, optional): The version returned by the put the read must see.
+            Servers holding an older version refuse the request.
+
+    Returns:
+        pyarrow.flight.FlightDescriptor: The descriptor to pass to get_flight_info.
+    """
+    query = {'table_name': table_name}
+    if select_fields:
+        query['select_fields'] = list(select_fields)
+    if filters:
+        query['filters'] = filters
+    if partitions:
+        query['partitions'] = int(partitions)
+    if compression:
+        query['compression'] = compression
+        query['adaptive'] = bool(adaptive)
+    if min_version:
+        query['min_version'] = int(min_version)
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def append_descriptor(table_name):
+    """
+    Builds the do_put descriptor of an append to `table_name`.
+
+    The server adds the uploaded batches to the stored flight instead of
+    replacing it, after checking that the schemas match.
+    """
+    return flight.FlightDescriptor.for_command(json.dumps({'table_name': table_name, 'append': True}))
+
+
+def subscribe_descriptor(table_name, from_row=0, select_fields=None, filters=None, heartbeat=None):
+    """
+    Builds the descriptor of a live tail subscription to `table_name`.
+
+    The ticket of its single endpoint streams the stored rows from `from_row`
+    and then keeps the stream open, sending every batch appended to the
+    flight. While nothing is appended, empty batches are sent every
+    `heartbeat` seconds.
+
+    Args:
+        table_name (str): The name of the stored flight.
+        from_row (int): The first row to send, e.g. the number of rows already received.
+        select_fields (list, optional): The columns to return. Defaults to all columns.
+        filters (dict, optional): The row filters, see query_descriptor.
+        heartbeat (float, optional): The heartbeat interval. Defaults to the server's.
+
+    Returns:
+        pyarrow.flight.FlightDescriptor: The descriptor to pass to get_flight_info.
+    """
+    query = {'table_name': table_name, 'subscribe': True, 'from_row': int(from_row)}
+    if select_fields:
+        query['select_fields'] = list(select_fields)
+    if filters:
+        query['filters'] = filters
+    if heartbeat:
+        query['heartbeat'] = float(heartbeat)
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def part_descriptor(table_name, upload_id, part, parts):
+    """
+    Builds the do_put descriptor of one part of a multi-stream upload.
+
+    The server stages the parts and publishes `table_name` once all `parts`
+    parts sharing `upload_id` have arrived.
+    """
+    return flight.FlightDescriptor.for_command(json.dumps(
+        {'table_name': table_name, 'upload_id': upload_id, 'part': part, 'parts': parts}))
+
+
+def shard_descriptor(table_name, shard, shards, upload_id=None):
+    """
+    Builds the do_put descriptor of one shard of a sharded flight.
+
+    Every shard carries the full shard map, a list of {'location', 'num_rows'}
+    dicts, so any producer holding a shard can describe the whole flight.
+    With an `upload_id` the shard is sent as a resumable upload, which the
+    producer only publishes once told the upload is complete, see
+    flight_resume.resumable_descriptor.
+    """
+    query = {'table_name': table_name, 'shard': shard, 'shards': shards}
+    if upload_id is not None:
+        query.update(upload_id=upload_id, resumable=True)
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def replica_descriptor(table_name, version, primary, base_version=None):
+    """
+    Builds the do_put descriptor a primary producer uses to copy a version
+    of `table_name` to a replica. With a `base_version` only the batches
+    appended to that version are sent, and the replica appends them.
+    """
+    query = {'table_name': table_name, 'version': version, 'primary': primary}
+    if base_version is not None:
+        query.update(append=True, base_version=base_version)
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def parse_descriptor(descriptor):
+    """
+    Splits a descriptor into the key of the stored flight and its query.
+
+    Returns:
+        tuple: (key, query) where query is a dict, empty for plain descriptors.
+    """
+    command = descriptor.command
+    query = {}
+    if command is not None and command.lstrip().startswith(b'{'):
+        query = json.loads(command)
+        command = query.pop('table_name').encode()
+    key = (descriptor.descriptor_type.value, command,
+           tuple(descriptor.path or tuple()))
+    return key, query
+
+
+def encode_ticket(key, query=None):
+    """
+    Encodes a flight key and the query of one endpoint as a compact binary ticket.
+
+    The header holds the descriptor type, the pinned `version` and the
+    `row_range` as fixed size fields, followed by the length prefixed key
+    parts. Any other query options (projection, filters, compression) follow
+    as JSON, so a plain ticket is a few bytes plus the flight name.
+
+    Returns:
+        bytes: The ticket, see decode_ticket.
+    """
+    query = dict(query or {})
+    version = query.pop('version', None)
+    row_range = query.pop('row_range', None)
+    descriptor_type, command, path = key
+    flags = ((_HAS_VERSION if version is not None else 0) | (_HAS_ROW_RANGE if row_range else 0)
+             | (_HAS_OPTIONS if query else 0) | (_IS_PATH if command is None else 0))
+    parts = list(path) if command is None else [command]
+    chunks = [_TICKET_HEADER.pack(TICKET_FORMAT, descriptor_type, flags, version or 0, len(parts))]
+    for part in parts:
+        part = part if isinstance(part, bytes) else part.encode()
+        chunks += [_PART_LENGTH.pack(len(part)), part]
+    if row_range:
+        chunks.append(_ROW_RANGE.pack(*row_range))
+    if query:
+        chunks.append(json.dumps(query, separators=(',', ':')).encode())
+    return b''.join(chunks)
+
+
+def decode_ticket(ticket):
+    """
+    Decodes a ticket made by encode_ticket without evaluating it, in time
+    proportional to its length.
+
+    Raises:
+        ValueError: If the ticket is not in the ticket format of this version.
+
+    Returns:
+        tuple: (key, query) encoded in the ticket, the query with the pinned `version`.
+    """
+    data = ticket.ticket
+    try:
+        fmt, descriptor_type, flags, version, count = _TICKET_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError('invalid ticket')
+    if fmt != TICKET_FORMAT:
+        raise ValueError(f'unsupported ticket format {fmt}')
+    offset = _TICKET_HEADER.size
+    parts = []
+    try:
+        for _ in range(count):
+            length, = _PART_LENGTH.unpack_from(data, offset)
+            offset += _PART_LENGTH.size
+            if offset + length > len(data):
+                raise ValueError('truncated ticket')
+            parts.append(data[offset:offset + length])
+            offset += length
+        key = (descriptor_type, None, tuple(parts)) if flags & _IS_PATH else (descriptor_type, parts[0], ())
+        query = {}
+        if flags & _HAS_VERSION:
+            query['version'] = version
+        if flags & _HAS_ROW_RANGE:
+            query['row_range'] = list(_ROW_RANGE.unpack_from(data, offset))
+            offset += _ROW_RANGE.size
+        if flags & _HAS_OPTIONS:
+            query.update(json.loads(data[offset:]))
+    except (struct.error, IndexError):
+        raise ValueError('truncated ticket')
+    return key, query
+
+
+def row_ranges(num_rows, partitions):
+    """
+    Splits `num_rows` rows into `partitions` contiguous row ranges.
+
+    Returns:
+        list: [start, stop] pairs, never more than one range per row.
+    """
+    partitions = max(1, min(partitions, num_rows))
+    step, remainder = divmod(num_rows, partitions)
+    ranges = []
+    start = 0
+    for i in range(partitions):
+        stop = start + step + (1 if i < remainder else 0)
+        ranges.append([start, stop])
+        start = stop
+    return ranges
+
+
+def project_schema(schema, select_fields):
+    if not select_fields:
+        return schema
+    return pyarrow.schema([schema.field(name) for name in select_fields])
+
+
+def _as_scalar(value, column):
+    return pyarrow.scalar(value).cast(column.type)
+
+
+def _value_set(values, column):
+    # dictionary columns are matched against their values
+    value_type = column.type.value_type if pyarrow.types.is_dictionary(column.type) else column.type
+    return pyarrow.array(values, type=value_type)
+
+
+def filter_mask(batch, filters):
+    """
+    Evaluates `filters` against a record batch.
+
+    Returns:
+        pyarrow.BooleanArray: The selection mask, or None if there are no filters.
+    """
+    mask = None
+    for name, condition in (filters or {}).items():
+        column = batch.column(name)
+        if isinstance(condition, dict):
+            terms = []
+            for op, value in condition.items():
+                if op == 'in':
+                    terms.append(pc.is_in(column, value_set=_value_set(value, column)))
+                elif op in FILTER_OPERATORS:
+                    terms.append(FILTER_OPERATORS[op](column, _as_scalar(value, column)))
+                else:
+                    raise ValueError(f"Invalid filter operator: {op}")
+        elif isinstance(condition, (list, tuple)):
+            terms = [pc.is_in(column, value_set=_value_set(condition, column))]
+        else:
+            terms = [pc.equal(column, _as_scalar(condition, column))]
+        for term in terms:
+            mask = term if mask is None else pc.and_(mask, term)
+    return mask
+
+
+def apply_query(batch, query):
+    """
+    Applies the projection and filters of `query` to a record batch.
+
+    The mask is computed on the filter columns only and the projection is
+    taken before filtering, so columns that are not selected are never copied.
+    """
+    mask = filter_mask(batch, query.get('filters'))
+    select_fields = query.get('select_fields')
+    if select_fields:
+        batch = batch.select(select_fields)
+    if mask is not None:
+        batch = batch.filter(mask)
+    return batch
+
+
+def query_batches(batches, query):
+    """
+    Yields the non empty results of apply_query over `batches`.
+    """
+    for batch in batches:
+        batch = apply_query(batch, query)
+        if batch.num_rows:
+            yield batch
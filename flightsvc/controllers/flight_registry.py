@@ -0,0 +1,242 @@
+import json
+import os
+import random
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import pyarrow.flight as flight
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
+from kazoo.retry import KazooRetry
+
+from flightsvc.controllers.flight_replication import is_version_unavailable
+from flightsvc.controllers.flight_resume import backoff, retry_settings
+
+log = logging.getLogger(__name__)
+
+PRODUCERS_PATH = '/flight/producers'
+
+# seconds a producer that refused a connection is skipped by the router
+FAILED_PRODUCER_BACKOFF = 10
+# seconds before discovery is retried after ZooKeeper could not be reached
+DISCOVERY_RETRY_INTERVAL = 30
+# seconds before a failed registration update is retried, doubled after every failure up to the maximum
+REGISTRATION_BACKOFF = 1
+MAX_REGISTRATION_BACKOFF = 60
+
+
+class ProducerRegistration:
+    """
+    Registers a producer as an ephemeral ZooKeeper node and keeps its data current.
+
+    The node disappears with the producer's ZooKeeper session, so clients
+    stop routing to a producer that died. A producer whose session expired
+    registers again; while ZooKeeper cannot be reached the update is retried
+    with backoff.
+
+    Args:
+        zk (KazooClient): A started ZooKeeper client.
+        info (callable): Returns the dict to publish: location, group, load and keys.
+        interval (float): Seconds between updates of the published data.
+        path (str): The parent node of the producer nodes.
+    """
+
+    def __init__(self, zk, info, interval=5, path=PRODUCERS_PATH):
+        self.zk = zk
+        self.info = info
+        self.interval = interval
+        self.path = path
+        self.node = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._register()
+        threading.Thread(target=self._update_loop, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.node:
+            try:
+                self.zk.delete(self.node)
+            except NoNodeError:
+                pass
+
+    def _data(self):
+        return json.dumps(self.info()).encode()
+
+    def _register(self):
+        self.node = self.zk.create(f'{self.path}/producer-', self._data(),
+                                   ephemeral=True, sequence=True, makepath=True)
+        log.info(f'registered producer as {self.node}')
+
+    def _update(self):
+        try:
+            self.zk.set(self.node, self._data())
+        except NoNodeError:
+            # the session expired and took the ephemeral node with it
+            self._register()
+
+    def _update_loop(self):
+        delay, retries = self.interval, 0
+        while not self._stopped.wait(delay):
+            try:
+                self._update()
+                delay, retries = self.interval, 0
+            except Exception as e:
+                # e.g. registering again while ZooKeeper is unreachable, the loop must outlive it
+                delay = min(REGISTRATION_BACKOFF * 2 ** retries, MAX_REGISTRATION_BACKOFF)
+                retries += 1
+                log.warning(f'could not update producer registration {self.node}: {e}, '
+                            f'retrying in {delay} seconds')
+
+
+class FlightRouter:
+    """
+    Keeps a local routing cache of the producers registered in ZooKeeper.
+
+    The cache is maintained by watches, so routing a transmit never talks to
+    ZooKeeper. Producers are picked by the load they published plus the
+    transmits this process currently has in flight to them.
+
+    Args:
+        zk (KazooClient): A started ZooKeeper client.
+        path (str): The parent node of the producer nodes.
+    """
+
+    def __init__(self, zk, path=PRODUCERS_PATH):
+        self.zk = zk
+        self.path = path
+        self._producers = {}
+        self._watched = set()
+        self._in_flight = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+        zk.ensure_path(path)
+        zk.ChildrenWatch(path, self._on_children)
+
+    def _on_children(self, children):
+        for child in children:
+            if child not in self._watched:
+                self._watched.add(child)
+                self.zk.DataWatch(f'{self.path}/{child}', self._data_watcher(child))
+
+    def _data_watcher(self, child):
+        def on_data(data, stat):
+            with self._lock:
+                if data is None:
+                    # the producer's node is gone, stop watching it
+                    self._producers.pop(child, None)
+                    self._watched.discard(child)
+                    return False
+                try:
+                    self._producers[child] = json.loads(data)
+                except ValueError:
+                    log.warning(f'ignoring invalid producer registration {child}')
+        return on_data
+
+    def producers(self, group=None):
+        with self._lock:
+            return [info for info in self._producers.values()
+                    if group is None or info.get('group') == group]
+
+    def route(self, group, table_name=None):
+        """
+        Returns the location of the least loaded live producer of `group`, or None.
+
+        If `table_name` is given, producers that store it are preferred.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [info for info in self._producers.values()
+                          if info.get('group') == group and self._failed.get(info['location'], 0) < now]
+            if table_name is not None:
+                holders = [info for info in candidates if table_name in info.get('keys', [])]
+                candidates = holders or candidates
+            if not candidates:
+                return None
+            scores = [info.get('load', 0) + self._in_flight.get(info['location'], 0) for info in candidates]
+            best = min(scores)
+            return random.choice([info for info, score in zip(candidates, scores) if score == best])['location']
+
+    @contextmanager
+    def using(self, location):
+        """
+        Counts a transmit to `location` as in flight while the block runs.
+        """
+        with self._lock:
+            self._in_flight[location] = self._in_flight.get(location, 0) + 1
+        try:
+            yield location
+        finally:
+            with self._lock:
+                self._in_flight[location] -= 1
+
+    def mark_failed(self, location):
+        log.warning(f'skipping producer {location} for {FAILED_PRODUCER_BACKOFF} seconds')
+        with self._lock:
+            self._failed[location] = time.monotonic() + FAILED_PRODUCER_BACKOFF
+
+
+_router = None
+_router_retry_at = 0
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """
+    Returns the process wide FlightRouter, or None if ZOOKEEPER_HOST is not
+    set or ZooKeeper cannot be reached.
+    """
+    global _router, _router_retry_at
+    host = os.environ.get('ZOOKEEPER_HOST')
+    if not host:
+        return None
+    with _router_lock:
+        if _router is None and time.monotonic() >= _router_retry_at:
+            address = f"{host}:{os.environ.get('ZOOKEEPER_PORT', '2181')}"
+            try:
+                zk = KazooClient(hosts=address, connection_retry=KazooRetry(max_tries=3, delay=0.5, backoff=2))
+                zk.start(timeout=5)
+                _router = FlightRouter(zk)
+            except Exception as e:
+                log.error(f'could not start producer discovery on {address}: {e}')
+                _router_retry_at = time.monotonic() + DISCOVERY_RETRY_INTERVAL
+        return _router
+
+
+def call_with_failover(resolve, call, attempts=3):
+    """
+    Calls `call(url)` with the URL returned by `resolve()`, moving on to another
+    producer when the chosen one is unavailable. A producer that is up but
+    does not hold the version asked for yet (see
+    flight_replication.VersionUnavailableError) is not skipped: the call is
+    retried after a backoff, by when a replica may have caught up.
+
+    Args:
+        resolve (callable): Returns the destination URL.
+        call (callable): Performs the transmit against a URL.
+        attempts (int): The maximum number of producers to try.
+
+    Returns:
+        The result of `call`.
+    """
+    router = get_router()
+    for attempt in range(attempts):
+        url = resolve()
+        if router is None:
+            return call(url)
+        try:
+            with router.using(url):
+                return call(url)
+        except (flight.FlightUnavailableError, flight.FlightTimedOutError) as e:
+            if attempt == attempts - 1:
+                raise
+            if is_version_unavailable(e):
+                delay = backoff(attempt, retry_settings()[1])
+                log.warning(f'{url} does not hold the version asked for, retrying in {delay:.1f} seconds: {e}')
+                time.sleep(delay)
+            else:
+                router.mark_failed(url)
@@ -0,0 +1,128 @@
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_pool import default_pool
+from flightsvc.controllers.flight_query import replica_descriptor
+from flightsvc.controllers.flight_resume import RETRYABLE_ERRORS, backoff, retry_settings
+from flightsvc.controllers.flight_store import key_name
+from flightsvc.controllers.parallel_flight_client import finish_put
+
+log = logging.getLogger(__name__)
+
+# extra_info of the error of a producer that does not hold the version asked for
+VERSION_UNAVAILABLE = b'version-unavailable'
+
+
+class VersionUnavailableError(flight.FlightUnavailableError):
+    """
+    Raised by a healthy producer that does not hold the version a client
+    asked for, e.g. a replica still copying the latest put. Clients move on
+    to another replica like for any FlightUnavailableError, but failover does
+    not take the producer for dead, see is_version_unavailable.
+    """
+
+    def __init__(self, message):
+        super().__init__(message, VERSION_UNAVAILABLE)
+
+
+def is_version_unavailable(error):
+    """
+    Tells whether a FlightUnavailableError received by a client is a VersionUnavailableError,
+    which only reaches the client as its extra_info.
+    """
+    return getattr(error, 'extra_info', None) == VERSION_UNAVAILABLE
+
+
+def put_result(entry):
+    """
+    Returns the do_put result a producer sends back for a stored entry.
+    """
+    return pyarrow.py_buffer(json.dumps({'version': entry.version}).encode())
+
+
+def check_version(key, entry, version=None, min_version=None):
+    """
+    Refuses to serve a version other than the one a ticket was issued for,
+    or one older than a client has already written.
+
+    Raises:
+        VersionUnavailableError: If the entry does not hold the version,
+            so the client moves on to another replica.
+    """
+    if version is not None and entry.version != version:
+        raise VersionUnavailableError(f'{key_name(key)} is at version {entry.version}, not {version}')
+    if min_version is not None and (entry.version or 0) < min_version:
+        raise VersionUnavailableError(
+            f'{key_name(key)} is at version {entry.version}, older than {min_version}')
+
+
+class FlightReplicator:
+    """
+    Copies committed flights from a primary producer to its peers in the background.
+
+    A replica is only listed in the FlightInfo of the version it holds once
+    its copy has completed, and tickets name the version they were issued
+    for, so a client never reads a replica that is behind.
+
+    Args:
+        location (str): The location of the primary producer.
+        pool (FlightClientPool, optional): The pool connections to peers are borrowed from.
+        max_workers (int): The maximum number of concurrent copies.
+    """
+
+    def __init__(self, location, pool=None, max_workers=4):
+        self.location = location
+        self.pool = pool or default_pool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='replicator')
+
+    def replicate(self, key, entry, peers):
+        """
+        Schedules the copy of a committed entry to every peer.
+        """
+        for peer in peers:
+            self._executor.submit(self._forward, key, entry, peer)
+
+    def _put(self, peer, descriptor, schema, batches):
+        # a busy peer refuses the copy until it has a free slot, see flight_admission
+        retries, factor = retry_settings()
+        for retry in range(retries + 1):
+            try:
+                with self.pool.connection(peer) as client:
+                    writer, reader = client.do_put(descriptor, schema)
+                    for batch in batches:
+                        writer.write_batch(batch)
+                    finish_put(writer, reader)
+                return
+            except RETRYABLE_ERRORS:
+                if retry == retries:
+                    raise
+                time.sleep(backoff(retry, factor))
+
+    def _forward(self, key, entry, peer):
+        name = key_name(key)
+        if entry.base is not None:
+            # a peer holding the version the entry was appended to only needs the new batches
+            base_version, base_batches = entry.base
+            try:
+                self._put(peer, replica_descriptor(name, entry.version, self.location, base_version),
+                          entry.schema, entry.batches[base_batches:])
+                entry.replicas.append(peer)
+                log.info(f'replicated the append to {name} version {entry.version} to {peer}')
+                return
+            except Exception as e:
+                log.info(f'{peer} cannot append to {name} version {base_version}, copying the flight: {e}')
+        try:
+            self._put(peer, replica_descriptor(name, entry.version, self.location), entry.schema, entry.batches)
+        except Exception as e:
+            log.error(f'could not replicate {name} version {entry.version} to {peer}: {e}')
+            return
+        entry.replicas.append(peer)
+        log.info(f'replicated {name} version {entry.version} to {peer}')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,258 @@
+import json
+import os
+import struct
+import time
+import uuid
+import logging
+
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_query import decode_ticket, encode_ticket
+from flightsvc.src.config import DEFAULT_ENV_VALUES
+
+log = logging.getLogger(__name__)
+
+# errors after which a transfer is resumed: the connection broke or the server is not reachable
+RETRYABLE_ERRORS = (flight.FlightUnavailableError, flight.FlightTimedOutError)
+
+# app_metadata of a batch of a resumable upload: its sequence number in the upload
+_SEQUENCE = struct.Struct('>q')
+
+
+def retry_settings():
+    """
+    Returns the retry policy of transfers from NUM_RETRIES and BACKOFF_FACTOR,
+    see config.DEFAULT_ENV_VALUES.
+
+    Returns:
+        tuple: (number of retries, backoff factor in seconds)
+    """
+    retries = int(os.environ.get('NUM_RETRIES') or DEFAULT_ENV_VALUES['NUM_RETRIES'])
+    factor = float(os.environ.get('BACKOFF_FACTOR') or DEFAULT_ENV_VALUES['BACKOFF_FACTOR'])
+    return retries, factor
+
+
+def backoff(retry, factor):
+    """
+    Returns the seconds to wait before retry number `retry` (from 0): factor, 2 * factor, 4 * factor...
+    """
+    return factor * 2 ** retry
+
+
+def resumable_descriptor(table_name, upload_id, append=False):
+    """
+    Builds the do_put descriptor of one attempt of a resumable upload.
+
+    Every attempt of the upload uses the same `upload_id`. The server answers
+    each attempt with the number of batches it already holds (see
+    resume_metadata) before reading, and the client sends the rest, each batch
+    with its sequence number as app_metadata (see sequence_metadata). The
+    flight is published once an attempt sends the number of batches of the
+    upload (see end_metadata): a broken connection can look like the end of
+    the stream to the server. A client whose batches fail to come sends
+    abort_metadata instead, and the server drops the upload at once.
+
+    Before its end, a client may send prepare_metadata: the server answers
+    with resume_metadata once it holds the batches sent, so uploads to
+    several producers are only completed once all of them have succeeded,
+    see parallel_flight_client.put_shards.
+    """
+    query = {'table_name': table_name, 'upload_id': upload_id, 'resumable': True}
+    if append:
+        query['append'] = True
+    return flight.FlightDescriptor.for_command(json.dumps(query))
+
+
+def resume_metadata(next_batch):
+    return pyarrow.py_buffer(json.dumps({'resume_from': next_batch}).encode())
+
+
+def sequence_metadata(sequence):
+    return pyarrow.py_buffer(_SEQUENCE.pack(sequence))
+
+
+def end_metadata(batches):
+    return pyarrow.py_buffer(json.dumps({'batches': batches}).encode())
+
+
+def abort_metadata(error):
+    return pyarrow.py_buffer(json.dumps({'abort': str(error)}).encode())
+
+
+def prepare_metadata(batches):
+    return pyarrow.py_buffer(json.dumps({'prepare': batches}).encode())
+
+
+def _upload_message(app_metadata):
+    if app_metadata is None or app_metadata.size == _SEQUENCE.size:
+        return {}
+    return json.loads(app_metadata.to_pybytes())
+
+
+def upload_end(app_metadata):
+    """
+    Returns the number of batches of a resumable upload sent as its last message, or None.
+    """
+    return _upload_message(app_metadata).get('batches')
+
+
+def upload_abort(app_metadata):
+    """
+    Returns the reason a client aborted a resumable upload with, or None.
+    """
+    return _upload_message(app_metadata).get('abort')
+
+
+def upload_prepare(app_metadata):
+    """
+    Returns the number of batches a client asks the server to confirm it holds, or None.
+    """
+    return _upload_message(app_metadata).get('prepare')
+
+
+def batch_sequence(app_metadata):
+    """
+    Returns the sequence number a batch of a resumable upload was sent with, or None.
+    """
+    if app_metadata is None or app_metadata.size != _SEQUENCE.size:
+        return None
+    return _SEQUENCE.unpack(app_metadata.to_pybytes())[0]
+
+
+def skip_rows(batches, rows):
+    """
+    Yields `batches` without their first `rows` rows, see get_resumable.
+    """
+    for batch in batches:
+        if rows >= batch.num_rows:
+            rows -= batch.num_rows
+            continue
+        yield batch.slice(rows) if rows else batch
+        rows = 0
+
+
+def abort_upload(writer, error):
+    """
+    Aborts the resumable upload written by `writer`: the server drops it
+    rather than wait for it to be resumed. The error the server answers with
+    is ignored.
+    """
+    try:
+        writer.write_metadata(abort_metadata(error))
+        writer.close()
+    except (flight.FlightError, pyarrow.ArrowException):
+        pass
+
+
+def put_resumable(pool, url, table_name, schema, batches, options=None, append=False, max_retries=None):
+    """
+    Uploads a stream of record batches as one flight, resuming from the last
+    batch the server holds when the connection breaks.
+
+    The upload is retried NUM_RETRIES times, waiting BACKOFF_FACTOR seconds
+    and then twice as long after every failure. Every retry only sends the
+    batches after those the server acknowledged when it was opened. If
+    iterating `batches` raises, the upload is aborted: the server drops it
+    and the flight it replaced stays published.
+
+    Args:
+        pool (FlightClientPool): The pool connections are borrowed from.
+        url (str): The Flight URL of the destination.
+        table_name (str): The name of the flight.
+        schema (pyarrow.Schema): The schema of the batches.
+        batches (callable): Returns an iterator over the batches, called for every
+            attempt; it must yield the same batches every time.
+        options (pyarrow.flight.FlightCallOptions, optional): The call options, e.g. IPC compression.
+        append (bool): If True, the batches are appended to the stored flight.
+        max_retries (int, optional): Defaults to NUM_RETRIES; 0 for batches that cannot
+            be iterated twice, e.g. decoded from a request body.
+
+    Returns:
+        dict: The put result sent back by the server, e.g. the `version` of the stored flight.
+    """
+    retries, factor = retry_settings()
+    if max_retries is not None:
+        retries = max_retries
+    descriptor = resumable_descriptor(table_name, uuid.uuid4().hex, append)
+    for retry in range(retries + 1):
+        try:
+            with pool.connection(url) as client:
+                writer, reader = client.do_put(descriptor, schema, options=options)
+                # the server tells how many batches it holds before it reads any
+                metadata = reader.read()
+                if metadata is None:
+                    # refused before reading, e.g. by admission control: close raises the error
+                    writer.close()
+                    raise flight.FlightUnavailableError(f'{url} ended the upload of {table_name} before reading it')
+                start = json.loads(metadata.to_pybytes())['resume_from']
+                sequence = 0
+                source = enumerate(batches(), 1)
+                while True:
+                    try:
+                        sequence, batch = next(source)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        abort_upload(writer, e)
+                        raise
+                    if sequence > start:
+                        writer.write_with_metadata(batch, sequence_metadata(sequence - 1))
+                writer.write_metadata(end_metadata(sequence))
+                writer.done_writing()
+                metadata = reader.read()
+                writer.close()
+            return json.loads(metadata.to_pybytes()) if metadata is not None else {}
+        except RETRYABLE_ERRORS as e:
+            if retry == retries:
+                raise
+            delay = backoff(retry, factor)
+            log.warning(f'upload of {table_name} to {url} broke, resuming in {delay:.1f} seconds: {e}')
+            time.sleep(delay)
+
+
+def get_resumable(connect, ticket, max_retries=None):
+    """
+    Reads the stream of a ticket, resuming after the rows already received when
+    the connection breaks, with the retries and backoff of put_resumable.
+
+    The ticket of a resumed read asks the server to skip the rows received.
+    They are counted in rows rather than batches, the batches of a flight are
+    merged by compactions but its rows are not.
+
+    Args:
+        connect (callable): Called with the retry number (0 for the first attempt),
+            returns a context manager giving the client to read with, e.g. a
+            connection of FlightClientPool, possibly to another replica.
+        ticket (pyarrow.flight.Ticket): The ticket of the endpoint.
+        max_retries (int, optional): Defaults to NUM_RETRIES.
+
+    Returns:
+        pyarrow.Table: The rows of the endpoint.
+    """
+    retries, factor = retry_settings()
+    if max_retries is not None:
+        retries = max_retries
+    key, query = decode_ticket(ticket)
+    batches, received, schema = [], 0, None
+    for retry in range(retries + 1):
+        if received:
+            ticket = flight.Ticket(encode_ticket(key, {**query, 'skip_rows': query.get('skip_rows', 0) + received}))
+        try:
+            with connect(retry) as client:
+                reader = client.do_get(ticket)
+                schema = reader.schema
+                while True:
+                    try:
+                        chunk = reader.read_chunk()
+                    except StopIteration:
+                        return pyarrow.Table.from_batches(batches, schema=schema)
+                    if chunk.data is not None:
+                        batches.append(chunk.data)
+                        received += chunk.data.num_rows
+        except RETRYABLE_ERRORS as e:
+            if retry == retries:
+                raise
+            delay = backoff(retry, factor)
+            log.warning(f'read broke after {received} rows, resuming in {delay:.1f} seconds: {e}')
+            time.sleep(delay)
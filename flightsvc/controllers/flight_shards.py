@@ -0,0 +1,114 @@
+import zlib
+import logging
+
+import numpy
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_query import encode_ticket, row_ranges
+
+log = logging.getLogger(__name__)
+
+SHARD_METHODS = ['hash', 'range']
+
+
+def _value_hash(value):
+    # stable across processes, unlike hash() of str and bytes
+    return zlib.crc32(repr(value).encode())
+
+
+def shard_ids(table, num_shards, shard_by=None, method='hash', boundaries=None):
+    """
+    Assigns every row of a table to a shard.
+
+    Args:
+        table (pyarrow.Table): The table to shard.
+        num_shards (int): The number of shards.
+        shard_by (str, optional): The column to shard on. Without it, the table
+            is split into contiguous row ranges.
+        method (str): 'hash' to spread the values of `shard_by` evenly, or
+            'range' to keep ordered ranges of values on the same shard.
+        boundaries (list, optional): The first value of shards 1..n-1 for range
+            sharding. Defaults to quantiles of the column.
+
+    Returns:
+        numpy.ndarray: The shard index of each row.
+    """
+    if method not in SHARD_METHODS:
+        raise ValueError(f"Invalid shard method {method!r}, expected one of {SHARD_METHODS}")
+    if shard_by is None:
+        ids = numpy.empty(table.num_rows, dtype=numpy.int32)
+        for shard, (start, stop) in enumerate(row_ranges(table.num_rows, num_shards)):
+            ids[start:stop] = shard
+        return ids
+
+    column = table.column(shard_by).combine_chunks()
+    if method == 'hash':
+        # hash the distinct values only, then broadcast through the dictionary indices
+        encoded = pc.dictionary_encode(column)
+        buckets = numpy.array([_value_hash(value) % num_shards for value in encoded.dictionary.to_pylist()],
+                              dtype=numpy.int32)
+        indices = encoded.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        if not len(buckets):
+            return numpy.zeros(table.num_rows, dtype=numpy.int32)
+        return buckets[indices]
+
+    if boundaries is None:
+        quantiles = [i / num_shards for i in range(1, num_shards)]
+        boundaries = pc.quantile(column, q=quantiles, interpolation='lower').to_pylist() if quantiles else []
+    ids = numpy.zeros(table.num_rows, dtype=numpy.int32)
+    for boundary in boundaries:
+        ids += pc.greater_equal(column, pyarrow.scalar(boundary).cast(column.type)) \
+            .fill_null(False).to_numpy(zero_copy_only=False)
+    return ids
+
+
+def shard_table(table, num_shards, shard_by=None, method='hash', boundaries=None):
+    """
+    Splits a table into `num_shards` tables, see shard_ids. Shards may be empty.
+
+    Returns:
+        list: The table of each shard.
+    """
+    if shard_by is None:
+        ranges = row_ranges(table.num_rows, num_shards)
+        # with fewer rows than shards the last shards stay empty
+        ranges += [[table.num_rows, table.num_rows]] * (num_shards - len(ranges))
+        # contiguous shards are zero-copy slices
+        return [table.slice(start, stop - start) for start, stop in ranges]
+    ids = pyarrow.array(shard_ids(table, num_shards, shard_by, method, boundaries))
+    return [table.filter(pc.equal(ids, shard)) for shard in range(num_shards)]
+
+
+def shard_endpoints(key, query, shards, partition_rows=None):
+    """
+    Builds the endpoints of a sharded flight, pointing at every shard.
+
+    Every shard stores its rows under the same key, so the tickets are the
+    same on every producer; only the location and row ranges differ.
+
+    Args:
+        key (tuple): The flight key.
+        query (dict): The ticket query, with an optional `partitions` count per shard.
+        shards (list): The shard map, one {'location', 'num_rows'} dict per shard.
+        partition_rows (int, optional): The rows per endpoint when the query
+            does not ask for a partition count.
+
+    Returns:
+        list: The FlightEndpoints of all shards, in shard order.
+    """
+    query = dict(query)
+    partitions = query.pop('partitions', None)
+    endpoints = []
+    for shard in shards:
+        location = flight.Location(shard['location'])
+        count = partitions
+        if count is None and partition_rows:
+            count = -(-shard['num_rows'] // partition_rows)
+        if count and count > 1:
+            endpoints.extend(flight.FlightEndpoint(encode_ticket(key, {**query, 'row_range': row_range}), [location])
+                             for row_range in row_ranges(shard['num_rows'], count))
+        elif shard['num_rows']:
+            endpoints.append(flight.FlightEndpoint(encode_ticket(key, query), [location]))
+    return endpoints
@@ -0,0 +1,1222 @@
+import ast
+import base64
+import bisect
+import collections
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+
+import pyarrow
+
+from flightsvc.controllers.flight_dictionary import (DICTIONARY_ENCODE, DictionaryEncodingReader, conform_reader,
+                                                     file_batches)
+from flightsvc.controllers.flight_index import BATCH_INDEXES, index_batch
+from flightsvc.controllers.flight_resume import batch_sequence, upload_abort, upload_end, upload_prepare
+
+log = logging.getLogger(__name__)
+
+# size of the end-of-stream marker closing an IPC stream
+IPC_EOS_SIZE = 8
+# entry attributes kept in the IPC file metadata of a persisted flight, as flight.<name>
+METADATA_FIELDS = ['shards', 'version', 'primary', 'lineage']
+# seconds between two compactions of the batches appended to flights
+COMPACT_INTERVAL = 10
+# appended batches are merged into batches of up to this many rows
+COMPACT_ROWS = 65536
+# seconds a replaced version stays readable by the tickets issued for it
+RETIRED_TTL = 30
+# seconds the batches of an interrupted resumable upload are kept for the client to resume it,
+# and the parts of a multi-stream upload for its other parts
+RESUME_TTL = 300
+
+
+class StoreFullError(MemoryError):
+    """
+    Raised when a put does not fit in the store's memory budget, even after eviction.
+    """
+
+
+class FlightReplacedError(LookupError):
+    """
+    Raised to a subscriber when the flight it follows is replaced by a new put
+    rather than appended to, so its row offset no longer applies.
+    """
+
+
+def key_name(key):
+    """
+    Returns the catalog name of a flight key: the command for command
+    descriptors, the '/' joined path for path descriptors.
+    """
+    if key[1] is not None:
+        name = key[1]
+    else:
+        name = b'/'.join(p if isinstance(p, bytes) else p.encode() for p in key[2])
+    return name.decode() if isinstance(name, bytes) else name
+
+
+def parse_criteria(criteria):
+    """
+    Parses the list_flights criteria.
+
+    The criteria expression is either a JSON object with the optional fields
+    `prefix`, `after` (the last name of the previous page) and `limit`, or a
+    plain name prefix.
+
+    Returns:
+        tuple: (prefix, after, limit)
+    """
+    expression = getattr(criteria, 'expression', criteria) or b''
+    if isinstance(expression, bytes):
+        expression = expression.decode()
+    if not expression:
+        return None, None, None
+    if expression.lstrip().startswith('{'):
+        options = json.loads(expression)
+        limit = options.get('limit')
+        return options.get('prefix'), options.get('after'), int(limit) if limit is not None else None
+    return expression, None, None
+
+
+def merge_batches(batches, max_rows):
+    """
+    Concatenates runs of consecutive batches of less than `max_rows` rows into
+    batches of up to `max_rows` rows. Larger batches are kept as they are.
+    """
+    merged, run, run_rows = [], [], 0
+    for batch in batches:
+        if batch.num_rows < max_rows and run_rows + batch.num_rows <= max_rows:
+            run.append(batch)
+            run_rows += batch.num_rows
+            continue
+        if run:
+            merged.append(pyarrow.concat_batches(run) if len(run) > 1 else run[0])
+        run, run_rows = ([batch], batch.num_rows) if batch.num_rows < max_rows else ([], 0)
+        if not run:
+            merged.append(batch)
+    if run:
+        merged.append(pyarrow.concat_batches(run) if len(run) > 1 else run[0])
+    return merged
+
+
+class Snapshot(collections.namedtuple('Snapshot', ['entries', 'index'])):
+    """
+    An immutable view of the catalog: the entries by key, and the (name, key)
+    index sorted by name. Writers publish a new snapshot rather than change
+    the current one, so a reader holding a snapshot needs no lock and never
+    sees a half-applied put.
+    """
+    __slots__ = ()
+
+
+class FlightEntry:
+    """
+    Record batches stored under a single flight key.
+
+    Batches are visible to readers as soon as they are appended, so a reader
+    of an entry that is still being uploaded streams the batches committed so
+    far and then waits for the rest.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.batches = []
+        self.num_rows = 0
+        # size of the entry written as an IPC stream, kept up to date on append
+        self.data_size = schema.serialize().size + IPC_EOS_SIZE
+        # bytes of the Arrow buffers held by the batches
+        self.nbytes = 0
+        # the (index, nbytes) of every batch, see flight_index.index_batch, and the memory they use
+        self.indexes = []
+        self.index_bytes = 0
+        # True once the store no longer counts this entry in its memory usage
+        self.released = False
+        # IPC file backing the batches once the entry has been persisted, and the bytes it maps
+        self.path = None
+        self.file_size = 0
+        self.mapped_bytes = 0
+        self.last_access = time.monotonic()
+        # shard map if this entry is one shard of a flight sharded across producers
+        self.shards = None
+        # consistency marker, assigned by the producer that received the put
+        self.version = None
+        # version of the put this entry descends from through appends and compactions
+        self.lineage = None
+        # locations holding a replica of this version, or the primary's location on a replica
+        self.replicas = []
+        self.primary = None
+        # batches appended since the last compaction, at the end of `batches`, and the
+        # (version, number of batches) of the entry they were appended to
+        self.appended = 0
+        self.base = None
+        self.complete = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    @property
+    def heap_bytes(self):
+        # memory-mapped batches live in the page cache, not on the heap
+        return self.nbytes - self.mapped_bytes
+
+    def append(self, batch, index=None):
+        """
+        Adds a batch, visible to readers at once.
+
+        Args:
+            batch (pyarrow.RecordBatch): The batch.
+            index (tuple, optional): The batch's (index, nbytes) from index_batch, when the
+                caller has built it already. Otherwise it is built here, before taking the lock.
+        """
+        if index is None and BATCH_INDEXES:
+            index = index_batch(batch)
+        index = index or (None, 0)
+        with self._cond:
+            self.batches.append(batch)
+            self.indexes.append(index)
+            self.index_bytes += index[1]
+            self.num_rows += batch.num_rows
+            self.data_size += pyarrow.ipc.get_record_batch_size(batch)
+            self.nbytes += batch.get_total_buffer_size()
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.complete = True
+            self.error = error
+            self._cond.notify_all()
+
+    def _iter(self, start=0):
+        # (batch, index) pairs from batch `start`, blocking for new ones until the upload has finished
+        if self.complete and self.error is None:
+            # a complete entry no longer changes, map_file only swaps in equal batches
+            for batch, (index, _) in zip(self.batches[start:], self.indexes[start:]):
+                yield batch, index
+            return
+        i = start
+        while True:
+            with self._cond:
+                while i >= len(self.batches) and not self.complete:
+                    self._cond.wait()
+                if i >= len(self.batches):
+                    if self.error is not None:
+                        raise IOError(f'upload failed: {self.error}')
+                    return
+                batch, (index, _) = self.batches[i], self.indexes[i]
+            i += 1
+            yield batch, index
+
+    def iter_batches(self, start=0, keep=None):
+        """
+        Yields the stored batches from index `start`, blocking for new ones
+        until the upload has finished.
+
+        Args:
+            start (int): The index of the first batch.
+            keep (callable, optional): A test of the batch indexes, see flight_index.batch_filter.
+                Batches it rejects are skipped without being read.
+
+        Raises:
+            IOError: If the upload feeding this entry failed.
+        """
+        for batch, index in self._iter(start):
+            if keep is None or keep(index):
+                yield batch
+
+    def iter_rows(self, start, stop, keep=None):
+        """
+        Yields zero-copy slices of the stored batches covering rows [start, stop),
+        skipping the batches rejected by `keep`, see iter_batches.
+        """
+        offset = 0
+        for batch, index in self._iter():
+            if offset >= stop:
+                return
+            end = offset + batch.num_rows
+            if end > start and (keep is None or keep(index)):
+                begin = max(start - offset, 0)
+                yield batch.slice(begin, min(stop, end) - offset - begin)
+            offset = end
+
+    def matching_spans(self, keep):
+        """
+        Returns the sorted (start, stop) row spans of the batches accepted by
+        `keep`, adjacent batches merged into one span. None if every row may
+        match, or if the entry is still uploading and its batches are not known.
+        """
+        if keep is None or not self.complete:
+            return None
+        spans, offset = [], 0
+        for batch, (index, _) in zip(self.batches, self.indexes):
+            end = offset + batch.num_rows
+            if keep(index):
+                if spans and spans[-1][1] == offset:
+                    spans[-1] = (spans[-1][0], end)
+                else:
+                    spans.append((offset, end))
+            offset = end
+        return spans
+
+    def to_table(self):
+        if self.complete:
+            return pyarrow.Table.from_batches(self.batches, schema=self.schema)
+        with self._cond:
+            batches = list(self.batches)
+        return pyarrow.Table.from_batches(batches, schema=self.schema)
+
+    def extended(self, other):
+        """
+        Returns a new complete entry holding the batches of this entry followed
+        by those of `other`, sharing their buffers.
+
+        The sizes are added up rather than recomputed, so the cost does not
+        depend on the rows already stored.
+        """
+        entry = FlightEntry(self.schema)
+        entry.batches = self.batches + other.batches
+        entry.indexes = self.indexes + other.indexes
+        entry.index_bytes = self.index_bytes + other.index_bytes
+        entry.num_rows = self.num_rows + other.num_rows
+        entry.data_size = self.data_size + other.data_size - (other.schema.serialize().size + IPC_EOS_SIZE)
+        entry.nbytes = self.nbytes + other.nbytes
+        # the batches of this entry stay mapped from its file until the next compaction persists the entry
+        entry.path, entry.file_size, entry.mapped_bytes = self.path, self.file_size, self.mapped_bytes
+        entry.appended = self.appended + len(other.batches)
+        entry.base = (self.version, len(self.batches))
+        entry.lineage = self.lineage
+        entry.complete = True
+        return entry
+
+    def map_file(self, path):
+        """
+        Swaps the batches for zero-copy views of the IPC file at `path`.
+
+        The file must hold the same rows in the same batches, only their
+        dictionaries may have been unified. Only the file footer and batch
+        metadata are read, the data pages are loaded on demand.
+        """
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+        batches = [reader.get_batch(i) for i in range(reader.num_record_batches)]
+        with self._cond:
+            self.batches = batches
+            self.path = path
+            self.file_size = os.path.getsize(path)
+            self.mapped_bytes = self.nbytes
+
+
+class FlightStore:
+    """
+    Thread safe mapping of flight keys to FlightEntry objects.
+
+    Besides the entries the store keeps a catalog index of the keys sorted by
+    name, so listing a page of flights does not touch the stored data. Both
+    are copy-on-write: writers serialize on a lock and publish a new Snapshot,
+    readers (get, list, do_get) take the current one without locking.
+
+    A replaced version stays readable for `retired_ttl` seconds through get
+    with its version, so the endpoints of a FlightInfo are all read from the
+    version it was issued for.
+
+    The store accounts the Arrow buffer bytes of every stored and in-progress
+    upload. When a memory limit is set, the least recently used complete
+    flights are evicted to make room for new batches, and a put that still
+    does not fit fails with StoreFullError. With a ttl, flights that have not
+    been read or written for that long are dropped.
+
+    Args:
+        streaming (bool): If True, an upload is published as soon as it starts
+            and readers see batches as they arrive. If False, the previous
+            entry (if any) stays visible until the upload has completed.
+        memory_limit (int, optional): The memory budget in bytes. Defaults to no limit.
+        ttl (float, optional): The idle time in seconds after which a flight expires.
+            Defaults to no expiry.
+        data_dir (str, optional): If set, every completed flight is written to an
+            Arrow IPC file in this directory and served from a memory map. On
+            startup the catalog is rebuilt from the files found there. Persisted
+            flights do not count against the memory limit. Appended batches are
+            written by the next compaction.
+        compact_interval (float, optional): The seconds between two background
+            compactions of appended flights, see compact. Defaults to COMPACT_INTERVAL,
+            0 disables them.
+        compact_rows (int): The rows per batch appended batches are merged into.
+        retired_ttl (float): The seconds a replaced version stays readable by its tickets.
+            Retired versions count against the memory limit, except for the buffers they
+            share with the current version, and are evicted before any flight.
+        dictionary_encode (bool): If True, the string columns of a put with few distinct
+            values in its first batch are stored dictionary encoded, see flight_dictionary.
+            The parts of a multi-stream upload are stored as they are sent.
+        resume_ttl (float): The seconds an interrupted resumable upload is kept for
+            its client to resume it, see ingest_resumable, and the parts of a multi-stream
+            upload wait for the others, see ingest_part.
+    """
+
+    def __init__(self, streaming=True, memory_limit=None, ttl=None, data_dir=None,
+                 compact_interval=COMPACT_INTERVAL, compact_rows=COMPACT_ROWS, retired_ttl=RETIRED_TTL,
+                 dictionary_encode=DICTIONARY_ENCODE, resume_ttl=RESUME_TTL):
+        self.streaming = streaming
+        self.resume_ttl = resume_ttl
+        self.dictionary_encode = dictionary_encode
+        self.data_dir = data_dir
+        self.memory_limit = memory_limit
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self.compact_rows = compact_rows
+        self.used_bytes = 0
+        self.evictions = 0
+        self.compactions = 0
+        self.retired_ttl = retired_ttl
+        self._snapshot = Snapshot({}, ())
+        # replaced versions by (key, version), with the time they expire; also copy-on-write
+        self._retired = {}
+        # staged parts of multi-stream uploads, and the staged batches of resumable uploads, by upload id
+        self._uploads = {}
+        self._resumable = {}
+        self._lock = threading.Lock()
+        # notified whenever an entry is published or removed, see follow
+        self._published = threading.Condition(self._lock)
+        self.subscribers = 0
+
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+            self._load()
+        if ttl:
+            threading.Thread(target=self._expire_loop, daemon=True).start()
+        if compact_interval:
+            threading.Thread(target=self._compact_loop, daemon=True).start()
+        if resume_ttl:
+            threading.Thread(target=self._sweep_loop, daemon=True).start()
+        if retired_ttl:
+            threading.Thread(target=self._retired_loop, daemon=True).start()
+
+    def __contains__(self, key):
+        return key in self._snapshot.entries
+
+    def snapshot(self):
+        """
+        Returns:
+            Snapshot: The current catalog, which does not change once returned.
+        """
+        return self._snapshot
+
+    def get(self, key, version=None):
+        """
+        Returns the entry of a flight, or None. With a `version`, the entry of
+        that version if it has been replaced recently, otherwise the current
+        entry whatever its version.
+        """
+        entry = self._snapshot.entries.get(key)
+        if version is not None and (entry is None or entry.version != version):
+            retired = self._retired.get((key, version))
+            if retired is not None and retired[1] > time.monotonic():
+                entry = retired[0]
+        if entry is not None:
+            entry.last_access = time.monotonic()
+        return entry
+
+    def items(self):
+        return list(self._snapshot.entries.items())
+
+    def list(self, prefix=None, after=None, limit=None):
+        """
+        Returns a page of (key, entry) pairs in name order.
+
+        Args:
+            prefix (str, optional): Only return flights whose name starts with this prefix.
+            after (str, optional): Only return flights whose name sorts after this one.
+            limit (int, optional): The maximum number of flights to return.
+        """
+        entries, index = self._snapshot
+        start = 0
+        if prefix:
+            start = bisect.bisect_left(index, (prefix,))
+        if after is not None:
+            start = max(start, bisect.bisect_right(index, (after, (float('inf'),))))
+        page = []
+        for i in range(start, len(index)):
+            name, key = index[i]
+            if prefix and not name.startswith(prefix):
+                break
+            if limit is not None and len(page) >= limit:
+                break
+            page.append((key, entries[key]))
+        return page
+
+    def usage(self):
+        """
+        Returns:
+            dict: The memory accounting of the store.
+        """
+        with self._lock:
+            return {
+                'used_bytes': self.used_bytes,
+                'disk_bytes': sum(entry.file_size for entry in self._snapshot.entries.values()),
+                'memory_limit': self.memory_limit,
+                'ttl': self.ttl,
+                'flights': len(self._snapshot.entries),
+                'uploads_in_progress': len(self._uploads) + len(self._resumable),
+                'evictions': self.evictions,
+                'compactions': self.compactions,
+                'subscribers': self.subscribers,
+                'retired_versions': len(self._retired),
+                'retired_bytes': sum(entry.heap_bytes for entry, _ in self._retired.values() if not entry.released),
+                'index_bytes': sum(entry.index_bytes for entry in self._snapshot.entries.values()),
+            }
+
+    def clear(self, prefix=None):
+        """
+        Removes every flight, or those whose name starts with `prefix`.
+
+        Returns:
+            tuple: (number of flights removed, bytes released)
+        """
+        with self._lock:
+            entries, index = self._snapshot
+            keys = [key for name, key in index if not prefix or name.startswith(prefix)]
+            released = sum(entries[key].heap_bytes for key in keys)
+            self._remove(*keys)
+        log.info(f'cleared {len(keys)} flights, {released} bytes')
+        return len(keys), released
+
+    def _publish(self, key, entry):
+        # must be called with the lock held, like every writer of the snapshot
+        entries, index = self._snapshot
+        previous = entries.get(key)
+        if entry.version is None:
+            # nanoseconds keep versions unique across clears and restarts
+            entry.version = max(time.time_ns(), previous.version + 1 if previous is not None else 0)
+        if entry.lineage is None:
+            entry.lineage = entry.version
+        if previous is None:
+            item = (key_name(key), key)
+            i = bisect.bisect_left(index, item)
+            index = index[:i] + (item,) + index[i:]
+        elif previous is not entry:
+            if previous.version != entry.version and previous.error is None and self.retired_ttl:
+                if entry.base is not None and entry.base[0] == previous.version:
+                    # an append shares the buffers of the version it extends, they are counted once
+                    self._release(previous)
+                self._retire(key, previous)
+            else:
+                self._release(previous)
+        if (key, entry.version) in self._retired:
+            # a retired version published again, e.g. restored after a failed put
+            self._retired = {k: v for k, v in self._retired.items() if k != (key, entry.version)}
+        self._retain(entry)
+        self._snapshot = Snapshot({**entries, key: entry}, index)
+        self._published.notify_all()
+
+    def _retire(self, key, entry):
+        # the entry stays counted until it expires, or is evicted when the store is over its budget
+        self._retired = {**self._retired, (key, entry.version): (entry, time.monotonic() + self.retired_ttl)}
+        self._prune_retired(0 if self.memory_limit is not None else None)
+
+    def _prune_retired(self, needed=None):
+        """
+        Drops the expired retired versions, and with `needed`, the retired
+        versions expiring first until `needed` more bytes fit in the memory
+        budget. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        dropped = []
+        for k, (entry, expires) in sorted(self._retired.items(), key=lambda item: item[1][1]):
+            if expires <= now:
+                dropped.append(k)
+            elif needed is not None and not entry.released and self.used_bytes + needed > self.memory_limit:
+                log.info(f'evicting version {k[1]} of {key_name(k[0])} ({entry.heap_bytes} bytes)')
+                dropped.append(k)
+                self.evictions += 1
+            else:
+                continue
+            self._release(entry)
+        if dropped:
+            self._retired = {k: v for k, v in self._retired.items() if k not in set(dropped)}
+
+    def _remove(self, *keys):
+        entries, index = self._snapshot
+        entries = dict(entries)
+        removed = set(keys)
+        for key in keys:
+            self._release(entries.pop(key))
+        self._snapshot = Snapshot(entries, tuple(item for item in index if item[1] not in removed))
+        if any(k in removed for k, _ in self._retired):
+            for (k, _), (entry, _) in self._retired.items():
+                if k in removed:
+                    self._release(entry)
+            self._retired = {(k, v): value for (k, v), value in self._retired.items() if k not in removed}
+        self._published.notify_all()
+        if self.data_dir:
+            for key in keys:
+                # the file may belong to an earlier version of the entry
+                path = self._file_path(key)
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError as e:
+                    log.warning(f'could not remove {path}: {e}')
+
+    def _release(self, entry):
+        if not entry.released:
+            self.used_bytes -= entry.heap_bytes
+            entry.released = True
+
+    def _retain(self, entry):
+        if entry.released:
+            self.used_bytes += entry.heap_bytes
+            entry.released = False
+
+    def _file_path(self, key):
+        name = base64.urlsafe_b64encode(repr(key).encode()).decode()
+        return os.path.join(self.data_dir, f'{name}.arrow')
+
+    def _load(self):
+        """
+        Rebuilds the catalog from the IPC files in the data directory.
+        """
+        for path in glob.glob(os.path.join(self.data_dir, '*.tmp')):
+            os.remove(path)
+        for path in sorted(glob.glob(os.path.join(self.data_dir, '*.arrow'))):
+            name = os.path.basename(path)[:-len('.arrow')]
+            try:
+                key = ast.literal_eval(base64.urlsafe_b64decode(name).decode())
+                reader = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+                entry = FlightEntry(reader.schema)
+                for i in range(reader.num_record_batches):
+                    entry.append(reader.get_batch(i))
+                for field in METADATA_FIELDS:
+                    value = (reader.metadata or {}).get(f'flight.{field}'.encode())
+                    if value is not None:
+                        setattr(entry, field, json.loads(value))
+            except Exception as e:
+                log.error(f'skipping unreadable flight file {path}: {e}')
+                continue
+            entry.path = path
+            entry.file_size = os.path.getsize(path)
+            entry.mapped_bytes = entry.nbytes
+            entry.finish()
+            with self._lock:
+                self._publish(key, entry)
+        log.info(f'loaded {len(self._snapshot.entries)} flights from {self.data_dir}')
+
+    def _persist(self, key, entry):
+        """
+        Writes a completed entry to its IPC file and serves it from a memory map.
+
+        The file is written under a temporary name and only moved into place
+        if the entry is still the current one for `key`.
+        """
+        if not self.data_dir or entry.error is not None:
+            return
+        path = self._file_path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        metadata = {f'flight.{field}': json.dumps(getattr(entry, field)) for field in METADATA_FIELDS
+                    if getattr(entry, field) is not None}
+        try:
+            with pyarrow.OSFile(tmp_path, 'wb') as sink:
+                # a file holds one dictionary per column, which later batches can only extend
+                options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                with pyarrow.ipc.new_file(sink, entry.schema, metadata=metadata, options=options) as writer:
+                    for batch in file_batches(entry.schema, entry.batches):
+                        writer.write_batch(batch)
+            with self._lock:
+                if self._snapshot.entries.get(key) is not entry:
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, path)
+                counted = not entry.released
+                self._release(entry)
+                entry.map_file(path)
+                if counted:
+                    self._retain(entry)
+        except Exception as e:
+            # the flight stays available from memory
+            log.error(f'could not persist {key} to {path}: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _charge(self, nbytes, key, upload_bytes=0, replaces=None):
+        """
+        Accounts `nbytes` new bytes for an upload to `key` that already holds
+        `upload_bytes`, evicting least recently used complete flights if they
+        do not fit in the budget. Must be called with the lock held.
+
+        `replaces` is the entry of `key` the upload replaces once it is
+        published. While it is still the current entry, its bytes are about to
+        be released and do not keep the upload from fitting: the store
+        holds both until the upload is published.
+        """
+        if self.memory_limit is not None and upload_bytes + nbytes > self.memory_limit:
+            # nothing is evicted for an upload that can never fit
+            raise StoreFullError(f'{key} is larger than the memory budget of {self.memory_limit} bytes')
+        if replaces is not None and self._snapshot.entries.get(key) is replaces and not replaces.released:
+            nbytes -= replaces.heap_bytes
+            credit = replaces.heap_bytes
+        else:
+            credit = 0
+        if self.memory_limit is not None and self.used_bytes + nbytes > self.memory_limit:
+            # replaced versions go before any current flight
+            self._prune_retired(nbytes)
+        if self.memory_limit is not None and self.used_bytes + nbytes > self.memory_limit:
+            candidates = sorted((entry.last_access, k) for k, entry in self._snapshot.entries.items()
+                                if k != key and entry.complete and not entry.path)
+            for _, k in candidates:
+                if self.used_bytes + nbytes <= self.memory_limit:
+                    break
+                log.info(f'evicting {k} ({self._snapshot.entries[k].nbytes} bytes)')
+                self._remove(k)
+                self.evictions += 1
+            if self.used_bytes + nbytes > self.memory_limit:
+                raise StoreFullError(
+                    f'{nbytes + credit} bytes for {key} do not fit in the memory budget: '
+                    f'{self.used_bytes} of {self.memory_limit} bytes in use')
+        self.used_bytes += nbytes + credit
+
+    def _expire_loop(self):
+        while True:
+            time.sleep(max(self.ttl / 2, 1))
+            deadline = time.monotonic() - self.ttl
+            with self._lock:
+                expired = [k for k, entry in self._snapshot.entries.items()
+                           if entry.complete and entry.last_access < deadline]
+                for k in expired:
+                    log.info(f'expiring {k}')
+                self._remove(*expired)
+                self.evictions += len(expired)
+
+    def _retired_loop(self):
+        while True:
+            time.sleep(self.retired_ttl / 2)
+            with self._lock:
+                self._prune_retired()
+
+    def _sweep_loop(self):
+        # drops the uploads abandoned by their clients, even if no other upload starts
+        while True:
+            time.sleep(self.resume_ttl / 2)
+            deadline = time.monotonic() - self.resume_ttl
+            with self._lock:
+                for upload_id, upload in list(self._resumable.items()):
+                    if upload['touched'] < deadline:
+                        log.info(f'dropping upload {upload_id} of {key_name(upload["key"])}, not resumed')
+                        self._drop_resumable(upload_id)
+                for upload_id, upload in list(self._uploads.items()):
+                    if not upload['reading'] and upload['touched'] < deadline:
+                        log.info(f'dropping upload {upload_id} of {key_name(upload["key"])}, '
+                                 f'{upload["pending"]} parts never arrived')
+                        self._drop_parts(upload_id)
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                log.error(f'compaction failed: {e}')
+
+    def compact(self, key=None):
+        """
+        Merges the small batches appended to flights into batches of up to
+        compact_rows rows, and persists the compacted flights.
+
+        Only the trailing run of small batches is copied, so the cost depends
+        on the appended rows, not on the size of the flight. The compacted
+        entry keeps the version of the entry it replaces: it holds the same
+        rows, and readers of the replaced entry finish from its batches.
+
+        Args:
+            key (tuple, optional): Only compact this flight. Defaults to every appended flight.
+
+        Returns:
+            int: The number of flights compacted.
+        """
+        with self._lock:
+            candidates = [(k, entry) for k, entry in self._snapshot.entries.items()
+                          if entry.appended and entry.complete and (key is None or k == key)]
+        compacted = 0
+        for k, entry in candidates:
+            batches = entry.batches
+            start = len(batches) - entry.appended
+            # the last batch of the previous compaction may still have room
+            while start > 0 and batches[start - 1].num_rows < self.compact_rows:
+                start -= 1
+            merged = FlightEntry(entry.schema)
+            # the batches left as they are keep their index
+            for batch, index in zip(batches[:start], entry.indexes):
+                merged.append(batch, index)
+            for batch in merge_batches(batches[start:], self.compact_rows):
+                merged.append(batch)
+            merged.version, merged.replicas, merged.primary = entry.version, entry.replicas, entry.primary
+            merged.lineage = entry.lineage
+            merged.path, merged.file_size = entry.path, entry.file_size
+            merged.mapped_bytes = min(entry.mapped_bytes, sum(b.get_total_buffer_size() for b in batches[:start]))
+            merged.finish()
+            with self._lock:
+                if self._snapshot.entries.get(k) is not entry:
+                    # appended or replaced meanwhile, the next compaction picks it up
+                    continue
+                merged.released = True
+                self._publish(k, merged)
+                self.compactions += 1
+            log.info(f'compacted {len(batches) - start} batches of {key_name(k)} into '
+                     f'{len(merged.batches) - start}')
+            self._persist(k, merged)
+            compacted += 1
+        return compacted
+
+    def follow(self, key, start=0, heartbeat=5.0, cancelled=None):
+        """
+        Yields the batches of a flight from row `start`, then every batch
+        appended to it, as soon as the append is published.
+
+        Nothing is queued for a subscriber: it only holds its row offset into
+        the shared batches, so one that reads slowly falls behind and catches
+        up from the store without slowing down the puts or other subscribers.
+        The generation stops when the flight is removed or `cancelled()`
+        returns True.
+
+        Args:
+            key (tuple): The flight key.
+            start (int): The first row to yield.
+            heartbeat (float): The seconds without new rows after which None is yielded.
+            cancelled (callable, optional): Checked at every heartbeat.
+
+        Raises:
+            KeyError: If the flight is not stored.
+            FlightReplacedError: If the flight is replaced by a put, rather than appended to.
+
+        Yields:
+            pyarrow.RecordBatch: The rows, or None as a heartbeat.
+        """
+        with self._lock:
+            entry = self._snapshot.entries.get(key)
+            if entry is None:
+                raise KeyError(f'Flight {key_name(key)} not found.')
+            self.subscribers += 1
+        # the next batch to read, `i` of `entry`, and its first row
+        i, first, offset = 0, 0, start
+        try:
+            while True:
+                # also follows a streaming upload that is still in progress
+                for batch in entry.iter_batches(i):
+                    begin = offset - first
+                    i, first = i + 1, first + batch.num_rows
+                    if first > offset:
+                        offset = first
+                        yield batch.slice(begin) if begin > 0 else batch
+
+                deadline = time.monotonic() + heartbeat
+                with self._lock:
+                    while self._snapshot.entries.get(key) is entry and deadline > time.monotonic():
+                        self._published.wait(deadline - time.monotonic())
+                    current = self._snapshot.entries.get(key)
+                if current is None or (cancelled is not None and cancelled()):
+                    return
+                if current is entry:
+                    yield None
+                    continue
+                if current.lineage != entry.lineage:
+                    raise FlightReplacedError(f'{key_name(key)} was replaced at version {current.version}, '
+                                              f'subscribe again from row 0')
+                # an append or a compaction, both keep the rows before `offset`: an append
+                # shares the batches of `entry`, a compaction merges the last ones, so the
+                # position only goes back to the last batch both still hold
+                while i and (i > len(current.batches) or current.batches[i - 1] is not entry.batches[i - 1]):
+                    i -= 1
+                    first -= entry.batches[i].num_rows
+                entry = current
+        finally:
+            with self._lock:
+                self.subscribers -= 1
+
+    def put_table(self, key, table):
+        entry = FlightEntry(table.schema)
+        for batch in table.to_batches():
+            entry.append(batch)
+        entry.finish()
+        with self._lock:
+            self._charge(entry.nbytes, key, replaces=self._snapshot.entries.get(key))
+            self._publish(key, entry)
+        self._persist(key, entry)
+        return entry
+
+    def ingest(self, key, reader, shards=None, version=None, primary=None):
+        """
+        Reads an upload batch by batch and stores it under `key`.
+
+        The upload is never materialized as a whole: each batch is added to
+        the entry as soon as it has been read from the stream.
+
+        Args:
+            key (tuple): The flight key.
+            reader (pyarrow.flight.MetadataRecordBatchReader): The do_put reader.
+            shards (list, optional): The shard map if the upload is one shard of a sharded flight.
+            version (int, optional): The version of a replicated flight. Defaults to a new version.
+            primary (str, optional): The location of the producer a replicated flight comes from.
+
+        Returns:
+            FlightEntry: The stored entry.
+        """
+        if self.dictionary_encode and primary is None:
+            # replicas store the primary's batches, already encoded
+            reader = DictionaryEncodingReader(reader)
+        entry = FlightEntry(reader.schema)
+        entry.shards = shards
+        entry.version = version
+        entry.primary = primary
+        with self._lock:
+            previous = self._snapshot.entries.get(key)
+            if self.streaming:
+                self._publish(key, entry)
+
+        try:
+            self._read_into(entry, reader, key, replaces=previous)
+        except Exception as e:
+            entry.finish(error=e)
+            with self._lock:
+                if self._snapshot.entries.get(key) is entry:
+                    self._restore(key, previous)
+                else:
+                    self._release(entry)
+            raise
+
+        entry.finish()
+        if not self.streaming:
+            with self._lock:
+                self._publish(key, entry)
+        self._persist(key, entry)
+        return entry
+
+    def append(self, key, reader, version=None, primary=None, base_version=None):
+        """
+        Reads an upload and appends its batches to the flight stored under `key`.
+
+        Only the new batches are read and accounted: they are staged, and once
+        the upload has completed a new version sharing the buffers of the
+        current one is published, so readers never see part of an append and
+        the cost of a put does not depend on the rows already stored. The
+        small batches appended are merged by the background compaction. A
+        flight that does not exist yet is created.
+
+        Args:
+            key (tuple): The flight key.
+            reader (pyarrow.flight.MetadataRecordBatchReader): The do_put reader.
+            version (int, optional): The version of a replicated append. Defaults to a new version.
+            primary (str, optional): The location of the producer a replicated append comes from.
+            base_version (int, optional): The version the append must be applied to, for replicas.
+
+        Raises:
+            ValueError: If the schema differs from the flight's other than in the dictionary
+                encoding of string columns, which is converted, the flight is sharded or
+                still uploading, or it is not at `base_version`.
+
+        Returns:
+            FlightEntry: The stored entry.
+        """
+        with self._lock:
+            previous = self._snapshot.entries.get(key)
+        if previous is not None:
+            # string columns are encoded like the flight's, plain strings continuing its dictionaries
+            reader = conform_reader(reader, previous.schema, previous.batches[-1] if previous.batches else None)
+        self._check_append(key, previous, reader.schema, base_version)
+        if previous is None:
+            return self.ingest(key, reader, version=version, primary=primary)
+
+        staged = FlightEntry(reader.schema)
+        try:
+            self._read_into(staged, reader, key)
+            staged.finish()
+            return self._commit_append(key, staged, version, primary, base_version)
+        except Exception:
+            with self._lock:
+                self._release(staged)
+            raise
+
+    def _check_append(self, key, current, schema, base_version=None):
+        name = key_name(key)
+        if base_version is not None and (current is None or current.version != base_version):
+            raise ValueError(f"{name} is at version {current.version if current else None}, "
+                             f"not {base_version}")
+        if current is None:
+            return
+        if current.shards:
+            raise ValueError(f'{name} is sharded, append to its shards separately')
+        if not current.complete:
+            raise ValueError(f'{name} is still uploading, append once its put has completed')
+        if not current.schema.equals(schema):
+            raise ValueError(f'the schema of the append does not match {name}: '
+                             f'{schema} != {current.schema}')
+
+    def _commit_append(self, key, staged, version=None, primary=None, base_version=None):
+        # publishes the flight extended with the staged batches of a completed append
+        with self._lock:
+            # another append may have been committed while this one was read
+            current = self._snapshot.entries.get(key)
+            if current is None:
+                raise ValueError(f'{key_name(key)} was removed during the append')
+            self._check_append(key, current, staged.schema, base_version)
+            entry = current.extended(staged)
+            entry.version = version
+            entry.primary = primary
+            # the staged buffers are now held by the appended entry
+            self._release(staged)
+            entry.released = True
+            self._publish(key, entry)
+        return entry
+
+    def ingest_resumable(self, key, reader, upload_id, acknowledge, append=False, shards=None):
+        """
+        Reads one attempt of a resumable upload, see flight_resume.put_resumable.
+
+        The batches are staged under `upload_id` across attempts, in the order
+        of the sequence numbers they were sent with. A batch the store already
+        holds is skipped, so an attempt may resend batches. The flight is
+        complete, or appended to, once an attempt ends with the number of
+        batches of the upload, see flight_resume.end_metadata. A newer attempt
+        of the upload takes over from an older one still reading, and an
+        upload not resumed for `resume_ttl` seconds is dropped.
+
+        Like ingest, a streaming store publishes the upload when its first
+        attempt starts, and readers see its batches as they arrive, across
+        attempts. An append, and a shard of a sharded flight, are only
+        published once complete: the new shard map must not be seen before
+        every producer holds its shard, see parallel_flight_client.put_shards.
+
+        Args:
+            key (tuple): The flight key.
+            reader (pyarrow.flight.MetadataRecordBatchReader): The do_put reader of this attempt.
+            upload_id (str): The id shared by all attempts of the upload.
+            acknowledge (callable): Called with the number of batches the store holds,
+                before anything is read, and when the client asks for it, see
+                flight_resume.prepare_metadata.
+            append (bool): If True, the batches are appended to the flight, see append.
+            shards (list, optional): The shard map if the upload is one shard of a sharded flight.
+
+        Raises:
+            ValueError: If an attempt skips batches, its schema does not match (see append),
+                or the client aborted the upload.
+
+        Returns:
+            FlightEntry: The stored entry.
+        """
+        now = time.monotonic()
+        with self._lock:
+            upload = self._resumable.setdefault(
+                upload_id, {'key': key, 'append': append, 'entry': None, 'attempt': 0, 'touched': now,
+                            'previous': self._snapshot.entries.get(key), 'published': False})
+            if upload['key'] != key:
+                raise ValueError(f'upload {upload_id} is not an upload of {key_name(key)}')
+            upload['attempt'] += 1
+            upload['touched'] = now
+            attempt = upload['attempt']
+            staged = upload['entry']
+            current = self._snapshot.entries.get(key)
+        acknowledge(len(staged.batches) if staged is not None else 0)
+
+        try:
+            if staged is not None:
+                # the batches of this attempt continue the dictionaries of those staged
+                reader = conform_reader(reader, staged.schema, staged.batches[-1] if staged.batches else None)
+            elif append and current is not None:
+                reader = conform_reader(reader, current.schema, current.batches[-1] if current.batches else None)
+                self._check_append(key, current, reader.schema)
+            elif self.dictionary_encode:
+                reader = DictionaryEncodingReader(reader)
+            with self._lock:
+                if upload['entry'] is None:
+                    upload['entry'] = FlightEntry(reader.schema)
+                    upload['entry'].shards = shards
+                    if self.streaming and shards is None and not (append and current is not None):
+                        self._publish(key, upload['entry'])
+                        upload['published'] = True
+                staged = upload['entry']
+            if not staged.schema.equals(reader.schema):
+                raise ValueError(f'the schema of upload {upload_id} changed between attempts')
+            self._read_sequenced(staged, reader, key, upload, attempt, acknowledge)
+        except (ValueError, StoreFullError) as e:
+            # the client does not resume these
+            with self._lock:
+                self._drop_resumable(upload_id, e)
+            raise
+
+        with self._lock:
+            if upload['attempt'] != attempt:
+                raise IOError(f'upload {upload_id} was resumed by another stream')
+            del self._resumable[upload_id]
+            current = self._snapshot.entries.get(key)
+        staged.finish()
+        if upload['published']:
+            # readers already follow it; persisted only if no other put replaced it meanwhile
+            self._persist(key, staged)
+            return staged
+        if append and current is not None:
+            return self._commit_append(key, staged)
+        with self._lock:
+            self._publish(key, staged)
+        self._persist(key, staged)
+        return staged
+
+    def _read_sequenced(self, entry, reader, key, upload, attempt, acknowledge):
+        # _read_into for resumable uploads, skipping the batches already held
+        end = None
+        while True:
+            try:
+                chunk = reader.read_chunk()
+            except StopIteration:
+                break
+            if chunk.data is None:
+                if upload_abort(chunk.app_metadata) is not None:
+                    raise ValueError(f'upload of {key_name(key)} aborted: {upload_abort(chunk.app_metadata)}')
+                if upload_prepare(chunk.app_metadata) is not None:
+                    acknowledge(len(entry.batches))
+                end = upload_end(chunk.app_metadata)
+                continue
+            sequence = batch_sequence(chunk.app_metadata)
+            index = index_batch(chunk.data) if BATCH_INDEXES else None
+            with self._lock:
+                if upload['attempt'] != attempt:
+                    raise IOError(f'upload of {key_name(key)} was resumed by another stream')
+                upload['touched'] = time.monotonic()
+                held = len(entry.batches)
+                if sequence is not None and sequence < held:
+                    continue
+                if sequence is not None and sequence > held:
+                    raise ValueError(f'upload of {key_name(key)} skipped from batch {held} to {sequence}')
+                if not entry.released:
+                    self._charge(chunk.data.get_total_buffer_size(), key, entry.nbytes,
+                                 None if upload['append'] else upload['previous'])
+                entry.append(chunk.data, index)
+        if end is None or end != len(entry.batches):
+            # the stream broke, the staged batches wait for the upload to be resumed
+            raise IOError(f'upload of {key_name(key)} stopped after {len(entry.batches)} batches')
+
+    def _drop_resumable(self, upload_id, error=None):
+        # must be called with the lock held
+        upload = self._resumable.pop(upload_id, None)
+        if upload is None or upload['entry'] is None:
+            return
+        entry, key = upload['entry'], upload['key']
+        entry.finish(error=error or IOError(f'upload {upload_id} of {key_name(key)} was abandoned'))
+        if self._snapshot.entries.get(key) is entry:
+            # a streaming upload gives way to the flight it replaced, like a failed ingest
+            self._restore(key, upload['previous'])
+        else:
+            self._release(entry)
+
+    def _restore(self, key, previous):
+        # publishes `previous` again in place of the failed upload to `key`, must be called with the lock held
+        self._release(self._snapshot.entries[key])
+        if previous is not None and previous.released:
+            # evicted or released since it was replaced: its bytes are charged again
+            try:
+                self._charge(previous.heap_bytes, key)
+            except StoreFullError as e:
+                log.warning(f'{key_name(key)} is not restored after its failed upload: {e}')
+                previous = None
+            else:
+                previous.released = False
+        if previous is None:
+            self._remove(key)
+        else:
+            self._publish(key, previous)
+
+    def ingest_part(self, key, reader, upload_id, part, parts):
+        """
+        Reads one part of a multi-stream upload.
+
+        The parts are staged without being visible to readers. Once every part
+        has arrived the flight is published in a single step, with the batches
+        in part order; if any part failed the whole upload is dropped. The
+        parts of an upload whose other parts do not arrive within `resume_ttl`
+        seconds are dropped too.
+
+        Args:
+            key (tuple): The flight key.
+            reader (pyarrow.flight.MetadataRecordBatchReader): The do_put reader of this part.
+            upload_id (str): The id shared by all parts of the upload.
+            part (int): The index of this part.
+            parts (int): The total number of parts.
+
+        Returns:
+            FlightEntry: The published entry if this was the last part, otherwise None.
+        """
+        if not 0 <= part < parts:
+            raise ValueError(f"part {part}/{parts} of {key} does not exist")
+        entry = FlightEntry(reader.schema)
+        with self._lock:
+            upload = self._uploads.setdefault(
+                upload_id, {'key': key, 'parts': [None] * parts, 'pending': parts, 'error': None,
+                            'reading': 0, 'touched': time.monotonic()})
+            if upload['key'] != key or len(upload['parts']) != parts:
+                raise ValueError(f"part {part}/{parts} of {key} does not match upload {upload_id}")
+            upload['reading'] += 1
+            previous = self._snapshot.entries.get(key)
+
+        error = None
+        try:
+            self._read_into(entry, reader, key, replaces=previous)
+        except Exception as e:
+            error = e
+        entry.finish(error=error)
+
+        with self._lock:
+            upload['reading'] -= 1
+            upload['touched'] = time.monotonic()
+            if upload['parts'][part] is not None:
+                self._release(upload['parts'][part])
+            upload['parts'][part] = entry
+            upload['pending'] -= 1
+            if error is not None and upload['error'] is None:
+                upload['error'] = error
+            if upload['pending'] > 0:
+                if error is not None:
+                    raise error
+                return None
+            del self._uploads[upload_id]
+
+            if upload['error'] is None and any(p is None for p in upload['parts']):
+                upload['error'] = ValueError(f"upload {upload_id} received a part twice")
+            schema = entry.schema
+            if upload['error'] is None and not all(p.schema.equals(schema) for p in upload['parts']):
+                upload['error'] = ValueError(f"parts of upload {upload_id} have different schemas")
+            if upload['error'] is not None:
+                self._drop_parts(upload_id, upload)
+                if error is not None:
+                    raise error
+                raise IOError(f"upload {upload_id} failed: {upload['error']}")
+
+            assembled = FlightEntry(schema)
+            for part_entry in upload['parts']:
+                for batch, index in zip(part_entry.batches, part_entry.indexes):
+                    assembled.append(batch, index)
+            assembled.finish()
+            # the parts' buffers are now held by the assembled entry
+            for part_entry in upload['parts']:
+                self._release(part_entry)
+            assembled.released = True
+            self._publish(key, assembled)
+        self._persist(key, assembled)
+        return assembled
+
+    def _drop_parts(self, upload_id, upload=None):
+        # must be called with the lock held
+        upload = upload or self._uploads.pop(upload_id)
+        for part_entry in upload['parts']:
+            if part_entry is not None:
+                self._release(part_entry)
+
+    def _read_into(self, entry, reader, key, replaces=None):
+        while True:
+            try:
+                chunk = reader.read_chunk()
+            except StopIteration:
+                break
+            if chunk.data is not None:
+                # indexed before taking the store lock
+                index = index_batch(chunk.data) if BATCH_INDEXES else None
+                with self._lock:
+                    # an entry replaced while it is uploading is no longer counted
+                    if not entry.released:
+                        self._charge(chunk.data.get_total_buffer_size(), key, entry.nbytes, replaces)
+                    entry.append(chunk.data, index)
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+import logging
+
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_query import project_schema, query_batches, subscribe_descriptor
+from flightsvc.controllers.flight_resume import backoff, retry_settings
+from flightsvc.controllers.flight_store import FlightReplacedError
+
+log = logging.getLogger(__name__)
+
+# seconds between two heartbeats of an idle subscription, unless the subscriber asks otherwise
+HEARTBEAT_INTERVAL = float(os.environ.get('FLIGHT_HEARTBEAT_INTERVAL', '5'))
+
+
+def subscription_batches(flights, key, query, context=None):
+    """
+    Yields the batches a producer sends for a subscription ticket, see
+    subscribe_descriptor and FlightStore.follow.
+
+    The projection and filters are applied to every batch as it is
+    appended, and a heartbeat is sent as an empty batch. Batches are pulled
+    by the stream as the subscriber reads them, so gRPC flow control holds
+    back a slow subscriber instead of buffering for it.
+
+    Args:
+        flights (FlightStore): The store holding the flight.
+        key (tuple): The flight key.
+        query (dict): The query of the ticket.
+        context (pyarrow.flight.ServerCallContext, optional): Ends the subscription once cancelled.
+    """
+    entry = flights.get(key)
+    if entry is None:
+        raise KeyError('Flight not found.')
+    heartbeat_batch = pyarrow.RecordBatch.from_pylist([], schema=project_schema(entry.schema,
+                                                                                 query.get('select_fields')))
+    cancelled = context.is_cancelled if context is not None else None
+    for batch in flights.follow(key, query.get('from_row', 0), query.get('heartbeat') or HEARTBEAT_INTERVAL,
+                                cancelled):
+        if batch is None:
+            yield heartbeat_batch
+        else:
+            yield from query_batches([batch], query)
+
+
+def _lineage(info):
+    return json.loads(info.app_metadata or b'{}').get('lineage')
+
+
+def subscribe(resolve, table_name, from_row=0, select_fields=None, filters=None, heartbeat=None,
+              max_retries=None):
+    """
+    Follows a flight: yields its rows from `from_row` and then every batch
+    appended to it, as soon as a producer publishes the append.
+
+    Heartbeats are not yielded. If the stream breaks, e.g. because the
+    producer restarted, the subscription resumes from the last row received,
+    unless the flight has been replaced in the meantime.
+
+    The subscription has its own connection, rather than holding a pooled
+    one for as long as it lasts.
+
+    Args:
+        resolve (callable): Returns the URL of a producer holding the flight. Called again to resume.
+        table_name (str): The name of the flight.
+        from_row (int): The first row to yield.
+        select_fields (list, optional): The columns to return.
+        filters (dict, optional): The row filters, see query_descriptor. A filtered
+            subscription cannot tell which row it stopped at, so it is not resumed.
+        heartbeat (float, optional): The heartbeat interval the producer should use.
+        max_retries (int, optional): The number of consecutive failed attempts to resume,
+            waiting BACKOFF_FACTOR seconds and twice as long after each. Defaults to NUM_RETRIES.
+
+    Raises:
+        FlightReplacedError: If the flight is replaced by a put, rather than appended to.
+
+    Yields:
+        pyarrow.RecordBatch: The rows, in flight order.
+    """
+    retries, factor = retry_settings()
+    if max_retries is not None:
+        retries = max_retries
+    offset, lineage, failures = from_row, None, 0
+    while True:
+        try:
+            with flight.FlightClient(resolve()) as client:
+                info = client.get_flight_info(subscribe_descriptor(table_name, offset, select_fields, filters,
+                                                                   heartbeat))
+                if lineage is not None and _lineage(info) != lineage:
+                    raise FlightReplacedError(f'{table_name} was replaced, subscribe again from row 0')
+                lineage = _lineage(info)
+                reader = client.do_get(info.endpoints[0].ticket)
+                log.info(f'subscribed to {table_name} from row {offset}')
+                while True:
+                    try:
+                        chunk = reader.read_chunk()
+                    except StopIteration:
+                        # the flight was removed
+                        return
+                    failures = 0
+                    if chunk.data is not None and chunk.data.num_rows:
+                        offset += chunk.data.num_rows
+                        yield chunk.data
+        except flight.FlightError as e:
+            failures += 1
+            if filters or failures > retries:
+                raise
+            delay = backoff(failures - 1, factor)
+            log.warning(f'subscription to {table_name} broke at row {offset}, resuming in {delay:.1f} seconds: '
+                        f'{str(e).splitlines()[0]}')
+            time.sleep(delay)
@@ -0,0 +1,58 @@
+import json
+import os
+import logging
+
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_metrics import local_servers, prometheus_document, prometheus_text
+from flightsvc.controllers.flight_pool import default_pool, normalize_url
+from flightsvc.controllers.flight_registry import get_router
+
+log = logging.getLogger(__name__)
+
+# seconds to wait for the stats of a remote server
+STATS_TIMEOUT = 2.0
+
+
+def metric_targets():
+    """
+    Returns the Flight URLs of the remote servers to collect stats from: the
+    comma separated FLIGHT_METRICS_URLS plus the producers registered in ZooKeeper.
+    """
+    urls = [url.strip() for url in os.environ.get('FLIGHT_METRICS_URLS', '').split(',') if url.strip()]
+    router = get_router()
+    if router is not None:
+        urls += [info['location'] for info in router.producers()]
+    return urls
+
+
+def remote_stats(url):
+    options = flight.FlightCallOptions(timeout=STATS_TIMEOUT)
+    with default_pool.connection(url, timeout=STATS_TIMEOUT) as client:
+        results = list(client.do_action(flight.Action('stats', b''), options=options))
+    return json.loads(results[0].body.to_pybytes())
+
+
+def get_metrics():
+    """
+    Exports the metrics of the Flight servers of this process and of the
+    remote servers in the Prometheus text format.
+    """
+    lines = []
+    seen = set()
+    for server in list(local_servers):
+        location = server._location().uri.decode()
+        seen.add(normalize_url(location))
+        lines += prometheus_text(server.stats(), {'server': location})
+        lines.append(f'flight_up{{server="{location}"}} 1')
+    for url in metric_targets():
+        if normalize_url(url) in seen:
+            continue
+        seen.add(normalize_url(url))
+        try:
+            lines += prometheus_text(remote_stats(url), {'server': url})
+            lines.append(f'flight_up{{server="{url}"}} 1')
+        except Exception as e:
+            log.warning(f'could not collect stats from {url}: {e}')
+            lines.append(f'flight_up{{server="{url}"}} 0')
+    return prometheus_document(lines), 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -1,10 +1,12 @@
 import pyarrow
 import pyarrow.flight as flight
 import argparse
-import ast
+import json
+import os
 import threading
 import multiprocessing
 import platform
+import socket
 import time
 import logging
 
@@ -12,6 +14,22 @@ from kazoo.client import KazooClient
 from kazoo.retry import KazooRetry
 from kazoo.handlers.threading import KazooTimeoutError
 
+from flightsvc.controllers.flight_admission import AdmissionController, AdmittedReader, client_id, release_on_completion
+from flightsvc.controllers.flight_compression import available_codecs, ticket_options
+from flightsvc.controllers.flight_compute import run_compute
+from flightsvc.controllers.flight_dictionary import DICTIONARY_ENCODE
+from flightsvc.controllers.flight_index import batch_filter, overlapping
+from flightsvc.controllers.flight_metrics import (MIDDLEWARE_KEY, FlightMetrics, MetricsMiddlewareFactory,
+                                                  call_metrics, counted_batches, counted_reader, local_servers)
+from flightsvc.controllers.flight_query import (decode_ticket, encode_ticket, parse_descriptor,
+                                                project_schema, query_batches, row_ranges)
+from flightsvc.controllers.flight_shards import shard_endpoints
+from flightsvc.controllers.flight_registry import FlightRouter, ProducerRegistration
+from flightsvc.controllers.flight_replication import FlightReplicator, check_version, put_result
+from flightsvc.controllers.flight_resume import resume_metadata, skip_rows
+from flightsvc.controllers.flight_store import COMPACT_INTERVAL, FlightStore, key_name, parse_criteria
+from flightsvc.controllers.flight_subscribe import subscription_batches
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
@@ -28,15 +46,45 @@ log = logging.getLogger(__name__)
 class FlightServer(flight.FlightServerBase):
     def __init__(self, host="localhost", location=None,
                  tls_certificates=None, verify_client=False,
-                 root_certificates=None, auth_handler=None, registry_address=None):
+                 root_certificates=None, auth_handler=None, registry_address=None,
+                 streaming_ingest=True, partition_rows=1000000, memory_limit=None, flight_ttl=None,
+                 data_dir=None, producer_group='default', replicas=0, replica_locations=None,
+                 compact_interval=COMPACT_INTERVAL,
+                 dictionary_encode=DICTIONARY_ENCODE, admission=None, advertised_host=None):
+        # per-method call, byte, row and latency metrics, see the stats action
+        self.metrics = FlightMetrics()
         super(FlightServer, self).__init__(
             location, auth_handler, tls_certificates, verify_client,
-            root_certificates)
+            root_certificates, middleware={MIDDLEWARE_KEY: MetricsMiddlewareFactory(self.metrics)})
+        local_servers.add(self)
         # self.flights = {"get_test_data": test_data}
-        self.flights = {}
+        self.flights = FlightStore(streaming=streaming_ingest, memory_limit=memory_limit, ttl=flight_ttl,
+                                   data_dir=data_dir, compact_interval=compact_interval,
+                                   dictionary_encode=dictionary_encode)
         self.host = host
+        # the host other processes reach this producer at, registered and returned in endpoints
+        self.advertised_host = advertised_host
         self.tls_certificates = tls_certificates
+        self._flight_location = None
+        # caps the concurrent streams and the bytes uploads hold, and paces reads, see flight_admission
+        self.admission = admission or AdmissionController()
+        # rows per endpoint when a client does not ask for a partition count
+        self.partition_rows = partition_rows
         self.registry_address = registry_address
+        self.zk = None
+        self.registration = None
+        # destination name clients route to, see flight_registry.FlightRouter
+        self.producer_group = producer_group
+        self.puts_in_progress = 0
+        self.requests_since_update = 0
+        # the load counters are updated by the handler threads and read by the registration
+        self._load_lock = threading.Lock()
+        # number of peers every committed flight is copied to, picked from
+        # replica_locations or else from the producers registered in the same group
+        self.replicas = replicas
+        self.replica_locations = replica_locations
+        self.router = None
+        self.replicator = None
 
     def connect_to_zookeeper(self):
         try:
@@ -60,77 +108,306 @@ class FlightServer(flight.FlightServerBase):
             import traceback
             log.error(traceback.format_exc())
 
+    def register_producer(self, interval=5):
+        """
+        Registers this producer in ZooKeeper so clients can discover it.
+        """
+        if self.zk is None or not self.zk.connected:
+            log.error(f'not registering producer {self._location().uri.decode()}: no zookeeper connection')
+            return
+        self.registration = ProducerRegistration(self.zk, self._producer_info, interval)
+        self.registration.start()
+        if self.replicas and not self.replica_locations:
+            self.router = FlightRouter(self.zk)
+
+    def _replica_peers(self):
+        location = self._location().uri.decode()
+        if self.replica_locations:
+            peers = [peer for peer in self.replica_locations if peer != location]
+        elif self.router is not None:
+            producers = sorted(self.router.producers(self.producer_group), key=lambda info: info.get('load', 0))
+            peers = [info['location'] for info in producers if info['location'] != location]
+        else:
+            peers = []
+        return peers[:self.replicas]
+
+    def _replicate(self, key, entry):
+        # path keys and shards are not replicated, a shard map pins each shard to its producer
+        if not self.replicas or entry.primary or entry.shards or key[1] is None or entry.error is not None:
+            return
+        peers = self._replica_peers()
+        if not peers:
+            log.warning(f'no peers to replicate {key} to')
+            return
+        if self.replicator is None:
+            self.replicator = FlightReplicator(self._location().uri.decode(), max_workers=self.replicas)
+        self.replicator.replicate(key, entry, peers)
+
+    def _producer_info(self):
+        # load is the number of running puts plus the requests since the last update and those waiting
+        with self._load_lock:
+            load = self.puts_in_progress + self.requests_since_update
+            self.requests_since_update = 0
+        load += sum(self.admission.snapshot()['queued'].values())
+        usage = self.flights.usage()
+        return {
+            'location': self._location().uri.decode(),
+            'group': self.producer_group,
+            'load': load,
+            'flights': usage['flights'],
+            'used_bytes': usage['used_bytes'],
+            'keys': [key_name(key) for key, _ in self.flights.list()],
+        }
+
     @classmethod
     def descriptor_to_key(self, descriptor):
-        return (descriptor.descriptor_type.value, descriptor.command,
-                tuple(descriptor.path or tuple()))
-
-    def _make_flight_info(self, key, descriptor, table):
-        if self.tls_certificates:
-            location = pyarrow.flight.Location.for_grpc_tls(
-                self.host, self.port
-            )
+        key, _ = parse_descriptor(descriptor)
+        return key
+
+    def _location(self):
+        if self._flight_location is None:
+            host = self.advertised_host or self.host
+            if self.tls_certificates:
+                self._flight_location = pyarrow.flight.Location.for_grpc_tls(
+                    host, self.port
+                )
+            else:
+                self._flight_location = pyarrow.flight.Location.for_grpc_tcp(
+                    host, self.port
+                )
+        return self._flight_location
+
+    def _count_request(self):
+        with self._load_lock:
+            self.requests_since_update += 1
+
+    def _make_flight_info(self, key, descriptor, entry, query=None):
+        # schema, row count and size are maintained by the store on put,
+        # so building the info never touches the stored data
+        query = dict(query or {})
+        if entry.shards and query.get('subscribe'):
+            raise ValueError(f'{key_name(key)} is sharded, subscribe to its shards separately')
+        if entry.shards:
+            # a shard of a sharded flight describes every shard, so clients read them all in parallel
+            return self._make_sharded_flight_info(key, descriptor, entry, query)
+        partitions = query.pop('partitions', None)
+        if query.get('subscribe'):
+            # a live tail is a single stream that does not end
+            partitions = 1
+        elif partitions is None and self.partition_rows:
+            partitions = -(-entry.num_rows // self.partition_rows)
+        # tickets are pinned to this version, and every endpoint lists the
+        # replicas that hold it, so clients spread their reads across them
+        query['version'] = entry.version
+        locations = [self._location()] + [pyarrow.flight.Location(location)
+                                          for location in list(entry.replicas) + [entry.primary] if location]
+        # the batch indexes tell which rows may match the filters, so ranges
+        # without any get no endpoint, and a flight without any gets none at all
+        spans = None if query.get('subscribe') else entry.matching_spans(
+            batch_filter(entry.schema, query.get('filters')))
+        if spans == []:
+            endpoints = []
+        elif partitions and partitions > 1 and entry.complete:
+            # one row range endpoint per partition, so clients can read them in parallel
+            endpoints = [pyarrow.flight.FlightEndpoint(encode_ticket(key, {**query, 'row_range': row_range}),
+                                                       locations)
+                         for row_range in overlapping(row_ranges(entry.num_rows, partitions), spans)]
         else:
-            location = pyarrow.flight.Location.for_grpc_tcp(
-                self.host, self.port
-            )
-        endpoints = [pyarrow.flight.FlightEndpoint(repr(key), [location]), ]
-
-        mock_sink = pyarrow.MockOutputStream()
-        stream_writer = pyarrow.RecordBatchStreamWriter(
-            mock_sink, table.schema)
-        stream_writer.write_table(table)
-        stream_writer.close()
-        data_size = mock_sink.size()
-
-        return pyarrow.flight.FlightInfo(table.schema,
+            endpoints = [pyarrow.flight.FlightEndpoint(encode_ticket(key, query), locations), ]
+
+        schema, num_rows, data_size = entry.schema, entry.num_rows, entry.data_size
+        if query.get('select_fields') or query.get('filters') or query.get('subscribe'):
+            # the size of a projected, filtered or live stream is not known up front
+            schema = project_schema(schema, query.get('select_fields'))
+            num_rows = -1 if query.get('filters') or query.get('subscribe') else num_rows
+            data_size = -1
+        if spans == []:
+            num_rows, data_size = 0, 0
+
+        return pyarrow.flight.FlightInfo(schema,
                                          descriptor, endpoints,
-                                         table.num_rows, data_size)
+                                         num_rows, data_size,
+                                         app_metadata=json.dumps({'version': entry.version,
+                                                                  'lineage': entry.lineage,
+                                                                  'index_bytes': entry.index_bytes}))
+
+    def _make_sharded_flight_info(self, key, descriptor, entry, query):
+        endpoints = shard_endpoints(key, query, entry.shards, self.partition_rows)
+        schema = project_schema(entry.schema, query.get('select_fields'))
+        num_rows = -1 if query.get('filters') else sum(shard['num_rows'] for shard in entry.shards)
+        # the other shards' sizes are not known here
+        return pyarrow.flight.FlightInfo(schema, descriptor, endpoints, num_rows, -1)
 
     def list_flights(self, context, criteria):
-        for key, table in self.flights.items():
+        prefix, after, limit = parse_criteria(criteria)
+        for key, entry in self.flights.list(prefix, after, limit):
             if key[1] is not None:
                 descriptor = pyarrow.flight.FlightDescriptor.for_command(key[1])
             else:
                 descriptor = pyarrow.flight.FlightDescriptor.for_path(*key[2])
 
-            yield self._make_flight_info(key, descriptor, table)
+            yield self._make_flight_info(key, descriptor, entry)
 
     def get_flight_info(self, context, descriptor):
-        key = FlightServer.descriptor_to_key(descriptor)
-        if key in self.flights:
-            table = self.flights[key]
-            return self._make_flight_info(key, descriptor, table)
+        key, query = parse_descriptor(descriptor)
+        entry = self.flights.get(key)
+        if entry is not None:
+            # a replica behind the version the client has written refuses to describe the flight
+            check_version(key, entry, min_version=query.pop('min_version', None))
+            return self._make_flight_info(key, descriptor, entry, query)
         raise KeyError('Flight not found.')
 
     def do_put(self, context, descriptor, reader, writer):
-        key = FlightServer.descriptor_to_key(descriptor)
-        log.info(f'adding key: {key}')
-        self.flights[key] = reader.read_all()
-        log.info(f'{key} has {self.flights[key].num_rows} rows and {self.flights[key].num_columns} columns')
+        self._count_request()
+        # waits for a slot, or raises FlightUnavailableError for the client to retry
+        slot = self.admission.admit('do_put', client_id(context))
+        with self._load_lock:
+            self.puts_in_progress += 1
+        try:
+            key, entry = self._do_put(descriptor, AdmittedReader(counted_reader(reader, call_metrics(context)), slot),
+                                      writer)
+        finally:
+            with self._load_lock:
+                self.puts_in_progress -= 1
+            slot.release()
+        if entry is not None:
+            # send the version back, so the client can ask for it when reading
+            writer.write(put_result(entry))
+            self._replicate(key, entry)
+
+    def _do_put(self, descriptor, reader, writer):
+        key, query = parse_descriptor(descriptor)
+        if query.get('resumable'):
+            # one attempt of a resumable upload, told how many batches are already held
+            log.info(f"adding key: {key}, upload {query['upload_id']}")
+            entry = self.flights.ingest_resumable(key, reader, query['upload_id'],
+                                                  lambda held: writer.write(resume_metadata(held)),
+                                                  append=query.get('append', False), shards=query.get('shards'))
+        elif 'upload_id' in query:
+            # one part of a multi-stream upload, published once all parts arrived
+            log.info(f"adding part {query['part'] + 1}/{query['parts']} of key: {key}")
+            entry = self.flights.ingest_part(key, reader, query['upload_id'], query['part'], query['parts'])
+            if entry is None:
+                return key, None
+        elif query.get('append'):
+            # a replicated append is only applied on top of the version it was appended to
+            log.info(f"appending to key: {key}" + (f" from {query['primary']}" if 'primary' in query else ''))
+            entry = self.flights.append(key, reader, version=query.get('version'), primary=query.get('primary'),
+                                        base_version=query.get('base_version'))
+        elif 'primary' in query:
+            log.info(f"adding replica of key: {key} from {query['primary']}")
+            entry = self.flights.ingest(key, reader, version=query['version'], primary=query['primary'])
+        elif 'shards' in query:
+            log.info(f"adding shard {query['shard'] + 1}/{len(query['shards'])} of key: {key}")
+            entry = self.flights.ingest(key, reader, shards=query['shards'])
+        else:
+            log.info(f'adding key: {key}')
+            entry = self.flights.ingest(key, reader)
+        log.info(f'{key} has {entry.num_rows} rows and {len(entry.schema)} columns')
+        return key, entry
+
+    def stats(self):
+        return {**self.metrics.snapshot(), 'store': self.flights.usage(), 'admission': self.admission.snapshot()}
 
     def do_get(self, context, ticket):
-        key = ast.literal_eval(ticket.ticket.decode())
-        if key not in self.flights:
-            return None
-        return pyarrow.flight.RecordBatchStream(self.flights[key])
+        self._count_request()
+        key, query = decode_ticket(ticket)
+        # the version the ticket was issued for, even if the flight has been replaced since
+        entry = self.flights.get(key, query.get('version'))
+        if entry is None:
+            raise KeyError('Flight not found.')
+        call = call_metrics(context)
+        # the slot is held until the last batch has been sent
+        release_on_completion(self.admission.admit('subscribe' if query.get('subscribe') else 'do_get',
+                                                   client_id(context)), call)
+        if query.get('subscribe'):
+            # a live tail follows the flight from version to version, see flight_subscribe
+            reader = pyarrow.RecordBatchReader.from_batches(
+                project_schema(entry.schema, query.get('select_fields')),
+                counted_batches(subscription_batches(self.flights, key, query, context), call))
+            return pyarrow.flight.RecordBatchStream(reader, options=ticket_options(query))
+        check_version(key, entry, query.get('version'))
+        row_range = query.get('row_range')
+        # the rows a resumed read has already received, see flight_resume.get_resumable
+        skipped = query.get('skip_rows', 0)
+        options = ticket_options(query, entry.batches[0] if entry.batches else None)
+        if query.get('select_fields') or query.get('filters'):
+            # projection and filters are evaluated here, before anything is sent
+            schema = project_schema(entry.schema, query.get('select_fields'))
+            # batches whose index rules out the filters are skipped unread
+            keep = batch_filter(entry.schema, query.get('filters'))
+            batches = entry.iter_rows(*row_range, keep=keep) if row_range else entry.iter_batches(keep=keep)
+            # a lazy reader rather than a GeneratorStream, which does not send dictionaries
+            batches = skip_rows(query_batches(batches, query), skipped)
+            reader = pyarrow.RecordBatchReader.from_batches(schema,
+                                                            self.admission.throttled(counted_batches(batches, call)))
+            return pyarrow.flight.RecordBatchStream(reader, options=options)
+        if entry.complete:
+            table = entry.to_table()
+            if row_range:
+                table = table.slice(row_range[0], row_range[1] - row_range[0])
+            table = table.slice(skipped)
+            # sent batch by batch, as fast as the egress budget allows, and counted once sent
+            reader = pyarrow.RecordBatchReader.from_batches(
+                table.schema, self.admission.throttled(counted_batches(table.to_batches(), call)))
+            return pyarrow.flight.RecordBatchStream(reader, options=options)
+        # still uploading: serve the committed batches and follow the rest
+        batches = skip_rows(entry.iter_rows(*row_range) if row_range else entry.iter_batches(), skipped)
+        reader = pyarrow.RecordBatchReader.from_batches(entry.schema,
+                                                        self.admission.throttled(counted_batches(batches, call)))
+        return pyarrow.flight.RecordBatchStream(reader, options=options)
+
+    def do_exchange(self, context, descriptor, reader, writer):
+        # server-side compute, only the result is sent back, see flight_compute.compute_descriptor
+        self._count_request()
+        key, query = parse_descriptor(descriptor)
+        if 'compute' not in query:
+            raise ValueError('do_exchange expects a compute descriptor')
+        call = call_metrics(context)
+        slot = self.admission.admit('do_exchange', client_id(context))
+        try:
+            result = run_compute(self.flights, key, query, AdmittedReader(counted_reader(reader, call), slot))
+            writer.begin(result.schema)
+            for batch in counted_batches(result.to_batches(), call):
+                writer.write_batch(batch)
+        finally:
+            slot.release()
 
     def list_actions(self, context):
         return [
-            ("clear", "Clear the stored flights."),
+            ("clear", "Clear the stored flights, or those whose name starts with the action body."),
+            ("usage", "Report the memory used by the stored flights."),
+            ("stats", "Report the per-method call metrics, store usage and admission control counters."),
+            ("compact", "Merge the batches appended to the flights, or to the flight named in the action body."),
+            ("codecs", "List the IPC compression codecs this server supports."),
             ("shutdown", "Shut down this server."),
         ]
 
     def do_action(self, context, action):
         if action.type == "clear":
-            raise NotImplementedError(
-                "{} is not implemented.".format(action.type))
+            prefix = action.body.to_pybytes().decode() or None
+            cleared, released = self.flights.clear(prefix)
+            yield pyarrow.flight.Result(pyarrow.py_buffer(
+                json.dumps({'cleared': cleared, 'released_bytes': released}).encode()))
+        elif action.type == "usage":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(self.flights.usage()).encode()))
+        elif action.type == "stats":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(self.stats()).encode()))
+        elif action.type == "compact":
+            name = action.body.to_pybytes().decode()
+            key = self.descriptor_to_key(pyarrow.flight.FlightDescriptor.for_command(name)) if name else None
+            yield pyarrow.flight.Result(pyarrow.py_buffer(
+                json.dumps({'compacted': self.flights.compact(key)}).encode()))
+        elif action.type == "codecs":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(available_codecs()).encode()))
         elif action.type == "healthcheck":
             pass
         elif action.type == "shutdown":
             yield pyarrow.flight.Result(pyarrow.py_buffer(b'Shutdown!'))
             # Shut down on background thread to avoid blocking current
             # request
+            if self.registration is not None:
+                self.registration.stop()
             threading.Thread(target=self._shutdown).start()
         else:
             raise KeyError("Unknown action {!r}".format(action.type))
@@ -142,9 +419,33 @@ class FlightServer(flight.FlightServerBase):
         self.shutdown()
 
 
+def flight_data_dir(name):
+    # each server persists its flights in its own directory under FLIGHT_DATA_DIR
+    data_dir = os.environ.get('FLIGHT_DATA_DIR')
+    return os.path.join(data_dir, name) if data_dir else None
+
+
+def advertised_host(location):
+    """
+    Returns the host a producer listening on `location` registers itself at:
+    FLIGHT_ADVERTISED_HOST if set, else the host of the location unless it
+    listens on every interface, where the host name of the machine is used.
+    """
+    host = location.split('://', 1)[-1].rsplit(':', 1)[0]
+    if os.environ.get('FLIGHT_ADVERTISED_HOST'):
+        return os.environ['FLIGHT_ADVERTISED_HOST']
+    return socket.gethostname() if host in ('0.0.0.0', '[::]', '') else host
+
+
 def start_producer(location, registry_address):
-    server = FlightServer(location=location, registry_address=registry_address)
+    port = location.rsplit(':', 1)[-1]
+    server = FlightServer(location=location, registry_address=registry_address,
+                          data_dir=flight_data_dir(f'producer_{port}'),
+                          producer_group=os.environ.get('FLIGHT_PRODUCER_GROUP', 'default'),
+                          replicas=int(os.environ.get('FLIGHT_REPLICAS', 0)),
+                          advertised_host=advertised_host(location))
     server.connect_to_zookeeper()
+    server.register_producer()
 
     log.info(f'starting producer: {location}')
     server.serve()
@@ -157,6 +458,10 @@ def start_producer(location, registry_address):
 
 
 
+# producer processes started by start_producers, by location
+producer_processes = {}
+
+
 def start_producers(**kwargs):
     try:
         parser = argparse.ArgumentParser()
@@ -170,7 +475,8 @@ def start_producers(**kwargs):
         parser.add_argument("--verify_client", type=bool, default=False,
                             help="enable mutual TLS and verify the client if True")
 
-        args = parser.parse_args()
+        # called from the API process too, whose command line has other arguments
+        args, _ = parser.parse_known_args()
         args.host = kwargs.get("host", args.host)
         args.port = kwargs.get("port", args.port)
 
@@ -214,14 +520,20 @@ def start_producers(**kwargs):
             ]
 
 
-        # start producers
-        start_producer(producer_locations[0], registry_address)
-        #
-        # processes = []
-        # for pl in producer_locations:
-        #     p = multiprocessing.Process(target=start_producer, args=(pl, registry_address))
-        #     processes.append(p)
-        #     p.start()
+        # a comma separated list of locations overrides the defaults, e.g. to run a sharded fleet
+        if os.environ.get('FLIGHT_PRODUCER_LOCATIONS'):
+            producer_locations = [pl.strip() for pl in os.environ['FLIGHT_PRODUCER_LOCATIONS'].split(',')]
+
+        # start producers, one process each, skipping those already running
+        started = []
+        for pl in producer_locations:
+            p = producer_processes.get(pl)
+            if p is not None and p.is_alive():
+                continue
+            p = multiprocessing.Process(target=start_producer, args=(pl, registry_address))
+            producer_processes[pl] = p
+            p.start()
+            started.append(pl)
 
 
         # # start flight server
@@ -232,13 +544,18 @@ def start_producers(**kwargs):
         # rpc_server = FlightServer(args.host, location, tls_certificates=tls_certificates, verify_client=args.verify_client)
         # rpc_server.serve()
 
-        return {f"started producers: {producer_locations}"}, 200
+        return {"started": started, "running": [pl for pl, p in producer_processes.items() if p.is_alive()]}, 200
     except Exception as e:
         import traceback
         log.error(traceback.format_exc())
         return {"error": str(e)}, 500
 
 
+def instantiate_producers():
+    # handler of GET /instantiate_producers/, safe to call again: running producers are left alone
+    return start_producers()
+
+
 def start_server(**kwargs):
     try:
         parser = argparse.ArgumentParser()
@@ -270,7 +587,8 @@ def start_server(**kwargs):
 
         # start flight server
         rpc_server = FlightServer(args.host, location, tls_certificates=tls_certificates,
-                                  verify_client=args.verify_client)
+                                  verify_client=args.verify_client,
+                                  data_dir=flight_data_dir(f'server_{args.port}'))
         log.info(f'starting server: {location}')
         rpc_server.serve()
 
@@ -1,11 +1,24 @@
 import os
 import pyarrow
 from dotenv import load_dotenv
-from sys import getsizeof
 import pyarrow.flight as flight
 import timeit
 import logging
 
+from flightsvc.controllers.flight_async import run_transmit, run_transmits
+from flightsvc.controllers.flight_compression import compression_setting, negotiate, wire_estimate, write_options
+from flightsvc.controllers.flight_compute import compute_descriptor, exchange
+from flightsvc.controllers.flight_dictionary import (DICTIONARY_ENCODE, EncodedStream, decode_dictionaries,
+                                                     dictionary_encode)
+from flightsvc.controllers.flight_http import get_stream, put_stream, rest_codec, rest_url
+from flightsvc.controllers.flight_pool import default_pool
+from flightsvc.controllers.flight_query import query_descriptor
+from flightsvc.controllers.flight_registry import call_with_failover, get_router
+from flightsvc.controllers.flight_resume import put_resumable
+from flightsvc.controllers.flight_subscribe import subscribe
+from flightsvc.controllers.parallel_flight_client import fetch_endpoints, put_parts, put_shards
+from flightsvc.controllers.synthetic_data import stock_prices
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 load_dotenv()
@@ -14,10 +27,19 @@ load_dotenv()
 class DataTransmitter:
     """
     Class for transmitting data using various methods.
+
+    Args:
+        pool (FlightClientPool, optional): The pool Flight connections are borrowed from.
+            Defaults to the shared process wide pool.
+        executor (concurrent.futures.Executor, optional): The executor the async transmits
+            run on. Defaults to the shared executor of FLIGHT_TRANSMIT_WORKERS threads.
     """
 
-    def __init__(self):
+    def __init__(self, pool=None, executor=None):
         self.valid_transmit_methods = ['REST', 'FLIGHT']
+        self.pool = pool or default_pool
+        self.executor = executor
+        self.destination_urls = {}
 
     def transmit(self, transmit_method, payload, head=None):
         """
@@ -42,59 +64,463 @@ class DataTransmitter:
         elif transmit_method == 'FLIGHT':
             return self.transmit_flight(payload, head)
 
-    def transmit_rest(self, payload, head):
+    async def transmit_async(self, transmit_method, payload, head=None):
         """
-        Transmits data using the REST method.
+        Transmits data like `transmit`, without blocking the event loop.
+
+        The transmit runs on a thread of the bounded executor, so an ASGI server
+        keeps serving requests while tables are written. The payload's `batches`
+        may be an async iterable of record batches, with its schema as the
+        iterable's `schema` attribute or the payload's `schema`.
 
         Args:
+            transmit_method (str): The transmission method ('REST' or 'FLIGHT').
             payload (dict): The data to be transmitted.
             head (dict, optional): Additional headers for the transmission. Defaults to None.
 
+        Raises:
+            ValueError: If the transmit method is invalid.
+
         Returns:
             The result of the transmission.
         """
-        return payload
+        if transmit_method not in self.valid_transmit_methods:
+            raise ValueError(f"Invalid transmit method: {transmit_method}")
+        report = await run_transmit(lambda payload, head: self.transmit(transmit_method, payload, head),
+                                    payload, head, self.executor)
+        if report['error'] is not None:
+            raise report['error']
+        return report['result']
 
-    def transmit_flight(self, payload, head):
+    async def transmit_many(self, transmit_method, payloads, head=None):
         """
-        Transmits data using the Flight method.
+        Transmits many tables concurrently, see transmit_async.
+
+        At most as many transmits run at once as the executor has workers, and
+        a failed transmit does not cancel the others.
+
+        Args:
+            transmit_method (str): The transmission method ('REST' or 'FLIGHT').
+            payloads (list): The payload of every table.
+            head (dict, optional): Additional headers for the transmissions. Defaults to None.
+
+        Raises:
+            ValueError: If the transmit method is invalid.
+
+        Returns:
+            list: One dict per payload, in payload order, with the table_name and
+                destination, the `result` of the transmission, the `error` it raised
+                or None, and the `queued_seconds` and `seconds` it took.
+        """
+        if transmit_method not in self.valid_transmit_methods:
+            raise ValueError(f"Invalid transmit method: {transmit_method}")
+        return await run_transmits(lambda payload, head: self.transmit(transmit_method, payload, head),
+                                   payloads, head, self.executor)
+
+    def transmit_rest(self, payload, head):
+        """
+        Transmits data using the REST method.
+
+        The `table` (or the `batches` source, see transmit_flight) is streamed to
+        the REST API of the destination as a chunked Arrow IPC body, for clients
+        that cannot reach the producers over gRPC. The API URL comes from the
+        REST_URL_<DESTINATION> environment variable.
 
         Args:
             payload (dict): The data to be transmitted.
-            head (dict, optional): Additional headers for the transmission. Defaults to None.
+            head (dict, optional): Additional HTTP headers, e.g. Authorization. Defaults to None.
 
         Raises:
-            ValueError: If the destination is invalid or the environment variable for FLIGHT_URL is not defined.
+            ValueError: If the environment variable for REST_URL is not defined.
 
         Returns:
-            None
+            int: The version of the stored flight.
         """
         destination = payload.get('destination', None)
         table_name = payload.get('table_name', None)
-        table_metadata = payload.get('table_metadata', None)
         table = payload.get('table', None)
+        batches = payload.get('batches', None)
+        batch_size = payload.get('batch_size', None)
+        table_metadata = payload.get('table_metadata', None) or {}
+        append = payload.get('append', False) or table_metadata.get('append', False)
+
+        url = rest_url(destination)
+        compression = payload.get('compression') or compression_setting(destination)
+        codec = rest_codec(url, compression, table)
+        if batches is None:
+            schema, batches = table.schema, table.to_batches(max_chunksize=batch_size)
+        else:
+            schema = batches.schema
+
+        sent = {'rows': 0, 'nbytes': 0, 'first': None}
+
+        def counted():
+            for batch in batches:
+                sent['rows'] += batch.num_rows
+                sent['nbytes'] += batch.nbytes
+                sent['first'] = sent['first'] or batch
+                yield batch
+
+        tic_write = timeit.default_timer()
+        result = put_stream(url, table_name, schema, counted(), codec, head, destination, append)
+        toc_write = timeit.default_timer()
+        log.info(
+            f'table of: {sent["rows"]} rows, {len(schema)} cols, '
+            f'{sent["nbytes"] / 1024 / 1024:.5f} MB transmitted over HTTP in {(toc_write - tic_write):.2f} seconds '
+            f'({sent["nbytes"] / 1024 / 1024 / (toc_write - tic_write):.2f} MB/s, {codec or "uncompressed"})')
+        return result.get('version')
+
+    def fetch_rest(self, payload, head=None):
+        """
+        Retrieves a table using the REST method, see fetch_flight.
+
+        The table arrives as an Arrow IPC stream and is decoded while it is
+        downloaded. The projection and filters are applied by the server.
+
+        Args:
+            payload (dict): The destination, table_name and optional table_metadata.
+            head (dict, optional): Additional HTTP headers, e.g. Authorization. Defaults to None.
+
+        Raises:
+            ValueError: If the environment variable for REST_URL is not defined.
+
+        Returns:
+            pyarrow.Table: The retrieved table.
+        """
+        destination = payload.get('destination', None)
+        table_name = payload.get('table_name', None)
+        table_metadata = payload.get('table_metadata', None) or {}
+
+        url = rest_url(destination)
+        compression = payload.get('compression') or compression_setting(destination)
+        codec = rest_codec(url, compression)
+
+        tic_read = timeit.default_timer()
+        table = get_stream(url, table_name, table_metadata.get('select_fields'), table_metadata.get('filters'),
+                           payload.get('min_version'), codec, head, destination)
+        toc_read = timeit.default_timer()
+        log.info(
+            f'table of: {table.num_rows} rows, {table.num_columns} cols '
+            f'retrieved over HTTP in {(toc_read - tic_read):.2f} seconds ({codec or "uncompressed"})')
+        return table
+
+    def resolve_destination(self, destination, table_name=None):
+        """
+        Resolves the Flight URL of a destination.
+
+        If ZOOKEEPER_HOST is set, the least loaded producer registered under the
+        destination name is returned, preferring producers that hold `table_name`.
+        Otherwise the URL comes from the FLIGHT_URL_<DESTINATION> environment
+        variable, cached per destination.
+
+        Args:
+            destination (str): The destination name.
+            table_name (str, optional): The flight about to be read.
+
+        Raises:
+            ValueError: If the environment variable for the destination is not defined.
+
+        Returns:
+            str: The Flight URL.
+        """
+        router = get_router()
+        if router is not None:
+            destination_url = router.route(destination, table_name)
+            if destination_url:
+                return destination_url
+
+        destination_url = self.destination_urls.get(destination)
+        if destination_url:
+            return destination_url
 
         destination_url = os.environ.get(f'FLIGHT_URL_{destination.upper()}', None)
 
         if not destination_url:
             raise ValueError(f"Invalid destination, please define environment variable for FLIGHT_URL_{destination.upper()}")
+        self.destination_urls[destination] = destination_url
+        return destination_url
+
+    def resolve_shard_locations(self, destination, shards):
+        """
+        Resolves the Flight URLs of the producers a flight is sharded across.
+
+        These are the producers registered under the destination name if
+        ZOOKEEPER_HOST is set, otherwise the comma separated URLs of the
+        FLIGHT_SHARD_URLS_<DESTINATION> environment variable.
+
+        Args:
+            destination (str): The destination name.
+            shards (int): The number of shards.
+
+        Raises:
+            ValueError: If the destination has fewer producers than shards.
+
+        Returns:
+            list: The Flight URL of each shard.
+        """
+        router = get_router()
+        if router is not None:
+            locations = sorted(info['location'] for info in router.producers(destination))
+        else:
+            urls = os.environ.get(f'FLIGHT_SHARD_URLS_{destination.upper()}', '')
+            locations = [url.strip() for url in urls.split(',') if url.strip()]
+        if len(locations) < shards:
+            raise ValueError(f"{shards} shards requested but {destination} has {len(locations)} producers, "
+                             f"register more producers or define FLIGHT_SHARD_URLS_{destination.upper()}")
+        return locations[:shards]
+
+    def transmit_flight(self, payload, head):
+        """
+        Transmits data using the Flight method.
+
+        If the payload sets `parts` above 1, the table is uploaded as that many
+        concurrent streams which the server assembles into one flight. The IPC
+        compression is negotiated with the server from the payload's `compression`
+        or the FLIGHT_COMPRESSION_<DESTINATION> setting (none, adaptive, lz4, zstd).
+
+        If the payload sets `shards` above 1, the table is split by its `shard_by`
+        column (`shard_method` 'hash' or 'range'), or into contiguous row ranges,
+        and each shard is sent to its own producer, see resolve_shard_locations.
 
-        client = flight.FlightClient(destination_url)
-        descriptor = flight.FlightDescriptor.for_command(table_name)
-        table_size_mb = round(getsizeof(table) / 1024 / 1024, 5)
+        Instead of a `table` the payload can carry `batches`, a re-iterable source of
+        record batches with a `schema` such as synthetic_data.SyntheticData, which is
+        streamed into a single do_put without being materialized.
+
+        With `append` set in the payload or its `table_metadata`, the rows are added
+        to the stored flight instead of replacing it, so only the new rows are sent.
+        The schema must match the flight's.
+
+        With `dictionary_encode` set in the payload (default: FLIGHT_DICTIONARY_ENCODE),
+        the string columns with few distinct values are dictionary encoded before
+        they are sent, see flight_dictionary.
+
+        Args:
+            payload (dict): The data to be transmitted.
+            head (dict, optional): Additional headers for the transmission. Defaults to None.
+
+        Raises:
+            ValueError: If the destination is invalid or the environment variable for FLIGHT_URL is not defined.
+
+        Returns:
+            int: The version of the stored flight, None for sharded flights. Passed as the
+                payload's `min_version` to fetch_flight, the read is guaranteed to see this write.
+        """
+        destination = payload.get('destination', None)
+        table_name = payload.get('table_name', None)
+        table_metadata = payload.get('table_metadata', None)
+        table = payload.get('table', None)
+        # instead of a table, a re-iterable source of record batches with a schema, e.g. a
+        # synthetic_data.SyntheticData, streamed into do_put without ever building the table
+        batches = payload.get('batches', None)
+        # number of concurrent do_put streams and maximum rows per record batch
+        parts = payload.get('parts', 1)
+        batch_size = payload.get('batch_size', None)
+        # number of producers to shard the flight across, and the column and method to shard by
+        shards = payload.get('shards', 1)
+        shard_by = payload.get('shard_by', None)
+        shard_method = payload.get('shard_method', 'hash')
+        # add the rows to the stored flight instead of replacing it, e.g. the new ticks of a time series
+        append = payload.get('append', False) or (table_metadata or {}).get('append', False)
+        # dictionary-encode the string columns with few distinct values, sent once per stream as deltas
+        encode = payload.get('dictionary_encode', DICTIONARY_ENCODE)
+
+        if batches is not None and (parts > 1 or shards > 1):
+            raise ValueError("parts and shards need a table, not a stream of batches")
+        if append and (parts > 1 or shards > 1):
+            raise ValueError("an append is sent as a single stream, without parts or shards")
+        compression = payload.get('compression') or compression_setting(destination)
+
+        if encode and table is not None:
+            table = dictionary_encode(table, batch_size)
+        if batches is not None and encode:
+            batches = EncodedStream(batches)
+        schema = table.schema if batches is None else batches.schema
+        sent = {'rows': 0, 'nbytes': 0, 'first': None}
+
+        def stream():
+            # called again by every resumed attempt, which skips the batches the server holds
+            if batches is None:
+                yield from table.to_batches(max_chunksize=batch_size)
+                return
+            sent.update(rows=0, nbytes=0, first=None)
+            for batch in batches:
+                sent['rows'] += batch.num_rows
+                sent['nbytes'] += batch.nbytes
+                sent['first'] = sent['first'] or batch
+                yield batch
+
+        def put(destination_url):
+            # negotiate the IPC buffer compression with the server
+            with self.pool.connection(destination_url) as client:
+                codec = negotiate(client, destination_url, compression, table)
+            options = flight.FlightCallOptions(write_options=write_options(codec))
+
+            # transmit the table over pooled connections
+            if parts > 1:
+                result = put_parts(self.pool, destination_url, table_name, table, parts, batch_size, options)
+            else:
+                # a broken connection is resumed after the last batch the server holds
+                result = put_resumable(self.pool, destination_url, table_name, schema, stream, options, append)
+            return codec, result
 
-        # transmit the table
         tic_write = timeit.default_timer()
-        writer, reader = client.do_put(descriptor, table.schema)
-        writer.write_table(table)
-        writer.close()
+        if shards > 1:
+            # the shard map pins every shard to its producer, so sharded puts do not fail over
+            locations = self.resolve_shard_locations(destination, shards)
+            with self.pool.connection(locations[0]) as client:
+                codec = negotiate(client, locations[0], compression, table)
+            options = flight.FlightCallOptions(write_options=write_options(codec))
+            put_shards(self.pool, locations, table_name, table, shard_by, shard_method, batch_size, options)
+            result = {}
+        else:
+            # an append goes to a producer holding the flight
+            codec, result = call_with_failover(
+                lambda: self.resolve_destination(destination, table_name if append else None), put)
 
         toc_write = timeit.default_timer()
+        if batches is None:
+            num_rows, nbytes = table.num_rows, table.nbytes
+            wire_bytes, ratio = wire_estimate(table, codec)
+        else:
+            num_rows, nbytes = sent['rows'], sent['nbytes']
+            wire_bytes, ratio = wire_estimate(sent['first'], codec, nbytes)
         log.info(
-            f'table of: {table.num_rows} rows, {table.num_columns} cols, '
-            f'{table_size_mb} MB transmitted in {(toc_write - tic_write):.2f} seconds')
+            f'table of: {num_rows} rows, {len(schema)} cols, '
+            f'{nbytes / 1024 / 1024:.5f} MB transmitted in {(toc_write - tic_write):.2f} seconds '
+            f'over {max(parts, shards)} streams ({nbytes / 1024 / 1024 / (toc_write - tic_write):.2f} MB/s), '
+            f'~{wire_bytes / 1024 / 1024:.2f} MB on the wire ({codec or "uncompressed"}, ratio {ratio:.2f}, '
+            f'estimated from a sample)')
 
         table = None
+        # reads passing this as min_version are guaranteed to see this write
+        return result.get('version')
+
+    def fetch_flight(self, payload, head=None):
+        """
+        Retrieves a table using the Flight method.
+
+        The `select_fields` and `filters` of the payload's `table_metadata` are sent
+        to the server, which applies them before streaming the result. If the flight
+        is split into several endpoints (see `partitions`), they are read in parallel,
+        each from one of the replicas holding the flight. Producers behind the
+        payload's `min_version` refuse the read.
+
+        Columns stored dictionary encoded are returned as such, with
+        `decode_dictionaries` set in the payload as plain strings instead.
+
+        Args:
+            payload (dict): The destination, table_name and optional table_metadata.
+            head (dict, optional): Additional headers for the transmission. Defaults to None.
+
+        Raises:
+            ValueError: If the destination is invalid or the environment variable for FLIGHT_URL is not defined.
+
+        Returns:
+            pyarrow.Table: The retrieved table.
+        """
+        destination = payload.get('destination', None)
+        table_name = payload.get('table_name', None)
+        table_metadata = payload.get('table_metadata', None) or {}
+
+        compression = payload.get('compression') or compression_setting(destination)
+
+        def fetch(destination_url):
+            with self.pool.connection(destination_url) as client:
+                codec = negotiate(client, destination_url, compression)
+                # projection and filters are evaluated by the server before it sends anything
+                descriptor = query_descriptor(table_name, table_metadata.get('select_fields'),
+                                              table_metadata.get('filters'), table_metadata.get('partitions'),
+                                              codec, compression == 'adaptive', payload.get('min_version'))
+                flight_info = client.get_flight_info(descriptor)
+            return fetch_endpoints(flight_info, destination_url, pool=self.pool), codec
+
+        # retrieve the table, preferring a producer that already holds it
+        tic_read = timeit.default_timer()
+        table, codec = call_with_failover(lambda: self.resolve_destination(destination, table_name), fetch)
+
+        toc_read = timeit.default_timer()
+        # the codec requested, the server may still drop an adaptive one for data that does not compress
+        wire_bytes, ratio = wire_estimate(table, codec)
+        log.info(
+            f'table of: {table.num_rows} rows, {table.num_columns} cols, {table.nbytes / 1024 / 1024:.5f} MB '
+            f'retrieved in {(toc_read - tic_read):.2f} seconds, '
+            f'~{wire_bytes / 1024 / 1024:.2f} MB on the wire ({codec or "uncompressed"}, ratio {ratio:.2f}, '
+            f'estimated from a sample)')
+        if payload.get('decode_dictionaries'):
+            # dictionary encoded columns back to plain strings
+            table = decode_dictionaries(table)
+        return table
+
+    def compute_flight(self, payload, head=None):
+        """
+        Runs a computation on the producer holding a flight and retrieves only its result.
+
+        The payload's `compute` holds the aggregates, group_by, window, join, order_by
+        and limit of flight_compute.compute_descriptor, e.g. the VWAP by symbol per
+        minute. The `select_fields` and `filters` of its `table_metadata` select the
+        rows first. A join without a `table_name` joins the payload's `table`.
+
+        Args:
+            payload (dict): The destination, table_name, compute and optional table_metadata.
+            head (dict, optional): Additional headers for the transmission. Defaults to None.
+
+        Raises:
+            ValueError: If the destination is invalid or the environment variable for FLIGHT_URL is not defined.
+
+        Returns:
+            pyarrow.Table: The result of the computation.
+        """
+        destination = payload.get('destination', None)
+        table_name = payload.get('table_name', None)
+        table_metadata = payload.get('table_metadata', None) or {}
+        compute = payload.get('compute', None) or {}
+        table = payload.get('table', None)
+
+        descriptor = compute_descriptor(table_name, filters=table_metadata.get('filters'),
+                                        select_fields=table_metadata.get('select_fields'),
+                                        min_version=payload.get('min_version'), **compute)
+
+        def run(destination_url):
+            with self.pool.connection(destination_url) as client:
+                return exchange(client, descriptor, table)
+
+        tic_compute = timeit.default_timer()
+        result = call_with_failover(lambda: self.resolve_destination(destination, table_name), run)
+        toc_compute = timeit.default_timer()
+        log.info(
+            f'computed {result.num_rows} rows, {result.num_columns} cols on {table_name} '
+            f'in {(toc_compute - tic_compute):.2f} seconds, {result.nbytes / 1024:.2f} KB retrieved')
+        return result
+
+    def subscribe_flight(self, payload, head=None):
+        """
+        Follows a flight: yields its rows and then every batch appended to it.
+
+        The rows are streamed from the payload's `from_row` (default 0, e.g. the
+        number of rows already received), then the stream stays open and each
+        append is pushed as soon as a producer publishes it, so consumers
+        neither poll get_flight_info nor re-read rows they have. The `select_fields`
+        and `filters` of the `table_metadata` apply to every batch. The generator
+        ends when the flight is removed.
+
+        Args:
+            payload (dict): The destination, table_name, optional from_row, heartbeat and table_metadata.
+            head (dict, optional): Additional headers for the transmission. Defaults to None.
+
+        Raises:
+            FlightReplacedError: If the flight is replaced by a put rather than appended to.
+
+        Yields:
+            pyarrow.RecordBatch: The rows, in flight order.
+        """
+        destination = payload.get('destination', None)
+        table_name = payload.get('table_name', None)
+        table_metadata = payload.get('table_metadata', None) or {}
+
+        log.info(f'subscribing to {table_name} from row {payload.get("from_row", 0)}')
+        yield from subscribe(lambda: self.resolve_destination(destination, table_name), table_name,
+                             payload.get('from_row', 0), table_metadata.get('select_fields'),
+                             table_metadata.get('filters'), payload.get('heartbeat'))
 
 
 class DataProcessor:
@@ -115,9 +541,9 @@ class DataProcessor:
         """
         new_cols = []
         for _ in range(x):
-            for col in table.columns:
-                new_col_name = f'{col._name}_{_}'
-                new_cols.append(pyarrow.field(new_col_name, col.type))
+            for field in table.schema:
+                new_col_name = f'{field.name}_{_}'
+                new_cols.append(pyarrow.field(new_col_name, field.type))
         all_cols = list(table.schema) + new_cols
         new_schema = pyarrow.schema(all_cols)
         new_arrays = [*table, *[table[col.name[:col.name.rfind('_')]] for col in new_cols]]
@@ -126,36 +552,25 @@ class DataProcessor:
 
     def generate_rows(self, table, x):
         """
-        Generates new rows by concatenating the table with itself.
+        Generates new rows by repeating the table 2**x times.
+
+        The result is combined into contiguous chunks. For load tests prefer
+        synthetic_data.SyntheticData, which is never materialized as a whole.
 
         Args:
             table (pyarrow.Table): The input table.
-            x (int): The number of times to concatenate the table.
+            x (int): The number of times to double the table.
 
         Returns:
             pyarrow.Table: The table with generated rows.
         """
-        for _ in range(x):
-            table = pyarrow.concat_tables([table] * 2)
-        return table
+        return pyarrow.concat_tables([table] * 2 ** x).combine_chunks()
 
 
 if __name__ == '__main__':
-    data_processor = DataProcessor()
     data_transmitter = DataTransmitter()
 
-    table = pyarrow.Table.from_arrays(
-        [
-            pyarrow.array(["AAPL", "GOOG", "MSFT"]),
-            pyarrow.array([1672345600, 1672345600, 1672345600]),  # Timestamps
-            pyarrow.array([150.0, 110.0, 250.0])
-        ],
-        names=["symbol", "timestamp", "price"]
-    )
-
-    table = data_processor.duplicate_columns(table, 10)
-    table = data_processor.generate_rows(table, 15)
-
+    # about 900 MB of stock prices in 4 MB record batches, generated while they are sent
     payload = {
         'destination': 'overlay',
         'table_name': 'stock_prices',
@@ -163,6 +578,6 @@ if __name__ == '__main__':
             'select_fields': [],
             'filters': {},
         },
-        'table': table
+        'batches': stock_prices(rows=1 << 22, copies=10, seed=0),
     }
-    res = data_transmitter.transmit('FLIGHT', payload, None)
\ No newline at end of file
+    res = data_transmitter.transmit('FLIGHT', payload, None)
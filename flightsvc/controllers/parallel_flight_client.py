@@ -0,0 +1,209 @@
+import contextlib
+import json
+import random
+import threading
+import timeit
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow
+import pyarrow.flight as flight
+
+from flightsvc.controllers.flight_query import part_descriptor, row_ranges, shard_descriptor
+from flightsvc.controllers.flight_resume import (abort_upload, end_metadata, get_resumable, prepare_metadata,
+                                                 sequence_metadata)
+from flightsvc.controllers.flight_shards import shard_table
+
+log = logging.getLogger(__name__)
+
+
+def finish_put(writer, reader):
+    """
+    Closes a do_put stream and returns the result the server sent back,
+    e.g. the `version` of the stored flight.
+
+    Returns:
+        dict: The put result, empty if the server did not send one.
+    """
+    writer.done_writing()
+    metadata = reader.read()
+    writer.close()
+    return json.loads(metadata.to_pybytes()) if metadata is not None else {}
+
+
+def fetch_endpoints(flight_info, default_location, max_workers=None, pool=None):
+    """
+    Fetches every endpoint of a FlightInfo concurrently and reassembles the table.
+
+    Each worker thread uses its own FlightClient per location, so the
+    partitions of a single flight are read over separate connections. An
+    endpoint served by several replicas is read from a random one, moving on
+    to the next if it is unavailable. A read that breaks is resumed after the
+    rows already received, see flight_resume.get_resumable.
+
+    Args:
+        flight_info (pyarrow.flight.FlightInfo): The info returned by get_flight_info.
+        default_location (str): The location to read endpoints that do not list one.
+        max_workers (int, optional): The thread pool size. Defaults to one thread per endpoint.
+        pool (FlightClientPool, optional): If given, clients are borrowed from the pool
+            instead of being opened for this call.
+
+    Returns:
+        pyarrow.Table: The endpoint tables concatenated in endpoint order.
+    """
+    endpoints = list(flight_info.endpoints)
+    if not endpoints:
+        return flight_info.schema.empty_table()
+
+    local = threading.local()
+    clients = []
+    clients_lock = threading.Lock()
+
+    def get_client(location):
+        if not hasattr(local, 'clients'):
+            local.clients = {}
+        if location not in local.clients:
+            client = flight.FlightClient(location)
+            local.clients[location] = client
+            with clients_lock:
+                clients.append(client)
+        return local.clients[location]
+
+    def fetch(endpoint):
+        locations = [location.uri.decode() for location in endpoint.locations] or [default_location]
+        first = random.randrange(len(locations))
+
+        def connect(retry):
+            location = locations[(first + retry) % len(locations)]
+            if retry:
+                log.warning(f'resuming the read from {location}')
+            if pool is not None:
+                return pool.connection(location)
+            return contextlib.nullcontext(get_client(location))
+
+        return get_resumable(connect, endpoint.ticket)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or len(endpoints)) as executor:
+            tables = list(executor.map(fetch, endpoints))
+    finally:
+        for client in clients:
+            client.close()
+
+    return pyarrow.concat_tables(tables)
+
+
+def put_parts(pool, url, table_name, table, parts, batch_size=None, options=None):
+    """
+    Uploads a table as several concurrent do_put streams of one logical flight.
+
+    The table is split into `parts` zero-copy row slices, each written over
+    its own pooled connection. The server publishes the flight atomically
+    once every part has arrived.
+
+    Args:
+        pool (FlightClientPool): The pool connections are borrowed from.
+        url (str): The Flight URL of the destination.
+        table_name (str): The name of the flight.
+        table (pyarrow.Table): The table to upload.
+        parts (int): The number of concurrent streams.
+        batch_size (int, optional): The maximum number of rows per record batch.
+        options (pyarrow.flight.FlightCallOptions, optional): The call options, e.g. IPC compression.
+
+    Returns:
+        dict: The put result sent back by the server with the part that completed the upload.
+    """
+    upload_id = uuid.uuid4().hex
+    ranges = row_ranges(table.num_rows, parts)
+
+    def put(part):
+        start, stop = ranges[part]
+        descriptor = part_descriptor(table_name, upload_id, part, len(ranges))
+        tic_write = timeit.default_timer()
+        with pool.connection(url) as client:
+            writer, reader = client.do_put(descriptor, table.schema, options=options)
+            writer.write_table(table.slice(start, stop - start), max_chunksize=batch_size)
+            result = finish_put(writer, reader)
+        toc_write = timeit.default_timer()
+        log.info(f'part {part + 1}/{len(ranges)} of {table_name}: {stop - start} rows '
+                 f'transmitted in {(toc_write - tic_write):.2f} seconds')
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        results = list(executor.map(put, range(len(ranges))))
+    return next((result for result in results if result), {})
+
+
+def put_shards(pool, locations, table_name, table, shard_by=None, method='hash',
+               batch_size=None, options=None):
+    """
+    Shards a table across several producers, one concurrent do_put per producer.
+
+    Every producer receives its shard together with the shard map, so
+    get_flight_info on any of them returns endpoints for all shards. Each
+    shard is a resumable upload that is only completed once every producer
+    has confirmed it holds its shard; if any shard fails the others are
+    aborted, and every producer keeps the flight it held before rather than
+    part of a broken shard map.
+
+    Args:
+        pool (FlightClientPool): The pool connections are borrowed from.
+        locations (list): The Flight URLs of the producers, one shard each.
+        table_name (str): The name of the flight.
+        table (pyarrow.Table): The table to upload.
+        shard_by (str, optional): The column to shard on. Defaults to contiguous row ranges.
+        method (str): 'hash' or 'range' sharding of `shard_by`.
+        batch_size (int, optional): The maximum number of rows per record batch.
+        options (pyarrow.flight.FlightCallOptions, optional): The call options, e.g. IPC compression.
+
+    Returns:
+        list: The shard map, one {'location', 'num_rows'} dict per shard.
+    """
+    tables = shard_table(table, len(locations), shard_by, method)
+    shards = [{'location': location, 'num_rows': shard.num_rows} for location, shard in zip(locations, tables)]
+    upload_id = uuid.uuid4().hex
+    # every shard waits here once its producer holds it, until all of them do
+    prepared = threading.Barrier(len(locations))
+
+    def put(shard):
+        descriptor = shard_descriptor(table_name, shard, shards, f'{upload_id}-{shard}')
+        tic_write = timeit.default_timer()
+        with pool.connection(locations[shard]) as client:
+            writer, reader = client.do_put(descriptor, table.schema, options=options)
+            try:
+                if reader.read() is None:
+                    # refused before reading, e.g. by admission control: close raises the error
+                    writer.close()
+                    raise flight.FlightUnavailableError(f'{locations[shard]} refused shard {shard} of {table_name}')
+                batches = tables[shard].to_batches(max_chunksize=batch_size)
+                for sequence, batch in enumerate(batches):
+                    writer.write_with_metadata(batch, sequence_metadata(sequence))
+                writer.write_metadata(prepare_metadata(len(batches)))
+                metadata = reader.read()
+                if metadata is None:
+                    # the producer failed, close raises its error
+                    writer.close()
+                    raise flight.FlightUnavailableError(f'{locations[shard]} ended shard {shard} of {table_name}')
+                prepared.wait()
+            except threading.BrokenBarrierError:
+                abort_upload(writer, f'another shard of {table_name} failed')
+                raise
+            except BaseException as e:
+                prepared.abort()
+                abort_upload(writer, e)
+                raise
+            writer.write_metadata(end_metadata(len(batches)))
+            finish_put(writer, reader)
+        toc_write = timeit.default_timer()
+        log.info(f'shard {shard + 1}/{len(locations)} of {table_name}: {tables[shard].num_rows} rows '
+                 f'transmitted to {locations[shard]} in {(toc_write - tic_write):.2f} seconds')
+
+    with ThreadPoolExecutor(max_workers=len(locations)) as executor:
+        futures = [executor.submit(put, shard) for shard in range(len(locations))]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    # the error of the shard that failed rather than the aborts it caused
+    failures = [e for e in errors if not isinstance(e, threading.BrokenBarrierError)]
+    if errors:
+        raise (failures or errors)[0]
+    return shards
@@ -1,11 +1,26 @@
 import pyarrow
 import pyarrow.flight as flight
 import argparse
-import ast
+import json
 import threading
 import time
 import logging
 
+from flightsvc.controllers.flight_admission import AdmissionController, AdmittedReader, client_id, release_on_completion
+from flightsvc.controllers.flight_compression import available_codecs, ticket_options
+from flightsvc.controllers.flight_compute import run_compute
+from flightsvc.controllers.flight_dictionary import DICTIONARY_ENCODE
+from flightsvc.controllers.flight_index import batch_filter, overlapping
+from flightsvc.controllers.flight_metrics import (MIDDLEWARE_KEY, FlightMetrics, MetricsMiddlewareFactory,
+                                                  call_metrics, counted_batches, counted_reader, local_servers)
+from flightsvc.controllers.flight_query import (decode_ticket, encode_ticket, parse_descriptor,
+                                                project_schema, query_batches, row_ranges)
+from flightsvc.controllers.flight_replication import check_version, put_result
+from flightsvc.controllers.flight_resume import resume_metadata, skip_rows
+from flightsvc.controllers.flight_shards import shard_endpoints
+from flightsvc.controllers.flight_store import COMPACT_INTERVAL, FlightStore, key_name, parse_criteria
+from flightsvc.controllers.flight_subscribe import subscription_batches
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
@@ -23,80 +38,238 @@ log = logging.getLogger(__name__)
 class FlightServer(flight.FlightServerBase):
     def __init__(self, host="localhost", location=None,
                  tls_certificates=None, verify_client=False,
-                 root_certificates=None, auth_handler=None):
+                 root_certificates=None, auth_handler=None, streaming_ingest=True,
+                 partition_rows=1000000, memory_limit=None, flight_ttl=None,
+                 data_dir=None, compact_interval=COMPACT_INTERVAL,
+                 dictionary_encode=DICTIONARY_ENCODE, admission=None):
+        # per-method call, byte, row and latency metrics, see the stats action
+        self.metrics = FlightMetrics()
         super(FlightServer, self).__init__(
             location, auth_handler, tls_certificates, verify_client,
-            root_certificates)
+            root_certificates, middleware={MIDDLEWARE_KEY: MetricsMiddlewareFactory(self.metrics)})
+        local_servers.add(self)
         # self.flights = {"get_test_data": test_data}
-        self.flights = {}
+        self.flights = FlightStore(streaming=streaming_ingest, memory_limit=memory_limit, ttl=flight_ttl,
+                                   data_dir=data_dir, compact_interval=compact_interval,
+                                   dictionary_encode=dictionary_encode)
         self.host = host
         self.tls_certificates = tls_certificates
+        self._flight_location = None
+        # caps the concurrent streams and the bytes uploads hold, and paces reads, see flight_admission
+        self.admission = admission or AdmissionController()
+        # rows per endpoint when a client does not ask for a partition count
+        self.partition_rows = partition_rows
 
     @classmethod
     def descriptor_to_key(self, descriptor):
-        return (descriptor.descriptor_type.value, descriptor.command,
-                tuple(descriptor.path or tuple()))
-
-    def _make_flight_info(self, key, descriptor, table):
-        if self.tls_certificates:
-            location = pyarrow.flight.Location.for_grpc_tls(
-                self.host, self.port
-            )
+        key, _ = parse_descriptor(descriptor)
+        return key
+
+    def _location(self):
+        if self._flight_location is None:
+            if self.tls_certificates:
+                self._flight_location = pyarrow.flight.Location.for_grpc_tls(
+                    self.host, self.port
+                )
+            else:
+                self._flight_location = pyarrow.flight.Location.for_grpc_tcp(
+                    self.host, self.port
+                )
+        return self._flight_location
+
+    def _make_flight_info(self, key, descriptor, entry, query=None):
+        # schema, row count and size are maintained by the store on put,
+        # so building the info never touches the stored data
+        query = dict(query or {})
+        if entry.shards and query.get('subscribe'):
+            raise ValueError(f'{key_name(key)} is sharded, subscribe to its shards separately')
+        if entry.shards:
+            # a shard of a sharded flight describes every shard, so clients read them all in parallel
+            return self._make_sharded_flight_info(key, descriptor, entry, query)
+        partitions = query.pop('partitions', None)
+        if query.get('subscribe'):
+            # a live tail is a single stream that does not end
+            partitions = 1
+        elif partitions is None and self.partition_rows:
+            partitions = -(-entry.num_rows // self.partition_rows)
+        # tickets are pinned to this version
+        query['version'] = entry.version
+        # the batch indexes tell which rows may match the filters, so ranges
+        # without any get no endpoint, and a flight without any gets none at all
+        spans = None if query.get('subscribe') else entry.matching_spans(
+            batch_filter(entry.schema, query.get('filters')))
+        if spans == []:
+            endpoints = []
+        elif partitions and partitions > 1 and entry.complete:
+            # one row range endpoint per partition, so clients can read them in parallel
+            endpoints = [pyarrow.flight.FlightEndpoint(encode_ticket(key, {**query, 'row_range': row_range}),
+                                                       [self._location()])
+                         for row_range in overlapping(row_ranges(entry.num_rows, partitions), spans)]
         else:
-            location = pyarrow.flight.Location.for_grpc_tcp(
-                self.host, self.port
-            )
-        endpoints = [pyarrow.flight.FlightEndpoint(repr(key), [location]), ]
-
-        mock_sink = pyarrow.MockOutputStream()
-        stream_writer = pyarrow.RecordBatchStreamWriter(
-            mock_sink, table.schema)
-        stream_writer.write_table(table)
-        stream_writer.close()
-        data_size = mock_sink.size()
-
-        return pyarrow.flight.FlightInfo(table.schema,
+            endpoints = [pyarrow.flight.FlightEndpoint(encode_ticket(key, query), [self._location()]), ]
+
+        schema, num_rows, data_size = entry.schema, entry.num_rows, entry.data_size
+        if query.get('select_fields') or query.get('filters') or query.get('subscribe'):
+            # the size of a projected, filtered or live stream is not known up front
+            schema = project_schema(schema, query.get('select_fields'))
+            num_rows = -1 if query.get('filters') or query.get('subscribe') else num_rows
+            data_size = -1
+        if spans == []:
+            num_rows, data_size = 0, 0
+
+        return pyarrow.flight.FlightInfo(schema,
                                          descriptor, endpoints,
-                                         table.num_rows, data_size)
+                                         num_rows, data_size,
+                                         app_metadata=json.dumps({'version': entry.version,
+                                                                  'lineage': entry.lineage,
+                                                                  'index_bytes': entry.index_bytes}))
+
+    def _make_sharded_flight_info(self, key, descriptor, entry, query):
+        endpoints = shard_endpoints(key, query, entry.shards, self.partition_rows)
+        schema = project_schema(entry.schema, query.get('select_fields'))
+        num_rows = -1 if query.get('filters') else sum(shard['num_rows'] for shard in entry.shards)
+        # the other shards' sizes are not known here
+        return pyarrow.flight.FlightInfo(schema, descriptor, endpoints, num_rows, -1)
 
     def list_flights(self, context, criteria):
-        for key, table in self.flights.items():
+        prefix, after, limit = parse_criteria(criteria)
+        for key, entry in self.flights.list(prefix, after, limit):
             if key[1] is not None:
                 descriptor = pyarrow.flight.FlightDescriptor.for_command(key[1])
             else:
                 descriptor = pyarrow.flight.FlightDescriptor.for_path(*key[2])
 
-            yield self._make_flight_info(key, descriptor, table)
+            yield self._make_flight_info(key, descriptor, entry)
 
     def get_flight_info(self, context, descriptor):
-        key = FlightServer.descriptor_to_key(descriptor)
-        if key in self.flights:
-            table = self.flights[key]
-            return self._make_flight_info(key, descriptor, table)
+        key, query = parse_descriptor(descriptor)
+        entry = self.flights.get(key)
+        if entry is not None:
+            check_version(key, entry, min_version=query.pop('min_version', None))
+            return self._make_flight_info(key, descriptor, entry, query)
         raise KeyError('Flight not found.')
 
     def do_put(self, context, descriptor, reader, writer):
-        key = FlightServer.descriptor_to_key(descriptor)
+        key, query = parse_descriptor(descriptor)
+        # waits for a slot, or raises FlightUnavailableError for the client to retry
+        slot = self.admission.admit('do_put', client_id(context))
+        try:
+            self._do_put(key, query, AdmittedReader(counted_reader(reader, call_metrics(context)), slot), writer)
+        finally:
+            slot.release()
+
+    def _do_put(self, key, query, reader, writer):
         log.info(f'adding key: {key}')
-        self.flights[key] = reader.read_all()
-        # log.info(self.flights[key])
+        if query.get('resumable'):
+            # one attempt of a resumable upload, told how many batches are already held
+            entry = self.flights.ingest_resumable(key, reader, query['upload_id'],
+                                                  lambda held: writer.write(resume_metadata(held)),
+                                                  append=query.get('append', False), shards=query.get('shards'))
+        elif 'upload_id' in query:
+            # one part of a multi-stream upload, published once all parts arrived
+            entry = self.flights.ingest_part(key, reader, query['upload_id'], query['part'], query['parts'])
+        elif query.get('append'):
+            entry = self.flights.append(key, reader)
+        else:
+            # one shard of a sharded flight carries the map of all shards
+            entry = self.flights.ingest(key, reader, shards=query.get('shards'))
+        if entry is not None:
+            # send the version back, so the client can ask for it when reading
+            writer.write(put_result(entry))
+        # log.info(self.flights.get(key).to_table())
+
+    def stats(self):
+        return {**self.metrics.snapshot(), 'store': self.flights.usage(), 'admission': self.admission.snapshot()}
 
     def do_get(self, context, ticket):
-        key = ast.literal_eval(ticket.ticket.decode())
-        if key not in self.flights:
-            return None
-        return pyarrow.flight.RecordBatchStream(self.flights[key])
+        key, query = decode_ticket(ticket)
+        # the version the ticket was issued for, even if the flight has been replaced since
+        entry = self.flights.get(key, query.get('version'))
+        if entry is None:
+            raise KeyError('Flight not found.')
+        call = call_metrics(context)
+        # the slot is held until the last batch has been sent
+        release_on_completion(self.admission.admit('subscribe' if query.get('subscribe') else 'do_get',
+                                                   client_id(context)), call)
+        if query.get('subscribe'):
+            # a live tail follows the flight from version to version, see flight_subscribe
+            reader = pyarrow.RecordBatchReader.from_batches(
+                project_schema(entry.schema, query.get('select_fields')),
+                counted_batches(subscription_batches(self.flights, key, query, context), call))
+            return pyarrow.flight.RecordBatchStream(reader, options=ticket_options(query))
+        check_version(key, entry, query.get('version'))
+        row_range = query.get('row_range')
+        # the rows a resumed read has already received, see flight_resume.get_resumable
+        skipped = query.get('skip_rows', 0)
+        options = ticket_options(query, entry.batches[0] if entry.batches else None)
+        if query.get('select_fields') or query.get('filters'):
+            # projection and filters are evaluated here, before anything is sent
+            schema = project_schema(entry.schema, query.get('select_fields'))
+            # batches whose index rules out the filters are skipped unread
+            keep = batch_filter(entry.schema, query.get('filters'))
+            batches = entry.iter_rows(*row_range, keep=keep) if row_range else entry.iter_batches(keep=keep)
+            # a lazy reader rather than a GeneratorStream, which does not send dictionaries
+            batches = skip_rows(query_batches(batches, query), skipped)
+            reader = pyarrow.RecordBatchReader.from_batches(schema,
+                                                            self.admission.throttled(counted_batches(batches, call)))
+            return pyarrow.flight.RecordBatchStream(reader, options=options)
+        if entry.complete:
+            table = entry.to_table()
+            if row_range:
+                table = table.slice(row_range[0], row_range[1] - row_range[0])
+            table = table.slice(skipped)
+            # sent batch by batch, as fast as the egress budget allows, and counted once sent
+            reader = pyarrow.RecordBatchReader.from_batches(
+                table.schema, self.admission.throttled(counted_batches(table.to_batches(), call)))
+            return pyarrow.flight.RecordBatchStream(reader, options=options)
+        # still uploading: serve the committed batches and follow the rest
+        batches = skip_rows(entry.iter_rows(*row_range) if row_range else entry.iter_batches(), skipped)
+        reader = pyarrow.RecordBatchReader.from_batches(entry.schema,
+                                                        self.admission.throttled(counted_batches(batches, call)))
+        return pyarrow.flight.RecordBatchStream(reader, options=options)
+
+    def do_exchange(self, context, descriptor, reader, writer):
+        # server-side compute, only the result is sent back, see flight_compute.compute_descriptor
+        key, query = parse_descriptor(descriptor)
+        if 'compute' not in query:
+            raise ValueError('do_exchange expects a compute descriptor')
+        call = call_metrics(context)
+        slot = self.admission.admit('do_exchange', client_id(context))
+        try:
+            result = run_compute(self.flights, key, query, AdmittedReader(counted_reader(reader, call), slot))
+            writer.begin(result.schema)
+            for batch in counted_batches(result.to_batches(), call):
+                writer.write_batch(batch)
+        finally:
+            slot.release()
 
     def list_actions(self, context):
         return [
-            ("clear", "Clear the stored flights."),
+            ("clear", "Clear the stored flights, or those whose name starts with the action body."),
+            ("usage", "Report the memory used by the stored flights."),
+            ("stats", "Report the per-method call metrics, store usage and admission control counters."),
+            ("compact", "Merge the batches appended to the flights, or to the flight named in the action body."),
+            ("codecs", "List the IPC compression codecs this server supports."),
             ("shutdown", "Shut down this server."),
         ]
 
     def do_action(self, context, action):
         if action.type == "clear":
-            raise NotImplementedError(
-                "{} is not implemented.".format(action.type))
+            prefix = action.body.to_pybytes().decode() or None
+            cleared, released = self.flights.clear(prefix)
+            yield pyarrow.flight.Result(pyarrow.py_buffer(
+                json.dumps({'cleared': cleared, 'released_bytes': released}).encode()))
+        elif action.type == "usage":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(self.flights.usage()).encode()))
+        elif action.type == "stats":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(self.stats()).encode()))
+        elif action.type == "compact":
+            name = action.body.to_pybytes().decode()
+            key = self.descriptor_to_key(pyarrow.flight.FlightDescriptor.for_command(name)) if name else None
+            yield pyarrow.flight.Result(pyarrow.py_buffer(
+                json.dumps({'compacted': self.flights.compact(key)}).encode()))
+        elif action.type == "codecs":
+            yield pyarrow.flight.Result(pyarrow.py_buffer(json.dumps(available_codecs()).encode()))
         elif action.type == "healthcheck":
             pass
         elif action.type == "shutdown":
@@ -124,6 +297,8 @@ if __name__ == "__main__":
                         help="Enable transport-level security")
     parser.add_argument("--verify_client", type=bool, default=False,
                         help="enable mutual TLS and verify the client if True")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Persist flights as Arrow IPC files in this directory")
 
     args = parser.parse_args()
     tls_certificates = []
@@ -138,7 +313,8 @@ if __name__ == "__main__":
 
     location = "{}://{}:{}".format(scheme, args.host, args.port)
 
-    server = FlightServer(args.host, location, tls_certificates=tls_certificates, verify_client=args.verify_client)
+    server = FlightServer(args.host, location, tls_certificates=tls_certificates, verify_client=args.verify_client,
+                          data_dir=args.data_dir)
     log.info(f'serving on: {location}')
     server.serve()
 
@@ -0,0 +1,157 @@
+import logging
+
+import numpy
+import pyarrow
+
+log = logging.getLogger(__name__)
+
+COLUMN_TYPES = ['int64', 'float64', 'string', 'symbol', 'timestamp']
+DISTRIBUTIONS = ['uniform', 'normal', 'zipf', 'sequence']
+
+# record batches are sized to about this many bytes unless a row count is given
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+# estimated bytes per value, used to size the batches
+VALUE_WIDTHS = {'int64': 8, 'float64': 8, 'string': 16, 'symbol': 4, 'timestamp': 8}
+
+
+def column(name, type='float64', distribution='uniform', cardinality=None, null_fraction=0.0, **params):
+    """
+    Describes one generated column.
+
+    Args:
+        name (str): The column name.
+        type (str): int64, float64, string, symbol (dictionary encoded string) or timestamp.
+        distribution (str): How values are drawn: uniform (`low`, `high`), normal
+            (`mean`, `std`), zipf (`a`, skewed towards the first values) or
+            sequence (`start`, `step`, increasing with the row number). String and
+            symbol values are `prefix` (default: the upper case name) plus a number.
+        cardinality (int, optional): The number of distinct values. Required for
+            string and symbol columns, optional for int64 columns.
+        null_fraction (float): The fraction of null values.
+        **params: The parameters of the distribution.
+
+    Returns:
+        dict: The column spec passed to SyntheticData.
+    """
+    if type not in COLUMN_TYPES:
+        raise ValueError(f"Invalid column type {type!r}, expected one of {COLUMN_TYPES}")
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Invalid distribution {distribution!r}, expected one of {DISTRIBUTIONS}")
+    if type in ('string', 'symbol') and not cardinality:
+        raise ValueError(f"{type} column {name!r} needs a cardinality")
+    return {'name': name, 'type': type, 'distribution': distribution, 'cardinality': cardinality,
+            'null_fraction': null_fraction, 'params': params}
+
+
+class SyntheticData:
+    """
+    Lazily generated, reproducible table of random data.
+
+    Iterating yields right-sized record batches that are generated on
+    demand, so a multi-GB load never exists in memory as a whole. Every batch
+    is drawn from its own generator seeded with (seed, batch index), so the
+    data is the same on every iteration and every run.
+
+    Args:
+        columns (list): The column specs, see `column`.
+        rows (int): The total number of rows.
+        batch_size (int, optional): The rows per record batch. Defaults to
+            about DEFAULT_BATCH_BYTES per batch.
+        seed (int): The random seed.
+    """
+
+    def __init__(self, columns, rows, batch_size=None, seed=0):
+        self.columns = columns
+        self.rows = rows
+        self.seed = seed
+        row_width = sum(VALUE_WIDTHS[spec['type']] for spec in columns) or 1
+        self.batch_size = batch_size or max(1, DEFAULT_BATCH_BYTES // row_width)
+        self.schema = pyarrow.schema([pyarrow.field(spec['name'], self._arrow_type(spec)) for spec in columns])
+        # string and symbol values are taken from one dictionary per column
+        self._dictionaries = {spec['name']: pyarrow.array([f"{spec['params'].get('prefix', spec['name'].upper())}{i}"
+                                                           for i in range(spec['cardinality'])])
+                              for spec in columns if spec['type'] in ('string', 'symbol')}
+
+    @staticmethod
+    def _arrow_type(spec):
+        if spec['type'] == 'symbol':
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        if spec['type'] == 'timestamp':
+            return pyarrow.timestamp('s')
+        return pyarrow.type_for_alias(spec['type'])
+
+    def __len__(self):
+        return -(-self.rows // self.batch_size)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.batch(index)
+
+    def batch(self, index):
+        """
+        Generates the record batch at `index`.
+        """
+        offset = index * self.batch_size
+        num_rows = min(self.batch_size, self.rows - offset)
+        rng = numpy.random.default_rng([self.seed, index])
+        arrays = [self._generate(spec, rng, offset, num_rows) for spec in self.columns]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _draw(self, spec, rng, offset, num_rows):
+        params = spec['params']
+        distribution = spec['distribution']
+        if distribution == 'sequence':
+            return params.get('start', 0) + params.get('step', 1) * numpy.arange(offset, offset + num_rows)
+        if spec['cardinality']:
+            # indices of the distinct values
+            if distribution == 'zipf':
+                return (rng.zipf(params.get('a', 1.5), num_rows) - 1) % spec['cardinality']
+            if distribution == 'normal':
+                values = rng.normal(spec['cardinality'] / 2, params.get('std', spec['cardinality'] / 6), num_rows)
+                return numpy.clip(values, 0, spec['cardinality'] - 1).astype(numpy.int64)
+            return rng.integers(0, spec['cardinality'], num_rows)
+        if distribution == 'normal':
+            return rng.normal(params.get('mean', 0.0), params.get('std', 1.0), num_rows)
+        if distribution == 'zipf':
+            return rng.zipf(params.get('a', 1.5), num_rows)
+        if spec['type'] in ('int64', 'timestamp'):
+            return rng.integers(params.get('low', 0), params.get('high', 1 << 31), num_rows)
+        return rng.uniform(params.get('low', 0.0), params.get('high', 1.0), num_rows)
+
+    def _generate(self, spec, rng, offset, num_rows):
+        values = self._draw(spec, rng, offset, num_rows)
+        mask = rng.random(num_rows) < spec['null_fraction'] if spec['null_fraction'] else None
+        if spec['type'] == 'symbol':
+            indices = pyarrow.array(values.astype(numpy.int32), mask=mask)
+            return pyarrow.DictionaryArray.from_arrays(indices, self._dictionaries[spec['name']])
+        if spec['type'] == 'string':
+            return self._dictionaries[spec['name']].take(pyarrow.array(values, mask=mask))
+        if spec['type'] == 'timestamp':
+            return pyarrow.array(values.astype(numpy.int64), type=pyarrow.timestamp('s'), mask=mask)
+        return pyarrow.array(values.astype(spec['type']), mask=mask)
+
+    def to_table(self):
+        return pyarrow.Table.from_batches(self, schema=self.schema)
+
+
+def stock_prices(rows, copies=0, batch_size=None, seed=0, symbols=500):
+    """
+    Returns the symbol, timestamp and price table used by the load tests.
+
+    Args:
+        rows (int): The number of rows.
+        copies (int): The number of extra, independently drawn copies of the three columns.
+        batch_size (int, optional): The rows per record batch.
+        seed (int): The random seed.
+        symbols (int): The number of distinct symbols.
+    """
+    columns = []
+    for copy in range(copies + 1):
+        suffix = f'_{copy - 1}' if copy else ''
+        columns += [
+            column(f'symbol{suffix}', 'symbol', 'zipf', cardinality=symbols, a=1.2, prefix='SYM'),
+            column(f'timestamp{suffix}', 'timestamp', 'sequence', start=1672345600),
+            column(f'price{suffix}', 'float64', 'normal', mean=150.0, std=40.0),
+        ]
+    return SyntheticData(columns, rows, batch_size, seed)
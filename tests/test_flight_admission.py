@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pyarrow
+import pyarrow.flight as flight
+import pytest
+
+from flightsvc.controllers.flight_admission import AdmissionController, AdmittedReader, release_on_completion
+from flightsvc.controllers.flight_metrics import FlightMetrics, MetricsMiddleware
+
+
+def controller(**limits):
+    return AdmissionController(**{'max_streams': {}, 'max_bytes': {}, 'max_client_streams': None,
+                                  'max_client_bytes': None, 'queue_timeout': 0.2, 'egress_rate': 0, **limits})
+
+
+class Chunk:
+    def __init__(self, data):
+        self.data = data
+        self.app_metadata = None
+
+
+class Reader:
+    def __init__(self, batch):
+        self.schema = batch.schema
+        self._batches = iter([batch])
+
+    def read_chunk(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            raise StopIteration
+        return Chunk(batch)
+
+
+def batch(rows):
+    return pyarrow.record_batch({'x': pyarrow.array(range(rows), pyarrow.int64())})
+
+
+def test_client_stream_cap_rejects_after_timeout():
+    admission = controller(max_client_streams=1)
+    slot = admission.admit('do_get', 'a')
+    started = time.monotonic()
+    with pytest.raises(flight.FlightUnavailableError):
+        admission.admit('do_get', 'a')
+    assert time.monotonic() - started >= 0.2
+    # other clients are not held back
+    admission.admit('do_get', 'b').release()
+    assert admission.snapshot()['rejected'] == {'do_get': 1}
+    slot.release()
+    admission.admit('do_get', 'a').release()
+
+
+@pytest.mark.parametrize('error', [None, IOError('stream broken')])
+def test_bytes_released_when_the_call_completes(error):
+    data = batch(1000)
+    admission = controller(max_bytes={'do_put': data.get_total_buffer_size()})
+    first, second = (MetricsMiddleware(FlightMetrics(), 'do_put') for _ in range(2))
+    slot = admission.admit('do_put', 'a')
+    release_on_completion(slot, first)
+    AdmittedReader(Reader(data), slot).read_chunk()
+    assert admission.snapshot()['bytes_in_flight'] == {'do_put': data.get_total_buffer_size()}
+
+    # a second put waits for the bytes of the first
+    waiting = admission.admit('do_put', 'b')
+    release_on_completion(waiting, second)
+    reader = threading.Thread(target=AdmittedReader(Reader(data), waiting).read_chunk)
+    reader.start()
+    time.sleep(0.05)
+    assert admission.snapshot()['queued'] == {'do_put': 1}
+    first.call_completed(error)
+    reader.join(1)
+    assert not reader.is_alive()
+    second.call_completed(error)
+    snapshot = admission.snapshot()
+    assert snapshot['bytes_in_flight'] == {} and snapshot['running'] == {}
+    assert snapshot['rejected'] == {}
+
+
+def test_egress_throttled_to_rate():
+    data = batch(12500)
+    rate = 1_000_000
+    admission = controller(egress_rate=rate)
+    count = 15
+    started = time.monotonic()
+    assert len(list(admission.throttled([data] * count))) == count
+    elapsed = time.monotonic() - started
+    # one second of the rate is sent at once, the rest at the rate
+    expected = (count * data.nbytes - rate) / rate
+    assert expected * 0.8 <= elapsed <= expected + 0.5
+    assert admission.snapshot()['egress_throttled_seconds'] > 0
@@ -0,0 +1,35 @@
+import pyarrow
+
+from flightsvc.controllers.flight_index import BloomFilter, batch_filter, hash_strings, index_batch
+
+
+def test_hash_strings_ignores_layout():
+    values = pyarrow.array(['', 'a', 'ab', 'ba', 'héllo', 'x' * 100])
+    hashes = hash_strings(values)
+    assert len(set(hashes.tolist())) == len(values)
+    assert (hash_strings(pyarrow.array(['pad', *values.to_pylist()]).slice(1)) == hashes).all()
+    assert (hash_strings(values.cast(pyarrow.large_string())) == hashes).all()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    values = [f'sym{i}' for i in range(5000)]
+    bloom = BloomFilter(pyarrow.array(values))
+    assert all(value in bloom for value in values)
+    false_positives = sum(f'other{i}' in bloom for i in range(5000))
+    assert false_positives < 250
+
+
+def test_bloom_index_of_string_and_dictionary_columns():
+    column = pyarrow.array([f'w{i}' for i in range(1000)] * 3)
+    batch = pyarrow.record_batch({'s': column, 'd': column.dictionary_encode()})
+    index, _ = index_batch(batch)
+    assert index['s'][0] == index['d'][0] == 'bloom'
+    keep = batch_filter(batch.schema, {'s': 'w10', 'd': ['w999']})
+    assert keep(index)
+    assert not batch_filter(batch.schema, {'s': 'absent'})(index)
+
+
+def test_unique_column_not_indexed():
+    batch = pyarrow.record_batch({'s': pyarrow.array([f'id{i}' for i in range(100000)])})
+    index, _ = index_batch(batch)
+    assert 's' not in index
@@ -0,0 +1,29 @@
+import pyarrow.flight as flight
+import pytest
+
+from flightsvc.controllers.flight_pool import FlightClientPool
+
+URL = 'grpc://localhost:1'
+
+
+@pytest.mark.parametrize('error', [KeyError('Flight not found.'), ValueError('bad query'),
+                                   flight.FlightServerError('not found')])
+def test_application_error_keeps_client(error):
+    pool = FlightClientPool()
+    with pytest.raises(type(error)):
+        with pool.connection(URL) as client:
+            raise error
+    with pool.connection(URL) as reused:
+        assert reused is client
+
+
+@pytest.mark.parametrize('error', [flight.FlightUnavailableError('connection reset'),
+                                   flight.FlightTimedOutError('deadline exceeded'), OSError('broken pipe')])
+def test_transport_error_discards_client(error):
+    pool = FlightClientPool(max_per_destination=1)
+    with pytest.raises(type(error)):
+        with pool.connection(URL) as client:
+            raise error
+    # the slot of the discarded client is free again
+    with pool.connection(URL, timeout=1) as replacement:
+        assert replacement is not client
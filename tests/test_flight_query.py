@@ -0,0 +1,51 @@
+import pyarrow.flight as flight
+import pytest
+
+from flightsvc.controllers.flight_query import decode_ticket, encode_ticket, parse_descriptor
+
+COMMAND_KEY = (flight.DescriptorType.CMD.value, b'trades', ())
+PATH_KEY = (flight.DescriptorType.PATH.value, None, (b'desk', b'trades'))
+
+
+def roundtrip(key, query=None):
+    return decode_ticket(flight.Ticket(encode_ticket(key, query)))
+
+
+@pytest.mark.parametrize('key', [COMMAND_KEY, PATH_KEY])
+def test_plain_ticket(key):
+    assert roundtrip(key) == (key, {})
+
+
+@pytest.mark.parametrize('key', [COMMAND_KEY, PATH_KEY])
+def test_ticket_with_query(key):
+    query = {'version': 7, 'row_range': [10, 20], 'select_fields': ['price'], 'filters': [['qty', '>', 1]]}
+    assert roundtrip(key, query) == (key, query)
+
+
+def test_version_zero_is_kept():
+    assert roundtrip(COMMAND_KEY, {'version': 0}) == (COMMAND_KEY, {'version': 0})
+
+
+def test_ticket_of_parsed_descriptor():
+    key, query = parse_descriptor(flight.FlightDescriptor.for_command(b'{"table_name": "trades", "limit": 5}'))
+    assert roundtrip(key, query) == (key, {'limit': 5})
+
+
+def test_encode_does_not_change_query():
+    query = {'version': 3, 'row_range': [0, 5]}
+    encode_ticket(COMMAND_KEY, query)
+    assert query == {'version': 3, 'row_range': [0, 5]}
+
+
+@pytest.mark.parametrize('data', [b'', b'\x00', b'{"table_name": "trades"}'])
+def test_invalid_ticket(data):
+    with pytest.raises(ValueError):
+        decode_ticket(flight.Ticket(data))
+
+
+@pytest.mark.parametrize('key', [COMMAND_KEY, PATH_KEY])
+def test_truncated_ticket(key):
+    data = encode_ticket(key, {'version': 2, 'row_range': [0, 5]})
+    for end in range(1, len(data)):
+        with pytest.raises(ValueError):
+            decode_ticket(flight.Ticket(data[:end]))
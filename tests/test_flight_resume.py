@@ -0,0 +1,30 @@
+import pyarrow
+
+from flightsvc.controllers.flight_resume import skip_rows
+
+
+def batches(*sizes):
+    start = 0
+    for size in sizes:
+        yield pyarrow.record_batch({'x': pyarrow.array(range(start, start + size), pyarrow.int64())})
+        start += size
+
+
+def values(batches):
+    return [value for batch in batches for value in batch['x'].to_pylist()]
+
+
+def test_skip_rows_across_batches():
+    skipped = list(skip_rows(batches(3, 4, 5), 5))
+    assert [batch.num_rows for batch in skipped] == [2, 5]
+    assert values(skipped) == list(range(5, 12))
+
+
+def test_skip_rows_at_batch_boundary():
+    assert [batch.num_rows for batch in skip_rows(batches(3, 4, 5), 7)] == [5]
+
+
+def test_skip_no_rows_and_all_rows():
+    assert values(skip_rows(batches(3, 4), 0)) == list(range(7))
+    assert list(skip_rows(batches(3, 4), 7)) == []
+    assert list(skip_rows(batches(3, 4), 10)) == []
@@ -0,0 +1,267 @@
+import threading
+import time
+
+import pyarrow
+import pytest
+
+from flightsvc.controllers.flight_resume import abort_metadata, end_metadata, sequence_metadata
+from flightsvc.controllers.flight_store import FlightStore, StoreFullError
+
+KEY = (2, b'trades', ())
+OTHER = (2, b'quotes', ())
+
+
+def table(rows, value=0):
+    return pyarrow.table({'x': pyarrow.array([value] * rows, pyarrow.int64())})
+
+
+def test_snapshot_is_immutable():
+    store = FlightStore(retired_ttl=0)
+    store.put_table(KEY, table(10))
+    before = store.snapshot()
+    store.put_table(KEY, table(20))
+    store.put_table(OTHER, table(5))
+    assert before.entries[KEY].num_rows == 10
+    assert OTHER not in before.entries
+    after = store.snapshot()
+    assert after.entries[KEY].num_rows == 20
+    assert [key for _, key in after.index] == [OTHER, KEY]
+
+
+def test_retired_version_readable_until_expiry():
+    store = FlightStore(retired_ttl=0.5)
+    old = store.put_table(KEY, table(10))
+    new = store.put_table(KEY, table(20))
+    assert store.get(KEY, old.version) is old
+    assert store.get(KEY, new.version) is new
+    time.sleep(0.6)
+    # no longer resolved, even before the sweep has run
+    assert store.get(KEY, old.version) is new
+
+
+def test_retired_versions_swept():
+    store = FlightStore(retired_ttl=0.2)
+    store.put_table(KEY, table(1000))
+    store.put_table(KEY, table(1000))
+    assert store.usage()['retired_versions'] == 1
+    time.sleep(0.5)
+    usage = store.usage()
+    assert usage['retired_versions'] == 0
+    assert usage['retired_bytes'] == 0
+    assert usage['used_bytes'] == store.get(KEY).heap_bytes
+
+
+def test_retired_bytes_count_against_memory_limit():
+    store = FlightStore(retired_ttl=60)
+    nbytes = table(1000).nbytes
+    store.memory_limit = 3 * nbytes
+    store.put_table(KEY, table(1000))
+    store.put_table(KEY, table(1000, 1))
+    assert store.usage()['used_bytes'] == 2 * nbytes
+    # the retired version is evicted before any current flight
+    store.put_table(OTHER, table(1000))
+    store.put_table((2, b'third', ()), table(1000))
+    usage = store.usage()
+    assert usage['retired_versions'] == 0
+    assert usage['used_bytes'] == 3 * nbytes
+    assert store.get(KEY) is not None and store.get(OTHER) is not None
+
+
+def test_removed_flight_releases_retired_versions():
+    store = FlightStore(retired_ttl=60)
+    store.put_table(KEY, table(1000))
+    store.put_table(KEY, table(1000))
+    store.clear(prefix='trades')
+    assert store.usage()['used_bytes'] == 0
+
+
+def test_upload_larger_than_budget():
+    store = FlightStore(memory_limit=100)
+    with pytest.raises(StoreFullError):
+        store.put_table(KEY, table(1000))
+
+
+class Chunk:
+    def __init__(self, data, app_metadata=None):
+        self.data = data
+        self.app_metadata = app_metadata
+
+
+class FailingReader:
+    """
+    A do_put reader whose stream breaks after `batches`.
+    """
+
+    def __init__(self, batches):
+        self.schema = batches[0].schema
+        self._batches = iter(batches)
+
+    def read_chunk(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            raise IOError('stream broken')
+        return Chunk(batch)
+
+
+@pytest.mark.parametrize('retired_ttl', [0, 60])
+def test_replace_flight_larger_than_half_the_budget(retired_ttl):
+    store = FlightStore(retired_ttl=retired_ttl)
+    store.memory_limit = int(table(1000).nbytes * 1.25)
+    store.put_table(KEY, table(1000))
+    store.put_table(KEY, table(1000, 1))
+    assert store.get(KEY).to_table()['x'][0].as_py() == 1
+    assert store.usage()['used_bytes'] == table(1000).nbytes
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_failed_ingest_restores_previous(streaming):
+    store = FlightStore(streaming=streaming, retired_ttl=0, dictionary_encode=False)
+    store.memory_limit = int(table(1000).nbytes * 1.25)
+    previous = store.put_table(KEY, table(1000))
+    with pytest.raises(IOError):
+        store.ingest(KEY, FailingReader([table(250, 1).to_batches()[0] for _ in range(3)]))
+    assert store.get(KEY) is previous
+    assert store.usage()['used_bytes'] == previous.heap_bytes
+
+
+class UploadReader:
+    """
+    The do_put reader of one attempt of a resumable upload: `sequences` are the
+    sequence numbers the batches are sent with, `end` the batch count of the end
+    marker, `abort` the reason of an abort marker. Without either the stream just stops.
+    """
+
+    def __init__(self, batches, sequences=None, end=None, abort=None, pause=None):
+        self.schema = batches[0].schema
+        sequences = range(len(batches)) if sequences is None else sequences
+        chunks = [Chunk(batch, sequence_metadata(sequence)) for batch, sequence in zip(batches, sequences)]
+        if end is not None:
+            chunks.append(Chunk(None, end_metadata(end)))
+        if abort is not None:
+            chunks.append(Chunk(None, abort_metadata(abort)))
+        self._chunks = iter(chunks)
+        # (read, resume) events: the reader waits for `resume` once it has read one batch
+        self._pause = pause
+
+    def read_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            raise StopIteration
+        if self._pause is not None:
+            read, resume = self._pause
+            if read.is_set():
+                resume.wait()
+            read.set()
+        return chunk
+
+
+def batches(count, rows=10):
+    return [table(rows, value).to_batches()[0] for value in range(count)]
+
+
+def test_resumed_upload_skips_held_batches():
+    store = FlightStore(dictionary_encode=False)
+    sent = batches(4)
+    acknowledged = []
+    with pytest.raises(IOError):
+        store.ingest_resumable(KEY, UploadReader(sent[:2]), 'upload', acknowledged.append)
+    entry = store.ingest_resumable(KEY, UploadReader(sent, end=4), 'upload', acknowledged.append)
+    assert acknowledged == [0, 2]
+    assert store.get(KEY) is entry
+    assert entry.to_table()['x'].to_pylist() == [value for value in range(4) for _ in range(10)]
+    assert store.usage()['used_bytes'] == entry.heap_bytes
+
+
+def test_resumable_upload_with_a_gap():
+    store = FlightStore(dictionary_encode=False)
+    with pytest.raises(ValueError, match='skipped'):
+        store.ingest_resumable(KEY, UploadReader(batches(2), [0, 2], end=3), 'upload', lambda held: None)
+    assert store.get(KEY) is None
+    assert store.usage()['used_bytes'] == 0
+
+
+def test_newer_attempt_takes_over():
+    store = FlightStore(dictionary_encode=False)
+    sent = batches(3)
+    read, resume = threading.Event(), threading.Event()
+    errors = []
+
+    def older():
+        try:
+            store.ingest_resumable(KEY, UploadReader(sent, end=3, pause=(read, resume)), 'upload', lambda held: None)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=older)
+    thread.start()
+    read.wait(5)
+    entry = store.ingest_resumable(KEY, UploadReader(sent, end=3), 'upload', lambda held: None)
+    resume.set()
+    thread.join(5)
+    assert len(errors) == 1 and isinstance(errors[0], IOError)
+    assert store.get(KEY) is entry
+    assert entry.num_rows == 30
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_aborted_upload_restores_previous(streaming):
+    store = FlightStore(streaming=streaming, retired_ttl=0, dictionary_encode=False)
+    previous = store.put_table(KEY, table(100))
+    with pytest.raises(ValueError, match='aborted'):
+        store.ingest_resumable(KEY, UploadReader(batches(2), abort='source failed'), 'upload', lambda held: None)
+    assert store.get(KEY) is previous
+    assert store.usage()['used_bytes'] == previous.heap_bytes
+    # the batches are dropped, not left for the upload to be resumed from
+    with pytest.raises(ValueError, match='from batch 0 to 1'):
+        store.ingest_resumable(KEY, UploadReader(batches(2)[1:], [1]), 'upload', lambda held: None)
+
+
+class PartReader:
+    """
+    A do_put reader sending `batches` to the end of the stream.
+    """
+
+    def __init__(self, batches):
+        self.schema = batches[0].schema
+        self._batches = iter(batches)
+
+    def read_chunk(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            raise StopIteration
+        return Chunk(batch)
+
+
+def test_parts_published_after_the_last():
+    store = FlightStore(dictionary_encode=False)
+    previous = store.put_table(KEY, table(10, -1))
+    parts = batches(3)
+    for part in (2, 0):
+        assert store.ingest_part(KEY, PartReader([parts[part]]), 'upload', part, 3) is None
+        assert store.get(KEY) is previous
+    entry = store.ingest_part(KEY, PartReader([parts[1]]), 'upload', 1, 3)
+    assert store.get(KEY) is entry
+    assert entry.to_table()['x'].to_pylist() == [value for value in range(3) for _ in range(10)]
+
+
+def test_duplicate_part_fails_the_upload():
+    store = FlightStore(retired_ttl=0, dictionary_encode=False)
+    previous = store.put_table(KEY, table(10, -1))
+    parts = batches(2)
+    store.ingest_part(KEY, PartReader([parts[0]]), 'upload', 0, 2)
+    with pytest.raises(IOError, match='twice'):
+        store.ingest_part(KEY, PartReader([parts[0]]), 'upload', 0, 2)
+    assert store.get(KEY) is previous
+    assert store.usage()['used_bytes'] == previous.heap_bytes
+
+
+def test_failed_part_drops_the_upload():
+    store = FlightStore(retired_ttl=0, dictionary_encode=False)
+    previous = store.put_table(KEY, table(10, -1))
+    parts = batches(3)
+    store.ingest_part(KEY, PartReader([parts[0]]), 'upload', 0, 2)
+    with pytest.raises(IOError, match='stream broken'):
+        store.ingest_part(KEY, FailingReader(parts[1:]), 'upload', 1, 2)
+    assert store.get(KEY) is previous
+    assert store.get(KEY).to_table()['x'].to_pylist() == [-1] * 10
+    assert store.usage()['used_bytes'] == previous.heap_bytes
@@ -0,0 +1,70 @@
+import threading
+
+import pyarrow
+import pyarrow.flight as flight
+import pytest
+
+from flightsvc.controllers.flight_pool import FlightClientPool
+from flightsvc.controllers.multi_flight_producer import FlightServer
+from flightsvc.controllers import parallel_flight_client
+from flightsvc.controllers.parallel_flight_client import fetch_endpoints, put_shards
+
+KEY = (2, b'sharded', ())
+
+
+@pytest.fixture
+def producers():
+    servers = [FlightServer(location='grpc://localhost:0') for _ in range(2)]
+    for server in servers:
+        threading.Thread(target=server.serve, daemon=True).start()
+    yield servers
+    for server in servers:
+        server.shutdown()
+
+
+def table(rows, value):
+    return pyarrow.table({'k': pyarrow.array(range(rows), pyarrow.int64()), 'v': [value] * rows})
+
+
+def read(url):
+    client = flight.FlightClient(url)
+    info = client.get_flight_info(flight.FlightDescriptor.for_command('sharded'))
+    return fetch_endpoints(info, url)
+
+
+def test_failed_shard_keeps_previous_flights(producers):
+    urls = [f'grpc://localhost:{server.port}' for server in producers]
+    pool = FlightClientPool()
+    shards = put_shards(pool, urls, 'sharded', table(20000, 1.0), shard_by='k', batch_size=1000)
+    previous = [server.flights.get(KEY) for server in producers]
+
+    # the second producer has no room for its new shard
+    producers[1].flights.memory_limit = int(producers[1].flights.usage()['used_bytes'] * 1.5)
+    with pytest.raises(flight.FlightError):
+        put_shards(pool, urls, 'sharded', table(40000, 2.0), shard_by='k', batch_size=1000)
+
+    for server, entry in zip(producers, previous):
+        assert server.flights.get(KEY) is entry
+        assert server.flights.get(KEY).shards == shards
+    result = read(urls[0])
+    assert result.num_rows == 20000
+    assert pyarrow.compute.sum(result['v']).as_py() == 20000.0
+
+
+def test_shards_published_once_all_prepared(producers, monkeypatch):
+    urls = [f'grpc://localhost:{server.port}' for server in producers]
+    pool = FlightClientPool()
+    put_shards(pool, urls, 'sharded', table(20000, 1.0), shard_by='k', batch_size=1000)
+    previous = [server.flights.get(KEY) for server in producers]
+    seen = []
+
+    class Barrier(threading.Barrier):
+        def wait(self, timeout=None):
+            # every producer holds its shard, none may serve it yet
+            seen.append([server.flights.get(KEY) for server in producers])
+            return super().wait(timeout)
+
+    monkeypatch.setattr(parallel_flight_client.threading, 'Barrier', Barrier)
+    put_shards(pool, urls, 'sharded', table(40000, 2.0), shard_by='k', batch_size=1000)
+    assert seen == [previous, previous]
+    assert read(urls[0]).num_rows == 40000